@@ -48,13 +48,94 @@ Code Author: Miles Cameron
 
 Running Time Analysis of get_org_budget
 --------------------
-get_org_budget runtime is O(N)
+get_org_budget runtime is O(1)
 
-In the worst case (summing the CEO's org), we need to visit ever single
-node in order to calculate the budget. This is done with my recursive traversal
-helper function sum_budgets.
+Every node keeps the total budget of its subtree in org_budget. The totals
+are filled in once during construction with a single post-order traversal
+(O(N)), so a query is one dictionary lookup plus a field read.
+
+Changing one budget with set_budget only touches the totals on the path from
+that employee up to the CEO, which is O(depth of the employee).
+
+Running Time Analysis of reorganizations
+--------------------
+add_employee, remove_employee, move_subtree and set_budget are O(log N)
+expected once the org has been reorganized (remove_employee also relinks each
+direct report in O(1)).
+
+The first reorganization builds an Euler tour of the tree in O(N) and stores
+it in an implicit treap. A subtree is a contiguous run of the tour, so every
+change is a handful of treap splits and merges, and until the cached totals
+are refreshed get_org_budget reads a subtree sum from the treap in O(log N).
+
+CompactOrganization answers get_org_budget in O(log N) with a binary search
+over its sorted id array followed by a read of the precomputed total.
+
+Running Time Analysis of analytics
+--------------------
+analytics() builds an OrgAnalyticsIndex in O(N log N) the first time it is
+called after a change. top_budgets(n) is then O(n), lowest_common_manager is
+O(1) with a sparse table over the pre-order, and get_org_budget_to_depth is
+O(log^2 N) using a merge sort tree of depths over pre-order positions.
+
+Running Time Analysis of versioned queries
+--------------------
+With versioned=True every mutation bumps self.version and
+get_org_budget(employee_id, as_of=version) is O(log N).
+
+Every employee gets a fixed slot in a persistent array the first time they
+are seen, holding their org budget, manager and report count. A budget
+change, hire, termination or move rewrites the slots of the employees it
+touches and of everyone above them, path-copying O(depth * log N) nodes
+and sharing the rest with the previous version, so history grows with the
+size of the changes rather than the size of the organization.
+
+CompactOrganization.load_snapshot maps a file written by save_snapshot with
+mmap and reads the arrays in place, so loading is O(1) apart from the pages
+the queries actually touch.
+
+Running Time Analysis of get_org_budgets
+--------------------
+get_org_budgets answers Q queries in O(N + Q).
+
+Subtree totals are brought up to date once (O(N) if a reorg left them stale,
+otherwise free), then every query is a dictionary hit. NumPy id arrays are
+gathered in one vectorized step from a dense id table (or a sorted id array
+with searchsorted when the ids are spread out), built once and reused until
+the org changes.
+
+Running Time Analysis of construction
+--------------------
+Building the organization is O(N).
+
+Each employee is visited once. Its manager is found with a dictionary lookup
+on manager_id, and reports that show up before their manager wait in a
+pending dictionary until the manager arrives, so input order doesn't matter.
+Employees that can't be reached from the CEO (orphans, cycles and anything
+hanging below them) are reported in build_result instead of the tree.
+
+Because the builder only ever looks at one employee at a time, from_file can
+stream a CSV or JSONL feed through read_employees straight into it without
+materializing the list of Employee objects.
 """
 
+import random
+from array import array
+from bisect import bisect_left
+import csv
+from itertools import accumulate, chain
+import json
+import mmap
+import operator
+import os
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class Employee:
     def __init__(self, employee_id, manager_id, budget):
@@ -72,88 +153,1222 @@ class EmployeeTreeNode:
         self.reports = []
         self.manager_node = None
         self.is_manager = False
+        # Total budget of the subtree rooted here, kept up to date by
+        #       AlgoBookOrganization
+        self.org_budget = employee.budget
+        # Position of this node in its manager's reports list
+        self.report_index = 0
+
+
+class OrgBuildResult:
+    """
+    Structured report of how the employee list was turned into a tree.
+
+    Employees that cannot be reached from the CEO are left out of node_map
+    and listed here instead of being silently dropped.
+    """
+    def __init__(self):
+        self.placed=0
+        # Employees whose manager_id never appeared in the input
+        self.orphans=[]
+        # Employees with no manager after the CEO has already been found
+        self.extra_roots=[]
+        # Lists of employee ids that manage each other in a loop
+        self.cycles=[]
+        # Employees hanging underneath an orphan, extra root or cycle
+        self.detached=[]
+        # Employee ids seen more than once (the first occurrence is kept)
+        self.duplicates=[]
+
+    def is_complete(self):
+        return not (self.orphans or self.extra_roots or self.cycles or
+                    self.detached or self.duplicates)
+
+    def _sort_unplaced(self, unplaced, manager_of, employee_id_of):
+        # Walk up the manager chain of every unplaced employee. A walk that
+        #       runs into its own path has found a new loop; everything else
+        #       on the path is detached. Each employee is walked once.
+        #       manager_of and employee_id_of translate the caller's keys
+        #       (node ids or array indices) so both backends can share this.
+        classified={}
+        for employee_id in self.orphans:
+            classified[employee_id]=True
+        for employee_id in self.extra_roots:
+            classified[employee_id]=True
+        seen=set()
+        for key in unplaced:
+            if key in seen or employee_id_of(key) in classified:
+                continue
+            path=[]
+            on_path={}
+            current=key
+            while current is not None and current not in seen \
+                    and employee_id_of(current) not in classified \
+                    and current not in on_path:
+                on_path[current]=len(path)
+                path.append(current)
+                current=manager_of(current)
+            loop_start=len(path)
+            if current is not None and current in on_path:
+                loop_start=on_path[current]
+                self.cycles.append([employee_id_of(k) for k in path[loop_start:]])
+            self.detached.extend(employee_id_of(k) for k in path[:loop_start])
+            seen.update(on_path)
+
+
+class _TourToken:
+    """
+    One entry in the Euler tour of the organization, stored as a node of an
+    implicit treap. Each employee has an enter token carrying their budget
+    and an exit token carrying 0, so the tokens between the two add up to
+    the budget of that employee's subtree.
+    """
+    __slots__=('employee_id', 'value', 'priority', 'size', 'total',
+               'left', 'right', 'parent')
+
+    def __init__(self, employee_id, value):
+        self.employee_id=employee_id
+        self.value=value
+        self.priority=random.random()
+        self.size=1
+        self.total=value
+        self.left=None
+        self.right=None
+        self.parent=None
+
+
+class EulerTourIndex:
+    """
+    Euler tour of the organization kept in an implicit treap.
+
+    A subtree is always a contiguous run of the tour, so subtree budgets,
+    moving a subtree and hiring or terminating an employee are all a few
+    O(log N) expected splits and merges.
+    """
+    def __init__(self, org_head):
+        self.enter={}
+        self.exit={}
+        if org_head is None:
+            return
+
+        # Iterative DFS producing the tour in order
+        sequence=[]
+        stack=[(org_head, False)]
+        while stack:
+            node, done=stack.pop()
+            if done:
+                token=_TourToken(node.id, 0)
+                self.exit[node.id]=token
+            else:
+                token=_TourToken(node.id, node.budget)
+                self.enter[node.id]=token
+                stack.append((node, True))
+                for report in reversed(node.reports):
+                    stack.append((report, False))
+            sequence.append(token)
+
+        # Build the treap in O(N) with the rightmost-spine stack method
+        spine=[]
+        for token in sequence:
+            last=None
+            while spine and spine[-1].priority<token.priority:
+                last=spine.pop()
+            token.left=last
+            if last is not None:
+                last.parent=token
+            if spine:
+                spine[-1].right=token
+                token.parent=spine[-1]
+            spine.append(token)
+
+        # Fill in sizes and totals bottom up (post-order over the treap)
+        order=[spine[0]]
+        for token in order:
+            if token.left is not None:
+                order.append(token.left)
+            if token.right is not None:
+                order.append(token.right)
+        for token in reversed(order):
+            self._pull(token)
+
+    @staticmethod
+    def _pull(token):
+        size=1
+        total=token.value
+        if token.left is not None:
+            size+=token.left.size
+            total+=token.left.total
+        if token.right is not None:
+            size+=token.right.size
+            total+=token.right.total
+        token.size=size
+        token.total=total
+
+    @staticmethod
+    def _root(token):
+        while token.parent is not None:
+            token=token.parent
+        return token
+
+    @staticmethod
+    def _position(token):
+        # Number of tokens before this one in the tour
+        position=token.left.size if token.left is not None else 0
+        while token.parent is not None:
+            if token.parent.right is token:
+                position+=1
+                if token.parent.left is not None:
+                    position+=token.parent.left.size
+            token=token.parent
+        return position
+
+    @staticmethod
+    def _prefix_total(token):
+        # Sum of the values of every token up to and including this one
+        total=token.value
+        if token.left is not None:
+            total+=token.left.total
+        while token.parent is not None:
+            if token.parent.right is token:
+                total+=token.parent.value
+                if token.parent.left is not None:
+                    total+=token.parent.left.total
+            token=token.parent
+        return total
+
+    def _split(self, token, count):
+        # Split a treap into its first count tokens and the rest
+        if token is None:
+            return None, None
+        left_size=token.left.size if token.left is not None else 0
+        if count<=left_size:
+            left, token.left=self._split(token.left, count)
+            if token.left is not None:
+                token.left.parent=token
+            if left is not None:
+                left.parent=None
+            self._pull(token)
+            return left, token
+        token.right, right=self._split(token.right, count-left_size-1)
+        if token.right is not None:
+            token.right.parent=token
+        if right is not None:
+            right.parent=None
+        self._pull(token)
+        return token, right
+
+    def _merge(self, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority>right.priority:
+            left.right=self._merge(left.right, right)
+            left.right.parent=left
+            self._pull(left)
+            return left
+        right.left=self._merge(left, right.left)
+        right.left.parent=right
+        self._pull(right)
+        return right
+
+    def _cut(self, employee_id):
+        # Remove an employee's whole subtree from the tour and return it
+        start=self._position(self.enter[employee_id])
+        end=self._position(self.exit[employee_id])
+        before, rest=self._split(self._root(self.enter[employee_id]), start)
+        segment, after=self._split(rest, end-start+1)
+        self._merge(before, after)
+        return segment
+
+    def _insert_before(self, token, segment):
+        before, after=self._split(self._root(token), self._position(token))
+        self._merge(self._merge(before, segment), after)
+
+    def _discard(self, token):
+        position=self._position(token)
+        before, rest=self._split(self._root(token), position)
+        removed, after=self._split(rest, 1)
+        self._merge(before, after)
+
+    def subtree_total(self, employee_id):
+        enter=self.enter[employee_id]
+        return self._prefix_total(self.exit[employee_id]) - \
+            self._prefix_total(enter) + enter.value
+
+    def contains(self, ancestor_id, employee_id):
+        # True if employee_id is in the subtree rooted at ancestor_id
+        position=self._position(self.enter[employee_id])
+        return self._position(self.enter[ancestor_id])<=position<= \
+            self._position(self.exit[ancestor_id])
+
+    def add(self, employee_id, budget, manager_id):
+        # New employees go in as the last report of their manager
+        enter=_TourToken(employee_id, budget)
+        exit=_TourToken(employee_id, 0)
+        self.enter[employee_id]=enter
+        self.exit[employee_id]=exit
+        self._insert_before(self.exit[manager_id], self._merge(enter, exit))
+
+    def remove(self, employee_id):
+        # The reports stay where they are in the tour, which places them
+        #       under the removed employee's manager
+        self._discard(self.enter.pop(employee_id))
+        self._discard(self.exit.pop(employee_id))
+
+    def move(self, employee_id, new_manager_id):
+        segment=self._cut(employee_id)
+        self._insert_before(self.exit[new_manager_id], segment)
+
+    def set_budget(self, employee_id, budget):
+        token=self.enter[employee_id]
+        token.value=budget
+        while token is not None:
+            self._pull(token)
+            token=token.parent
+
+
+def _make_budget_lookup(ids, budgets):
+    # Index org budgets by employee id for vectorized gathers. Closely packed
+    #       ids get a dense table (O(N) to build), anything else is sorted.
+    if len(ids)==0:
+        return ('empty', None, budgets)
+    low=int(ids.min())
+    span=int(ids.max())-low+1
+    if span<=4*len(ids):
+        table=np.zeros(span, dtype=budgets.dtype)
+        table[ids-low]=budgets
+        return ('dense', low, table)
+    order=np.argsort(ids, kind='stable')
+    return ('sorted', ids[order], budgets[order])
+
+
+def _gather_budgets(lookup, employee_ids):
+    # Look up every id at once; unknown ids come back as 0
+    kind, keys, values=lookup
+    result=np.zeros(employee_ids.shape, dtype=values.dtype)
+    if kind=='empty':
+        return result
+    if kind=='dense':
+        offsets=employee_ids.astype(np.int64)-keys
+        found=(offsets>=0)&(offsets<len(values))
+        result[found]=values[offsets[found]]
+        return result
+    positions=np.searchsorted(keys, employee_ids)
+    positions[positions==len(keys)]=len(keys)-1
+    found=keys[positions]==employee_ids
+    result[found]=values[positions[found]]
+    return result
+
+
+class PersistentArray:
+    """
+    Persistent array of slots that grows on demand.
+
+    A version is a (root, height) pair over a binary trie of 2**height
+    slots. Inner nodes are immutable (left, right) tuples and None stands
+    for a run of empty slots. Setting a slot copies only the O(log N) nodes
+    on its path and shares everything else with the previous version, and
+    growing the array wraps the old root, so every old version stays
+    readable.
+    """
+    @staticmethod
+    def build(values):
+        # Version holding values in slots 0..len(values)-1, built in O(N)
+        height=0
+        level=list(values)
+        while len(level)>1:
+            if len(level) % 2:
+                level.append(None)
+            level=[(level[i], level[i+1]) for i in range(0, len(level), 2)]
+            height+=1
+        return (level[0] if level else None), height
+
+    @staticmethod
+    def get(version, index):
+        node, height=version
+        if index>=1 << height:
+            return None
+        for bit in range(height-1, -1, -1):
+            if node is None:
+                return None
+            node=node[(index >> bit) & 1]
+        return node
+
+    @staticmethod
+    def set(version, index, value):
+        # New version with slot index set to value
+        node, height=version
+        while index>=1 << height:
+            node=(node, None)
+            height+=1
+        path=[]
+        for bit in range(height-1, -1, -1):
+            side=(index >> bit) & 1
+            path.append((node, side))
+            node=node[side] if node is not None else None
+        for node, side in reversed(path):
+            if node is None:
+                node=(None, None)
+            value=(value, node[1]) if side==0 else (node[0], value)
+        return value, height
+
+
+def _parse_field(text):
+    # CSV fields arrive as strings; ids and budgets are numbers when they
+    #       look like numbers and blank / null managers mean "no manager"
+    text=text.strip()
+    if text=='' or text.lower() in ('none', 'null'):
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def read_employees(path, chunk_size=1 << 20):
+    """
+    Stream Employee objects out of a CSV or JSONL file.
+
+    CSV rows are employee_id,manager_id,budget (an optional header row is
+    skipped). Files ending in .jsonl or .json hold one object per line with
+    those three keys. The file is read chunk_size bytes of lines at a time
+    and each Employee is handed on as soon as it is parsed, so no list of
+    employees is ever built.
+    """
+    is_json=path.endswith(('.jsonl', '.json'))
+    with open(path, newline='') as source:
+        first_row=True
+        # Lines read before the current chunk, for error messages
+        line_offset=0
+        while True:
+            lines=source.readlines(chunk_size)
+            if not lines:
+                break
+            chunk_offset=line_offset
+            line_offset+=len(lines)
+            if is_json:
+                for line in lines:
+                    if line.strip():
+                        record=json.loads(line)
+                        yield Employee(record['employee_id'],
+                                       record.get('manager_id'),
+                                       record['budget'])
+                continue
+            reader=csv.reader(lines)
+            for row in reader:
+                if not row:
+                    continue
+                if first_row:
+                    first_row=False
+                    if row[0].strip().lower()=='employee_id':
+                        continue
+                if len(row)<3:
+                    raise ValueError(f"{path}: line "
+                                     f"{chunk_offset+reader.line_num}: "
+                                     f"expected employee_id,manager_id,"
+                                     f"budget, got {row!r}")
+                yield Employee(_parse_field(row[0]), _parse_field(row[1]),
+                               _parse_field(row[2]))
 
 
 class AlgoBookOrganization:
-    def __init__(self, employees):
+    def __init__(self, employees, versioned=False):
+        self.org_head=None
+        self.node_map={}
+        # Euler tour index, built the first time the org is reorganized
+        self._tour=None
+        # True when org_budget fields are out of date and the tour is the
+        #       source of truth for subtree totals
+        self._totals_stale=False
+        # Sorted id / org budget arrays used by get_org_budgets
+        self._budget_lookup=None
+        # Planning index returned by analytics()
+        self._analytics=None
+        self.build_result=self._build(employees)
+        # Version history for get_org_budget(..., as_of=version). Every
+        #       employee ever seen keeps a fixed slot in a PersistentArray
+        #       holding (org budget, manager id, report count), and entry v
+        #       is that array as of version v.
+        self.version=0
+        self._versions=None
+        self._slots=None
+        if versioned:
+            self._slots={employee_id: slot for slot, employee_id
+                         in enumerate(self.node_map)}
+            self._versions=[PersistentArray.build(
+                self._slot_record(node) for node in self.node_map.values())]
+
+    @classmethod
+    def from_file(cls, path, chunk_size=1 << 20, versioned=False):
+        # Build straight from a CSV / JSONL HR feed without an Employee list
+        return cls(read_employees(path, chunk_size), versioned=versioned)
+
+    def _build(self, employees):
+
+        link=self._link
+
+        result=OrgBuildResult()
+        ceo=None
+        # Every node created so far, placed or not, keyed by employee id
+        nodes={}
+        # Reports whose manager has not shown up yet, keyed by manager id
+        pending={}
+
+        # Single pass over the input. Each employee is linked to its manager
+        #       with a dictionary lookup, so the input order doesn't matter
+        #       and the caller's list is never modified.
+        for employee in employees:
 
-        # Recursive helper function for tree creation
-        def add_to_org(current_node, new_node):
+            if employee.employee_id in nodes:
+                result.duplicates.append(employee.employee_id)
+                continue
+
+            new_node=EmployeeTreeNode(employee)
+            nodes[new_node.id]=new_node
+
+            # Adopt any reports that arrived before their manager
+            waiting=pending.pop(new_node.id, None)
+            if waiting:
+                for report in waiting:
+                    link(new_node, report)
+
+            if new_node.manager_id is None:
+                if ceo is None:
+                    ceo=new_node
+                else:
+                    result.extra_roots.append(new_node.id)
+            elif new_node.manager_id in nodes:
+                link(nodes[new_node.manager_id], new_node)
+            else:
+                pending.setdefault(new_node.manager_id, []).append(new_node)
+
+        # Anyone still waiting has a manager that was never in the input
+        for waiting in pending.values():
+            result.orphans.extend(report.id for report in waiting)
+
+        # Only employees reachable from the CEO make it into the node map.
+        #       The map is filled in pre-order (managers before reports).
+        node_map={}
+        if ceo is not None:
+            stack=[ceo]
+            while stack:
+                node=stack.pop()
+                node_map[node.id]=node
+                stack.extend(node.reports)
+
+        # Walking the pre-order backwards is a post-order pass, so every
+        #       subtree total is finished before it is added to its manager
+        for node in reversed(node_map.values()):
+            if node.manager_node is not None:
+                node.manager_node.org_budget+=node.org_budget
+
+        # Sort the remaining employees into cycles and detached subtrees
+        if len(node_map)<len(nodes):
+            result._sort_unplaced(
+                (key for key in nodes if key not in node_map),
+                lambda key: nodes[key].manager_node.id
+                if nodes[key].manager_node is not None else None,
+                lambda key: key)
+
+        result.placed=len(node_map)
+        self.org_head=ceo
+        self.node_map=node_map
+        return result
 
-            # If the manager is found, add the current node to reports
-            if current_node.id==new_node.manager_id:
 
-                current_node.reports.append(new_node)
-                current_node.is_manager=True
-                new_node.manager_node=current_node
+    def get_org_budget(self, employee_id, as_of=None):
 
-                # Returning True stops the search traversal
-                return True
+        if as_of is not None:
+            return self._get_versioned_budget(employee_id, as_of)
 
-            # Recursively traverse, and stop if the manager is found
-            for report in current_node.reports:
-                if add_to_org(report, new_node):
-                    return True
+        # First check if the employee ID exists in the org
+        employee=self.node_map.get(employee_id)
+        if employee is None:
+            return 0
 
-        # Main block for tree construction begins here
+        # If employee is a manager, their own subtree total is the answer
+        # If employee is not a manager, use their manager's subtree total
+        if not employee.is_manager and employee.manager_node is not None:
+            employee=employee.manager_node
+        if self._totals_stale:
+            return self._tour.subtree_total(employee.id)
+        return employee.org_budget
+
+    def set_budget(self, employee_id, budget):
+
+        employee=self.node_map.get(employee_id)
+        if employee is None:
+            raise KeyError(employee_id)
+
+        delta=budget-employee.budget
+        employee.budget=budget
+
+        # Once the tour exists it takes the update in O(log N)
+        if self._tour is not None:
+            self._tour.set_budget(employee_id, budget)
+            self._totals_stale=True
+            self._changed(employee_id)
+            return
+
+        # Otherwise only the totals on the path up to the CEO change
+        node=employee
+        while node is not None:
+            node.org_budget+=delta
+            node=node.manager_node
+        self._changed(employee_id)
+
+    def add_employee(self, employee):
+
+        if employee.employee_id in self.node_map:
+            raise ValueError(f"Employee {employee.employee_id} already exists")
+
+        new_node=EmployeeTreeNode(employee)
+
+        # Hiring into an empty org makes the new employee the CEO
+        if employee.manager_id is None:
+            if self.org_head is not None:
+                raise ValueError("The organization already has a CEO")
+            self.org_head=new_node
+            self.node_map[new_node.id]=new_node
+            self._tour=None
+            self._totals_stale=False
+            self._changed(new_node.id)
+            return
+
+        manager=self.node_map.get(employee.manager_id)
+        if manager is None:
+            raise KeyError(employee.manager_id)
+
+        tour=self._get_tour()
+        self._link(manager, new_node)
+        self.node_map[new_node.id]=new_node
+        tour.add(new_node.id, new_node.budget, manager.id)
+        self._totals_stale=True
+        self._changed(new_node.id)
+
+    def remove_employee(self, employee_id):
+
+        employee=self.node_map.get(employee_id)
+        if employee is None:
+            raise KeyError(employee_id)
+        if employee is self.org_head:
+            raise ValueError("The CEO can't be removed from the organization")
+
+        tour=self._get_tour()
+        manager=employee.manager_node
+        self._unlink(employee)
+        # Direct reports now report to the removed employee's manager
+        reports=employee.reports
+        for report in reports:
+            self._link(manager, report)
+        employee.reports=[]
+        del self.node_map[employee_id]
+        tour.remove(employee_id)
+        self._totals_stale=True
+        self._changed(employee_id, manager.id,
+                      *(report.id for report in reports))
+
+    def move_subtree(self, employee_id, new_manager_id):
+
+        employee=self.node_map.get(employee_id)
+        new_manager=self.node_map.get(new_manager_id)
+        if employee is None:
+            raise KeyError(employee_id)
+        if new_manager is None:
+            raise KeyError(new_manager_id)
+        if employee is self.org_head:
+            raise ValueError("The CEO's organization can't be moved")
+
+        tour=self._get_tour()
+        # A manager can't be moved underneath their own organization
+        if tour.contains(employee_id, new_manager_id):
+            raise ValueError(f"Employee {new_manager_id} is inside the \
+organization of {employee_id}")
+
+        old_manager_id=employee.manager_node.id
+        self._unlink(employee)
+        self._link(new_manager, employee)
+        employee.manager_id=new_manager_id
+        tour.move(employee_id, new_manager_id)
+        self._totals_stale=True
+        self._changed(employee_id, old_manager_id)
+
+    @staticmethod
+    def _link(manager, report):
+        # Hook a report up to its manager
+        report.report_index=len(manager.reports)
+        manager.reports.append(report)
+        manager.is_manager=True
+        report.manager_node=manager
+        report.manager_id=manager.id
+
+    @staticmethod
+    def _unlink(report):
+        # Swap the last report into this one's slot so removal is O(1)
+        manager=report.manager_node
+        last=manager.reports.pop()
+        if last is not report:
+            manager.reports[report.report_index]=last
+            last.report_index=report.report_index
+        manager.is_manager=len(manager.reports)>0
+        report.manager_node=None
+
+    def get_org_budgets(self, employee_ids):
+
+        # Bring every cached total up to date once, O(N) at most
+        self._refresh_totals()
+
+        if np is not None and isinstance(employee_ids, np.ndarray) and \
+                employee_ids.dtype.kind in 'iu':
+            if self._budget_lookup is None:
+                self._budget_lookup=self._build_budget_lookup()
+            if self._budget_lookup[0]!='dict':
+                return _gather_budgets(self._budget_lookup, employee_ids)
+            # Ids int64 can't hold: look each one up in the dict instead
+            budgets=[self.get_org_budget(employee_id)
+                     for employee_id in employee_ids.ravel().tolist()]
+            return np.array(budgets, dtype=None if budgets else np.int64) \
+                .reshape(employee_ids.shape)
+
+        # Plain sequences: each lookup is now a dict hit plus a field read
+        return [self.get_org_budget(employee_id) for employee_id in employee_ids]
+
+    def _build_budget_lookup(self):
+        # Vectorized lookup over int64 employee ids, or ('dict', None, None)
+        #       when some id isn't an integer that fits
+        if not all(isinstance(employee_id, (int, np.integer))
+                   for employee_id in self.node_map):
+            return ('dict', None, None)
+        try:
+            ids=np.fromiter(self.node_map.keys(), dtype=np.int64,
+                            count=len(self.node_map))
+        except OverflowError:
+            return ('dict', None, None)
+        budgets=[self.get_org_budget(employee_id)
+                 for employee_id in self.node_map]
+        return _make_budget_lookup(
+            ids, np.array(budgets, dtype=None if budgets else np.int64))
+
+    def analytics(self):
+        # Build the planning index on first use and reuse it until the org
+        #       changes
+        if self._analytics is None:
+            self._analytics=OrgAnalyticsIndex(self)
+        return self._analytics
+
+    def _changed(self, *employee_ids):
+        # Called on every mutation to drop derived lookup structures and,
+        #       in versioned mode, record a new version. employee_ids are
+        #       the employees whose budget, manager or reports changed (or
+        #       who left); their slots and those of everyone above them are
+        #       rewritten, O(depth * log N) in total.
+        self._budget_lookup=None
+        self._analytics=None
+        if self._versions is None:
+            return
+        self.version+=1
+        version=self._versions[-1]
+        refreshed=set()
+        for employee_id in employee_ids:
+            while employee_id is not None and employee_id not in refreshed:
+                refreshed.add(employee_id)
+                node=self.node_map.get(employee_id)
+                slot=self._slots.setdefault(employee_id, len(self._slots))
+                version=PersistentArray.set(
+                    version, slot,
+                    self._slot_record(node) if node is not None else None)
+                employee_id=node.manager_id if node is not None else None
+        self._versions.append(version)
+
+    def _slot_record(self, node):
+        # What a version remembers about one employee
+        if self._totals_stale:
+            org_budget=self._tour.subtree_total(node.id)
+        else:
+            org_budget=node.org_budget
+        return (org_budget, node.manager_id, len(node.reports))
+
+    def _get_versioned_budget(self, employee_id, version):
+        if self._versions is None:
+            raise ValueError("as_of needs an organization built with \
+versioned=True")
+        if not 0<=version<len(self._versions):
+            raise ValueError(f"Unknown version {version}")
+        slot=self._slots.get(employee_id)
+        record=PersistentArray.get(self._versions[version], slot) \
+            if slot is not None else None
+        if record is None:
+            return 0
+        org_budget, manager_id, report_count=record
+        # ICs resolve to their manager's organization in that version
+        if report_count==0 and manager_id is not None:
+            org_budget=PersistentArray.get(self._versions[version],
+                                           self._slots[manager_id])[0]
+        return org_budget
+
+    def to_compact(self):
+        return CompactOrganization.from_organization(self)
+
+    def save_snapshot(self, path):
+        # Snapshots are written in the compact layout and load back as a
+        #       read-only CompactOrganization
+        self.to_compact().save_snapshot(path)
+
+    def _get_tour(self):
+        if self._tour is None:
+            self._tour=EulerTourIndex(self.org_head)
+        return self._tour
+
+    def _refresh_totals(self):
+        # Recompute every org_budget field with one post-order pass
+        if not self._totals_stale or self.org_head is None:
+            return
+        order=[self.org_head]
+        for node in order:
+            node.org_budget=node.budget
+            order.extend(node.reports)
+        for node in reversed(order):
+            if node.manager_node is not None:
+                node.manager_node.org_budget+=node.org_budget
+        self._totals_stale=False
+
+
+class OrgAnalyticsIndex:
+    """
+    Read-only index over an AlgoBookOrganization for planning queries.
+
+    Built once in O(N log N) from a pre-order walk of the tree:
+    - managers sorted by org budget for top_budgets
+    - a sparse table of depths over the pre-order for O(1) lowest common
+      manager lookups
+    - a merge sort tree over the pre-order, each block sorted by depth with
+      budget prefix sums, for depth-limited rollups
+    """
+    def __init__(self, organization):
+        organization._refresh_totals()
+        head=organization.org_head
+
+        self.position={}
+        self.last_position={}
+        self.depth={}
+        self.nodes=[]
+        node_depths=[]
+
+        # Iterative pre-order walk; a second visit closes the subtree
+        stack=[(head, 0, False)] if head is not None else []
+        while stack:
+            node, depth, done=stack.pop()
+            if done:
+                self.last_position[node.id]=len(self.nodes)-1
+                continue
+            self.position[node.id]=len(self.nodes)
+            self.depth[node.id]=depth
+            self.nodes.append(node)
+            node_depths.append(depth)
+            stack.append((node, depth, True))
+            for report in reversed(node.reports):
+                stack.append((report, depth+1, False))
+
+        # Sparse table of depth*size+position over the pre-order. The min of
+        #       a range picks its shallowest node, ties broken by position.
+        size=len(self.nodes)
+        level=[depth*size+i for i, depth in enumerate(node_depths)]
+        self.sparse=[level]
+        width=1
+        while 2*width<=size:
+            level=list(map(min, level[:-width], level[width:]))
+            self.sparse.append(level)
+            width*=2
+
+        # Merge sort tree over the same depth*size+position keys. Level L
+        #       holds the pre-order cut into blocks of 2**L, each block
+        #       sorted (so by depth), plus running budget sums along the
+        #       level. Sorting a level only merges two sorted halves per
+        #       block, which timsort does in linear time.
+        budgets=[node.budget for node in self.nodes]
+        level=self.sparse[0]
+        self.depth_keys=[]
+        self.depth_sums=[]
+        width=1
+        while True:
+            self.depth_keys.append(level)
+            self.depth_sums.append(list(accumulate(
+                (budgets[key % size] for key in level), initial=0)))
+            if width>=size:
+                break
+            level=list(chain.from_iterable(
+                sorted(level[start:start+2*width])
+                for start in range(0, size, 2*width)))
+            width*=2
+
+        # Every organization sorted by budget, largest first, ties by id
+        self.ranked_orgs=sorted(
+            ((node.org_budget, node.id) for node in self.nodes
+             if node.is_manager or node.manager_node is None),
+            key=lambda entry: (-entry[0], entry[1]))
+
+    def top_budgets(self, count):
+        # The count largest organizations as (manager_id, org_budget), O(count)
+        return [(employee_id, budget)
+                for budget, employee_id in self.ranked_orgs[:count]]
+
+    def lowest_common_manager(self, first_id, second_id):
+
+        if first_id not in self.position or second_id not in self.position:
+            return None
+
+        if first_id==second_id:
+            node=self.nodes[self.position[first_id]]
+            if not node.is_manager and node.manager_node is not None:
+                return node.manager_node.id
+            return node.id
+
+        left=self.position[first_id]
+        right=self.position[second_id]
+        if left>right:
+            left, right=right, left
+        # An employee manages everyone inside their pre-order range
+        if right<=self.last_position[self.nodes[left].id]:
+            return self.nodes[left].id
+
+        # Otherwise the shallowest node strictly after left and up to right
+        #       is a direct report of the common manager
+        left+=1
+        level=(right-left+1).bit_length()-1
+        table=self.sparse[level]
+        lowest=min(table[left], table[right-(1 << level)+1])
+        return self.nodes[lowest % len(self.nodes)].manager_node.id
+
+    def get_org_budget_to_depth(self, employee_id, depth):
+        # Budget of the organization counting only people at most depth
+        #       levels below its manager. O(log^2 N): the pre-order range
+        #       splits into O(log N) merge sort tree blocks and each block
+        #       needs one binary search for the depth cut-off.
+        if employee_id not in self.position or depth<0:
+            return 0
+        node=self.nodes[self.position[employee_id]]
+        if not node.is_manager and node.manager_node is not None:
+            node=node.manager_node
+
+        size=len(self.nodes)
+        # Keys below limit belong to nodes no deeper than the cut-off
+        limit=(self.depth[node.id]+depth+1)*size
+        low=self.position[node.id]
+        high=self.last_position[node.id]+1
+        total=0
+        level=0
+        while low<high:
+            if low & 1:
+                total+=self._block_total(level, low, limit)
+                low+=1
+            if high & 1:
+                high-=1
+                total+=self._block_total(level, high, limit)
+            low>>=1
+            high>>=1
+            level+=1
+        return total
+
+    def _block_total(self, level, block, limit):
+        # Budget of the nodes in one merge sort tree block with keys below
+        #       limit
+        start=block << level
+        end=min(start+(1 << level), len(self.nodes))
+        cut=bisect_left(self.depth_keys[level], limit, start, end)
+        sums=self.depth_sums[level]
+        return sums[cut]-sums[start]
+
+
+class CompactOrganization:
+    """
+    Array-backed storage for an AlgoBook organization.
+
+    The tree is held as parallel typed arrays sorted by employee id, so an
+    employee costs about 48 bytes (id, parent index, first report, next
+    sibling, budget and subtree total) instead of a full EmployeeTreeNode.
+    Lookups use binary search on the id array and every traversal is
+    iterative, so deep management chains never hit the recursion limit.
+    Employee ids must be integers.
+
+    Employees that can't be reached from the CEO are kept in the arrays with
+    a parent of UNPLACED and are listed in build_result.
+    """
+    NO_PARENT=-1
+    UNPLACED=-2
+
+    # Snapshot layout: a fixed header followed by the six arrays back to back
+    SNAPSHOT_MAGIC=b'ALGOBOOK'
+    SNAPSHOT_VERSION=1
+    SNAPSHOT_HEADER=struct.Struct('<8sI1s1s2xqqq')
 
-        # Find "CEO", establish head node, and initialize node map
+    def __init__(self, employees):
+        self.build_result=OrgBuildResult()
+        self.root=self.NO_PARENT
+
+        # Read the input once into flat arrays. Budgets start as integers
+        #       and switch to floats the first time a float shows up.
+        raw_ids=array('q')
+        raw_managers=array('q')
+        has_manager=bytearray()
+        raw_budgets=array('q')
         for employee in employees:
-            if employee.manager_id==None:
-                ceo=EmployeeTreeNode(employee)
-                employees.pop(employees.index(employee))
-                node_map={ceo.id:ceo}
-
-        # Iterate over the rest of the employees
-        # Allow for many loops in case the list order is out of whack
-        # Early exit of loop is built in
-        for i in range(len(employees)*10):
-
-            new_node=EmployeeTreeNode(employees[0])
-
-            # If employee can be added, enter into node map and pop from list
-            if add_to_org(ceo,new_node):
-                node_map[new_node.id]=new_node
-                employees.pop(0)
-
-            # If not, save for later since the list may have been out of order
+            raw_ids.append(employee.employee_id)
+            has_manager.append(employee.manager_id is not None)
+            raw_managers.append(employee.manager_id
+                                if employee.manager_id is not None else 0)
+            if raw_budgets.typecode=='q' and \
+                    not isinstance(employee.budget, int):
+                raw_budgets=array('d', raw_budgets)
+            raw_budgets.append(employee.budget)
+
+        # Sort by id (stable, so the first of any duplicate ids wins)
+        order=sorted(range(len(raw_ids)), key=raw_ids.__getitem__)
+        ids=array('q')
+        budgets=array(raw_budgets.typecode)
+        managers=array('q')
+        manager_flags=bytearray()
+        # (input position, index) of everyone without a manager
+        roots=[]
+        for i in order:
+            if ids and ids[-1]==raw_ids[i]:
+                self.build_result.duplicates.append(raw_ids[i])
+                continue
+            if not has_manager[i]:
+                roots.append((i, len(ids)))
+            ids.append(raw_ids[i])
+            budgets.append(raw_budgets[i])
+            managers.append(raw_managers[i])
+            manager_flags.append(has_manager[i])
+        del order, raw_ids, raw_managers, raw_budgets, has_manager
+        count=len(ids)
+
+        # The first employee without a manager in the input is the CEO
+        roots.sort()
+        if roots:
+            self.root=roots[0][1]
+
+        # Resolve every manager id to an array index
+        parent=array('q', [self.NO_PARENT])*count
+        for i in range(count):
+            if not manager_flags[i]:
+                continue
+            j=bisect_left(ids, managers[i])
+            if j<count and ids[j]==managers[i]:
+                parent[i]=j
             else:
-                employees.append(employees.pop(0))
-
-            # Break the loop if we've added all employees
-            if len(employees)==0:
-                break
-
-        # If the there are employees that couldn't be added to the tree, warn
-        #       the user
-        if len(employees)!=0:
-            print("WARNING: Construction timed out. Employee list may contain \
-                   errors.")
-
-        self.org_head=ceo
-        self.node_map=node_map
-
+                self.build_result.orphans.append(ids[i])
+                parent[i]=self.UNPLACED
+        for position, i in roots[1:]:
+            self.build_result.extra_roots.append(ids[i])
+            parent[i]=self.UNPLACED
+        del managers, manager_flags, roots
+
+        # Thread the reports of each manager into a first-child /
+        #       next-sibling list
+        first_child=array('q', [self.NO_PARENT])*count
+        next_sibling=array('q', [self.NO_PARENT])*count
+        for i in range(count):
+            p=parent[i]
+            if p>=0:
+                next_sibling[i]=first_child[p]
+                first_child[p]=i
+
+        # Breadth first walk from the CEO gives managers before reports
+        placed=bytearray(count)
+        walk=array('q')
+        if self.root!=self.NO_PARENT:
+            walk.append(self.root)
+            placed[self.root]=1
+        position=0
+        while position<len(walk):
+            child=first_child[walk[position]]
+            while child!=self.NO_PARENT:
+                placed[child]=1
+                walk.append(child)
+                child=next_sibling[child]
+            position+=1
+
+        # Subtree totals, accumulated in reverse breadth first order
+        totals=array(budgets.typecode, budgets)
+        for position in range(len(walk)-1, 0, -1):
+            i=walk[position]
+            totals[parent[i]]+=totals[i]
+        self.build_result.placed=len(walk)
+        del walk
+
+        # Anything the walk didn't reach is an orphan, loop or detached
+        if self.build_result.placed<count:
+            self.build_result._sort_unplaced(
+                (i for i in range(count) if not placed[i] and parent[i]>=0),
+                lambda i: parent[i] if parent[i]>=0 else None,
+                ids.__getitem__)
+            for i in range(count):
+                if not placed[i]:
+                    parent[i]=self.UNPLACED
+                    totals[i]=0
+
+        self.ids=ids
+        self.parent=parent
+        self.first_child=first_child
+        self.next_sibling=next_sibling
+        self.budgets=budgets
+        self.totals=totals
+        self._budget_lookup=None
+
+    @classmethod
+    def from_file(cls, path, chunk_size=1 << 20):
+        # Stream a CSV / JSONL HR feed directly into the arrays
+        return cls(read_employees(path, chunk_size))
+
+    @classmethod
+    def from_organization(cls, organization):
+        # Copy the placed part of a node based organization into arrays
+        return cls(Employee(node.id, node.manager_id, node.budget)
+                   for node in organization.node_map.values())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _index(self, employee_id):
+        # Array index of a placed employee, or -1 if there isn't one.
+        #       Any integer type works, NumPy scalars included.
+        try:
+            employee_id=operator.index(employee_id)
+        except TypeError:
+            return -1
+        i=bisect_left(self.ids, employee_id)
+        if i==len(self.ids) or self.ids[i]!=employee_id or \
+                self.parent[i]==self.UNPLACED:
+            return -1
+        return i
 
     def get_org_budget(self, employee_id):
 
-        # Recursive helper fucntion for traversing tree to sum budgets
-        def sum_budgets(node):
-            sum=node.budget
-            for report in node.reports:
-                sum+=sum_budgets(report)
-            return sum
-
-        # First check if the employee ID exists in the org
-        if employee_id not in self.node_map:
+        i=self._index(employee_id)
+        if i<0:
             return 0
 
-        employee=self.node_map[employee_id]
-        # If employee is a manager, run helper on self
-        if employee.is_manager:
-            return sum_budgets(employee)
-        # If employee is not a manager, run helper on self's manager
-        else:
-            return sum_budgets(employee.manager_node)
+        # ICs use their manager's organization
+        if self.first_child[i]==self.NO_PARENT and self.parent[i]>=0:
+            i=self.parent[i]
+        return self.totals[i]
+
+    def get_org_budgets(self, employee_ids):
+
+        if np is not None and isinstance(employee_ids, np.ndarray) and \
+                employee_ids.dtype.kind in 'iu':
+            if self._budget_lookup is None:
+                # Resolve every employee to the total of their organization
+                #       in a few whole-array steps; ids are already sorted
+                ids=np.frombuffer(self.ids, dtype=np.int64)
+                parent=np.frombuffer(self.parent, dtype=np.int64)
+                first_child=np.frombuffer(self.first_child, dtype=np.int64)
+                totals=np.frombuffer(self.totals,
+                                     dtype=memoryview(self.totals).format)
+                target=np.arange(len(ids), dtype=np.int64)
+                uses_manager=(first_child==self.NO_PARENT)&(parent>=0)
+                target[uses_manager]=parent[uses_manager]
+                resolved=totals[target]
+                resolved[parent==self.UNPLACED]=0
+                self._budget_lookup=('sorted', ids, resolved) if len(ids) \
+                    else ('empty', None, resolved)
+            return _gather_budgets(self._budget_lookup, employee_ids)
+
+        return [self.get_org_budget(employee_id) for employee_id in employee_ids]
+
+    def save_snapshot(self, path):
+        # Write the arrays as raw machine words so load_snapshot can map
+        #       them straight back in without parsing anything. The file
+        #       is written next to path, synced and renamed over it, so a
+        #       crash leaves either the old snapshot or the new one.
+        budget_format=memoryview(self.budgets).format
+        byteorder=b'L' if sys.byteorder=='little' else b'B'
+        temporary=path+'.tmp'
+        try:
+            with open(temporary, 'wb') as snapshot:
+                snapshot.write(self.SNAPSHOT_HEADER.pack(
+                    self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION,
+                    budget_format.encode(), byteorder, len(self.ids),
+                    self.root, self.build_result.placed))
+                for column in (self.ids, self.parent, self.first_child,
+                               self.next_sibling, self.budgets, self.totals):
+                    snapshot.write(column)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            # Don't leave a partial snapshot behind
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    @classmethod
+    def load_snapshot(cls, path):
+        # Map the file read-only and point every array at its slice of the
+        #       mapping. Pages are loaded on demand and shared between every
+        #       process that maps the same file.
+        with open(path, 'rb') as snapshot:
+            mapping=mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header_size=cls.SNAPSHOT_HEADER.size
+        magic, version, budget_format, byteorder, count, root, placed= \
+            cls.SNAPSHOT_HEADER.unpack_from(mapping, 0)
+        if magic!=cls.SNAPSHOT_MAGIC or version!=cls.SNAPSHOT_VERSION:
+            mapping.close()
+            raise ValueError(f"{path} is not an AlgoBook snapshot")
+        if byteorder!=(b'L' if sys.byteorder=='little' else b'B'):
+            mapping.close()
+            raise ValueError(f"{path} was written on a machine with a \
+different byte order")
+        if len(mapping)!=header_size+6*8*count:
+            mapping.close()
+            raise ValueError(f"{path} is truncated")
+
+        organization=cls.__new__(cls)
+        organization.build_result=OrgBuildResult()
+        organization.build_result.placed=placed
+        organization.root=root
+        organization._budget_lookup=None
+        organization._mapping=mapping
+        view=memoryview(mapping)
+        columns=[]
+        formats=('q', 'q', 'q', 'q', budget_format.decode(),
+                 budget_format.decode())
+        for i, column_format in enumerate(formats):
+            start=header_size+i*8*count
+            columns.append(view[start:start+8*count].cast(column_format))
+        organization.ids, organization.parent, organization.first_child, \
+            organization.next_sibling, organization.budgets, \
+            organization.totals=columns
+        return organization
+
+    def close(self):
+        # Release a mapped snapshot; in-memory stores have nothing to close
+        mapping=getattr(self, '_mapping', None)
+        if mapping is None:
+            return
+        self._budget_lookup=None
+        for column in (self.ids, self.parent, self.first_child,
+                       self.next_sibling, self.budgets, self.totals):
+            column.release()
+        self._mapping=None
+        mapping.close()
+
+    def get_reports(self, employee_id):
+        i=self._index(employee_id)
+        reports=[]
+        if i<0:
+            return reports
+        child=self.first_child[i]
+        while child!=self.NO_PARENT:
+            reports.append(self.ids[child])
+            child=self.next_sibling[child]
+        return reports
 
 
 """
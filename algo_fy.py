@@ -1,4 +1,31 @@
 import heapq
+from array import array
+from bisect import bisect_left, bisect_right, insort
+import asyncio
+from collections import Counter, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import operator
+import os
+import pickle
+import random
+import struct
+import sys
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger=logging.getLogger(__name__)
 
 '''
  You are working for a promising new music streaming service “Algo-fy”.
@@ -32,114 +59,1814 @@ import heapq
 
 Code Author: Miles Cameron
 
-Running Time Analysis of get_top_k
+Running Time Analysis of stream_songs
 --------------------
 This method runs in O(N) time, where N is the number of streams in the list.
-Each of the N streams needs to update its corresponding dictionary/map entry,
-which is an O(1) operation.
+Each of the N streams updates its dictionary/map entry and is added to the
+set of changed songs, both O(1) operations.
 
-Running Time Analysis of stream_songs
---------------------
-This method runs in O(N) time.
+Typed batches (NumPy int arrays, array('q'), memoryviews and raw buffers)
+are counted in one vectorized step first (bincount or unique with NumPy,
+which reads arrays and buffers through a zero-copy view; Counter without
+it), so the Python-level work is O(D) for D distinct songs in the batch
+instead of O(N). Raw bytes, and memoryviews over them, hold int64 ids.
+
+With a window, each batch is also added to the time bucket for its
+timestamp, so late plays expire on time. Expiring a bucket subtracts its
+per-song counts from the chart, so it costs O(D) for the D distinct songs it
+held, never a full recount. A calendar-day rollover just starts a new chart.
 
-This method has a couple parts. First I heapify the list using the bottom-up
-method starting with the first internal node. As discussed in the course
-materials, the run time for bottom-up construction is O(N).
+ApproxAlgoFy keeps memory fixed at O(1/epsilon + log(1/delta)/epsilon) no
+matter how many songs exist. Each distinct song in a batch costs O(log(1/delta))
+for the Count-Min sketch plus O(1) amortized for Space-Saving.
 
-Then, I remove_min k times. Remove_min takes h operations, and since this is
-a complete binary tree, h=log(N). So, this process is k*log(N) or just log(N)
+Partial states from several AlgoFy shards merge exactly with merge_top_k or
+the ShardedAlgoFy process pool. The Threshold Algorithm (TPUT) needs three
+rounds: local top k lists, songs at or above a threshold, and exact counts
+for the remaining candidates, so full count maps are never shipped.
+
+get_rank, get_songs_by_rank and count_at_least use an order statistics index
+(a Fenwick tree over blocks of the distinct play counts plus blocked sorted
+songs per count, so its size doesn't depend on how large counts get) built
+on the first rank query and kept in step with the buckets from then on.
+Keeping it in step costs O(log) per changed song, each query is
+logarithmic, and a range query adds O(1) per song returned.
+
+Plays tagged with dimensions (region, genre, ...) are counted for the global
+chart and every dimension chart in the same pass over the batch, and each
+dimension keeps its own incremental buckets for get_top_k(dimension=...).
+
+checkpoint() detaches each chart's state in O(1) and counts new plays on top
+of it; a background thread lays the frozen counts out as flat arrays (songs
+by rank, the distinct counts and run lengths, and an id-sorted index) and
+writes them to a temp file that is renamed into place. recover() maps the
+file with mmap, replays the log records written after the checkpoint and
+serves reads from the mapping while the dicts are built in the background,
+so it costs O(k) plus the replayed log rather than O(songs).
+
+AlgoFyServer puts an asyncio front end on a ranker: a bounded queue gives
+producers backpressure, queued batches are coalesced into one stream_songs
+call on a dedicated thread, and readers get the last published chart in O(k)
+without waiting on ingestion.
+
+Running Time Analysis of get_top_k
+--------------------
+This method runs in O(C + k) time, where C is the number of distinct songs
+whose count changed since the last call.
 
-Since these two processes are not nested, they are just added together as
-O(N+log(N)) which goes to O(N) as N gets large.
+Songs are filed in buckets keyed by play count, with a sorted list of the
+distinct counts. Catching up moves each changed song to its new bucket,
+O(1) plus a bisect on the (short) list of distinct counts. The top k is then
+read from the highest buckets down. Ties inside a bucket are ordered by
+song id. The bucket the k-th place falls in keeps a sorted prefix of its
+smallest songs, updated in O(k) as songs enter or leave it, so a refresh
+after a play doesn't rescan a large tie. The answer is cached until the next
+batch, so repeated refreshes with no new plays are O(k).
 '''
 
 
+class _SongChart:
+    """
+    Play counts for one chart plus a count-bucket ranking of its songs.
+
+    Ingest only bumps counts and remembers which songs changed. The buckets
+    catch up on the next read, so a play costs one dict update and a read
+    costs O(songs changed since the last read + k).
+
+    While a checkpoint is written or a recovery is still building its
+    dicts, the chart runs on top of a read-only base (a detached _SongChart
+    or a _MappedChart): counts then only holds the plays since, and top()
+    merges them with the base until attach() folds them back in.
+    """
+    # Everything detach() hands over to the base and attach() takes back
+    _STATE=('counts', 'changed', 'ranked', 'buckets', 'levels', '_top',
+            'prefixes', '_prefix_limit', 'rank_index')
+
+    def __init__(self):
+        # song -> total plays
+        self.counts={}
+        # Songs whose count moved since the buckets were last synced
+        self.changed=set()
+        # song -> count the song is currently filed under in buckets
+        self.ranked={}
+        # count -> {song: None}, used as an insertion ordered set
+        self.buckets={}
+        # Distinct counts that have a bucket, ascending
+        self.levels=[]
+        # Last top list handed out, reused until something changes
+        self._top=[]
+        # count -> sorted list of the smallest songs in that bucket, kept
+        #       for buckets that top() had to cut short so a big tie isn't
+        #       rescanned on every refresh
+        self.prefixes={}
+        # Longest prefix top() has asked for
+        self._prefix_limit=0
+        # Order statistics index, built on the first rank query
+        self.rank_index=None
+        # Read-only base state this chart counts on top of, if any, and the
+        #       best songs played since (song -> total) for top()
+        self.base=None
+        self._overlay_top={}
+        self._overlay_k=0
+
+    def count(self, song):
+        return self.counts.get(song, 0)
+
+    def count_many(self, songs):
+        counts=self.counts
+        return [counts.get(song, 0) for song in songs]
+
+    def detach(self):
+        # Hand the current state to a new read-only chart and start over
+        #       on top of it, O(1)
+        frozen=_SongChart()
+        for name in self._STATE:
+            empty=getattr(frozen, name)
+            setattr(frozen, name, getattr(self, name))
+            setattr(self, name, empty)
+        self.base=frozen
+        return frozen
+
+    def attach(self, settled):
+        # Fold the plays counted since detach() into settled, a complete
+        #       chart for the base, and carry on from its state
+        counts=settled.counts
+        for song, plays in self.counts.items():
+            count=counts.get(song, 0)+plays
+            if count>0:
+                counts[song]=count
+            else:
+                counts.pop(song, None)
+        # Every song counted since detach() has to be refiled
+        settled.changed.update(self.counts)
+        for name in self._STATE:
+            setattr(self, name, getattr(settled, name))
+        self.base=None
+        self._overlay_top={}
+        self._overlay_k=0
+
+    def add(self, song, plays):
+        # Apply a (possibly negative) number of plays to one song
+        count=self.counts.get(song, 0)+plays
+        if count>0:
+            self.counts[song]=count
+        else:
+            self.counts.pop(song, None)
+        self.changed.add(song)
+
+    def add_many(self, songs, plays):
+        # Merge pre-aggregated (song, plays) pairs; plays are all positive
+        counts=self.counts
+        for song, count in zip(songs, plays):
+            counts[song]=counts.get(song, 0)+count
+        self.changed.update(songs)
+
+    def sync(self):
+        # Move every changed song from its old bucket to its new one. Over
+        #       a base the counts are only deltas, so the buckets wait for
+        #       attach()
+        if not self.changed or self.base is not None:
+            return
+        counts=self.counts
+        ranked=self.ranked
+        buckets=self.buckets
+        levels=self.levels
+        rank_index=self.rank_index
+        prefixes=self.prefixes
+        for song in self.changed:
+            old=ranked.get(song, 0)
+            new=counts.get(song, 0)
+            if old==new:
+                continue
+            if rank_index is not None:
+                rank_index.move(song, old, new)
+            if old:
+                bucket=buckets[old]
+                del bucket[song]
+                if not bucket:
+                    del buckets[old]
+                    del levels[bisect_left(levels, old)]
+                    prefixes.pop(old, None)
+                elif old in prefixes:
+                    self._prefix_remove(old, song)
+            if new:
+                bucket=buckets.get(new)
+                if bucket is None:
+                    bucket=buckets[new]={}
+                    insort(levels, new)
+                elif new in prefixes:
+                    self._prefix_add(new, song, len(bucket))
+                bucket[song]=None
+                ranked[song]=new
+            else:
+                del ranked[song]
+        self.changed.clear()
+        self._top=[]
+
+    def _prefix_remove(self, level, song):
+        # The rest of a prefix are still the smallest songs in the bucket,
+        #       unless it runs dry
+        prefix=self.prefixes[level]
+        if song<=prefix[-1]:
+            del prefix[bisect_left(prefix, song)]
+            if not prefix:
+                del self.prefixes[level]
+
+    def _prefix_add(self, level, song, bucket_size):
+        # A newcomer below the largest prefix song (or any newcomer, if the
+        #       prefix already holds the whole bucket) joins the prefix
+        prefix=self.prefixes[level]
+        if song<prefix[-1] or len(prefix)==bucket_size:
+            insort(prefix, song)
+            if len(prefix)>4*self._prefix_limit:
+                del prefix[2*self._prefix_limit:]
+
+    def ranks(self):
+        # Synced order statistics index, built on first use
+        self.sync()
+        if self.rank_index is None:
+            self.rank_index=_RankIndex(self)
+        return self.rank_index
+
+    def top(self, k):
+        # The k most played songs, most plays first and ties by song id
+        if self.base is not None:
+            return self._top_over_base(k)
+        self.sync()
+        if len(self._top)>=k or len(self._top)==len(self.ranked):
+            return self._top[:k]
+
+        top_list=[]
+        for level in reversed(self.levels):
+            need=k-len(top_list)
+            if need<=0:
+                break
+            bucket=self.buckets[level]
+            if len(bucket)<=need:
+                top_list.extend(sorted(bucket))
+                continue
+            # The cut falls inside this bucket: reuse its cached prefix,
+            #       which sync keeps current, and only scan the bucket when
+            #       the prefix is too short
+            self._prefix_limit=max(self._prefix_limit, k)
+            prefix=self.prefixes.get(level)
+            if prefix is None or len(prefix)<need:
+                prefix=self.prefixes[level]=heapq.nsmallest(
+                    2*self._prefix_limit, bucket)
+            top_list.extend(prefix[:need])
+        self._top=top_list
+        return top_list[:k]
+
+    def _top_over_base(self, k):
+        # Over a base, counts only hold the plays since detach(), and those
+        #       only ever grow. The best k songs among them are kept in
+        #       _overlay_top and refreshed from the songs changed since the
+        #       last read; a song that fell short stays out until it is
+        #       played again, as the bar only rises. The rest of the chart
+        #       comes from the base's own top list, skipping songs that
+        #       have new plays. O(k log k + changed songs) per read.
+        overlay=self.counts
+        base=self.base
+        if k!=self._overlay_k:
+            # Until the first read every overlay song is still in changed
+            if self._overlay_k:
+                self.changed.update(overlay)
+            self._overlay_k=k
+            self._overlay_top={}
+        if self.changed:
+            changed=self.changed
+            songs=list(changed)
+            totals=list(map(operator.add, base.count_many(songs),
+                            map(overlay.__getitem__, songs)))
+            for song, plays in self._overlay_top.items():
+                if song not in changed:
+                    songs.append(song)
+                    totals.append(plays)
+            changed.clear()
+            self._overlay_top=dict(_best_songs(songs, totals, k))
+        best=self._overlay_top
+
+        # Base songs that were played since can't count at their old rank
+        wanted=k
+        while True:
+            base_top=base.top(wanted)
+            entries=[(-base.count(song), song) for song in base_top
+                     if song not in overlay]
+            if len(entries)>=k or len(base_top)<wanted:
+                break
+            wanted*=2
+        entries.extend((-plays, song) for song, plays in best.items())
+        return [song for plays, song in heapq.nsmallest(k, entries)]
+
+
+class _MappedChart:
+    """
+    Read-only chart over one checkpoint section mapped with mmap, used by
+    recover() while the dicts are built on a background thread.
+
+    songs lists every song by rank: runs of equal plays (levels, most
+    first), each run sorted by id. ids and plays hold the same songs sorted
+    by id, so a song's count is one binary search over the mapping.
+    """
+    # Songs per dict.fromkeys call when materializing, small enough that
+    #       other threads get the GIL back every few milliseconds
+    CHUNK=1 << 16
+
+    def __init__(self, songs, levels, runs, ids, plays):
+        self.songs=songs
+        self.levels=levels
+        self.runs=runs
+        self.ids=ids
+        self.plays=plays
+
+    def count(self, song):
+        i=bisect_left(self.ids, song)
+        if i<len(self.ids) and self.ids[i]==song:
+            return self.plays[i]
+        return 0
+
+    def count_many(self, songs):
+        # count() for a list of songs, one vectorized search with NumPy
+        if np is None or not len(self.ids):
+            return list(map(self.count, songs))
+        try:
+            wanted=np.array(songs, dtype=np.int64)
+        except OverflowError:
+            return list(map(self.count, songs))
+        ids=np.frombuffer(self.ids, dtype=np.int64)
+        found=np.minimum(np.searchsorted(ids, wanted), len(ids)-1)
+        plays=np.frombuffer(self.plays, dtype=np.int64)[found]
+        return np.where(ids[found]==wanted, plays, 0).tolist()
+
+    def top(self, count):
+        # Runs are stored sorted by id, so the top is a prefix of songs
+        return self.songs[:count].tolist()
+
+    def materialize(self):
+        # A complete _SongChart with the same counts, built a chunk at a
+        #       time with C-level dict.fromkeys calls
+        chart=_SongChart()
+        counts=chart.counts
+        ranked=chart.ranked
+        start=0
+        for level, run in zip(self.levels, self.runs):
+            bucket={}
+            for first in range(start, start+run, self.CHUNK):
+                part=self.songs[first:min(first+self.CHUNK, start+run)]
+                bucket.update(dict.fromkeys(part))
+                plays=dict.fromkeys(part, level)
+                counts.update(plays)
+                ranked.update(plays)
+                # Hand the GIL straight back to readers and writers
+                time.sleep(0)
+            chart.buckets[level]=bucket
+            start+=run
+        chart.levels=sorted(chart.buckets)
+        return chart
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def release(self):
+        for view in (self.songs, self.levels, self.runs, self.ids,
+                     self.plays):
+            view.release()
+
+
+class _CombinedCounts(Mapping):
+    """
+    Read-only song -> plays view of a chart that counts on top of a base:
+    the base's counts plus the plays since. AlgoFy.stream_map hands this
+    out while a checkpoint or recovery runs, and it stays correct after the
+    chart is attached again.
+    """
+    def __init__(self, chart):
+        self.chart=chart
+
+    def _base_songs(self):
+        base=self.chart.base
+        if base is None:
+            return ()
+        return base.counts if isinstance(base, _SongChart) else base
+
+    def __getitem__(self, song):
+        chart=self.chart
+        base=chart.base
+        count=chart.counts.get(song, 0)
+        if base is not None:
+            count+=base.count(song)
+        if count<=0:
+            raise KeyError(song)
+        return count
+
+    def __iter__(self):
+        base=self.chart.base
+        yield from self._base_songs()
+        for song in list(self.chart.counts):
+            if base is None or not base.count(song):
+                yield song
+
+    def __len__(self):
+        base=self.chart.base
+        overlay=list(self.chart.counts)
+        if base is None:
+            return len(overlay)
+        return len(self._base_songs())+base.count_many(overlay).count(0)
+
+
+def _best_songs(songs, totals, k):
+    # The k (song, total) pairs with the most plays, ties by song id. The
+    #       first read after a recovery sees every replayed song here, so
+    #       long lists are cut with NumPy.
+    if np is not None and 0<k<len(songs)//4:
+        try:
+            ids=np.array(songs, dtype=np.int64)
+        except OverflowError:
+            ids=None
+        if ids is not None:
+            plays=np.array(totals, dtype=np.int64)
+            cut=np.partition(plays, len(plays)-k)[len(plays)-k]
+            kept=np.flatnonzero(plays>=cut)
+            kept=kept[np.lexsort((ids[kept], -plays[kept]))[:k]]
+            return list(zip(ids[kept].tolist(), plays[kept].tolist()))
+    best=heapq.nsmallest(k, zip(map(operator.neg, totals), songs))
+    return [(song, -plays) for plays, song in best]
+
+
+def _fsync_directory(path):
+    # Make a rename into path's directory durable, where the OS allows it
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    directory=os.open(os.path.dirname(os.path.abspath(path)),
+                      os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def _freeze_counts(counts):
+    """
+    Lay out a song -> plays dict for a checkpoint: (songs, levels, runs,
+    ids, plays) where songs is every song by rank, as runs of equal plays
+    (levels, most first) each sorted by id, and ids / plays are the same
+    songs sorted by id. Runs on a background thread, so the dict is read
+    and sorted a chunk at a time; NumPy sorts without holding the GIL.
+    """
+    chunk=_MappedChart.CHUNK
+    keys=iter(counts)
+    if np is not None:
+        songs=np.concatenate([np.zeros(0, dtype=np.int64)]+[
+            np.fromiter(islice(keys, chunk), dtype=np.int64)
+            for i in range(0, len(counts), chunk)])
+        plays=np.concatenate([np.zeros(0, dtype=np.int64)]+[
+            np.fromiter(map(counts.__getitem__, songs[i:i+chunk].tolist()),
+                        dtype=np.int64)
+            for i in range(0, len(songs), chunk)])
+        order=np.argsort(songs)
+        ids=songs[order]
+        plays=plays[order]
+        order=np.argsort(-plays, kind='stable')
+        ranked=plays[order]
+        starts=np.flatnonzero(np.diff(ranked, prepend=-1))
+        runs=np.diff(starts, append=len(ranked))
+        return ids[order], ranked[starts], runs, ids, plays
+
+    # Without NumPy: sort short runs and merge them pairwise, so no single
+    #       call holds the GIL for long, then split by plays
+    pieces=[sorted(islice(keys, chunk)) for i in range(0, len(counts), chunk)]
+    while len(pieces)>1:
+        merged=[]
+        for i in range(0, len(pieces), 2):
+            piece=pieces[i]
+            if i+1<len(pieces):
+                piece.extend(pieces[i+1])
+                piece.sort()
+            merged.append(piece)
+        pieces=merged
+    ids=array('q', pieces[0] if pieces else ())
+    del pieces
+    plays=array('q')
+    by_level={}
+    for i in range(0, len(ids), chunk):
+        part=ids[i:i+chunk]
+        plays.extend(map(counts.__getitem__, part))
+        for song, level in zip(part, plays[i:i+chunk]):
+            songs=by_level.get(level)
+            if songs is None:
+                songs=by_level[level]=array('q')
+            songs.append(song)
+    songs=array('q')
+    levels=array('q', sorted(by_level, reverse=True))
+    runs=array('q')
+    for level in levels:
+        songs.extend(by_level.pop(level))
+        runs.append(len(songs)-sum(runs))
+    return songs, levels, runs, ids, plays
+
+
+def _aggregate_plays(songIds):
+    # Collapse a typed batch of song ids into parallel (songs, plays) lists.
+    #       Returns None for plain Python iterables, which keep the per-id
+    #       loop (and its skipping of non-int ids).
+    if np is not None and isinstance(songIds, np.ndarray):
+        if songIds.dtype.kind not in 'iu':
+            return None
+        ids=songIds.ravel()
+    else:
+        view=_int_view(songIds)
+        if view is None:
+            return None
+        if np is None:
+            played=Counter(view)
+            return list(played.keys()), list(played.values())
+        # Arrays and buffers share the NumPy path through a zero-copy view
+        ids=np.asarray(view)
+
+    if ids.size==0:
+        return [], []
+    low=int(ids.min())
+    span=int(ids.max())-low+1
+    # Dense id ranges count with bincount, sparse ones with unique
+    if span<=4*ids.size:
+        plays=np.bincount(ids-low, minlength=span)
+        songs=np.flatnonzero(plays)
+        return (songs+low).tolist(), plays[songs].tolist()
+    songs, plays=np.unique(ids, return_counts=True)
+    return songs.tolist(), plays.tolist()
+
+
+def _int_view(songIds):
+    # Zero-copy 1-D integer memoryview over an array or buffer, or None for
+    #       anything else. Untyped bytes / bytearray / mmap buffers, and
+    #       memoryviews over them, are read as native int64 ids; arrays and
+    #       views over arrays keep their own format.
+    if not isinstance(songIds, (array, memoryview, bytes, bytearray)):
+        return None
+    view=memoryview(songIds)
+    if isinstance(songIds, (bytes, bytearray)) or view.format=='B' and \
+            isinstance(view.obj, (bytes, bytearray, mmap.mmap)):
+        view=view.cast('B')
+        if len(view) % 8:
+            raise ValueError("Raw song id buffers must hold whole int64 ids")
+        return view.cast('q')
+    if view.format not in ('b', 'B', 'h', 'H', 'i', 'I', 'l', 'L', 'q',
+                           'Q', 'n', 'N'):
+        raise TypeError(f"Can't read song ids from a '{view.format}' buffer")
+    if view.ndim!=1:
+        view=view.cast('B').cast(view.format)
+    return view
+
+
+class _SortedSongs:
+    """
+    Sorted song ids of one count bucket, stored as a list of short sorted
+    blocks with a Fenwick tree over the block sizes. Adding or removing a
+    song touches one block (at most 2 * BLOCK ids) plus O(log B) tree
+    nodes, and finding a song's position or the song at a position is
+    O(log B), for B the size of the bucket.
+    """
+    BLOCK=256
+
+    def __init__(self, songs=()):
+        # songs must already be sorted
+        songs=list(songs)
+        self.blocks=[songs[i:i+self.BLOCK]
+                     for i in range(0, len(songs), self.BLOCK)]
+        self.maxes=[block[-1] for block in self.blocks]
+        self.size=len(songs)
+        # Fenwick tree over len(block), rebuilt lazily after a split or
+        #       after a block empties
+        self._tree=None
+
+    def __len__(self):
+        return self.size
+
+    def add(self, song):
+        blocks=self.blocks
+        self.size+=1
+        if not blocks:
+            blocks.append([song])
+            self.maxes.append(song)
+            self._tree=None
+            return
+        i=bisect_left(self.maxes, song)
+        if i==len(blocks):
+            i-=1
+        block=blocks[i]
+        insort(block, song)
+        self.maxes[i]=block[-1]
+        if len(block)>2*self.BLOCK:
+            blocks[i:i+1]=[block[:self.BLOCK], block[self.BLOCK:]]
+            self.maxes[i:i+1]=[blocks[i][-1], blocks[i+1][-1]]
+            self._tree=None
+        elif self._tree is not None:
+            self._add(i, 1)
+
+    def remove(self, song):
+        i=bisect_left(self.maxes, song)
+        block=self.blocks[i]
+        del block[bisect_left(block, song)]
+        self.size-=1
+        if block:
+            self.maxes[i]=block[-1]
+            if self._tree is not None:
+                self._add(i, -1)
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+            self._tree=None
+
+    def _fenwick(self):
+        if self._tree is None:
+            tree=[0]+[len(block) for block in self.blocks]
+            for i in range(1, len(tree)):
+                parent=i+(i & -i)
+                if parent<len(tree):
+                    tree[parent]+=tree[i]
+            self._tree=tree
+        return self._tree
+
+    def _add(self, block, amount):
+        tree=self._tree
+        block+=1
+        while block<len(tree):
+            tree[block]+=amount
+            block+=block & -block
+
+    def index(self, song):
+        # Position of a song in the bucket, counting from 0
+        i=bisect_left(self.maxes, song)
+        tree=self._fenwick()
+        before=0
+        block=i
+        while block>0:
+            before+=tree[block]
+            block-=block & -block
+        return before+bisect_left(self.blocks[i], song)
+
+    def slice(self, start, stop):
+        # Songs at positions start..stop-1
+        stop=min(stop, self.size)
+        if start>=stop:
+            return []
+        # Fenwick descent to the block holding position start
+        tree=self._fenwick()
+        block=0
+        step=1 << (len(tree)-1).bit_length()
+        offset=start
+        while step:
+            if block+step<len(tree) and tree[block+step]<=offset:
+                block+=step
+                offset-=tree[block]
+            step>>=1
+        songs=[]
+        while len(songs)<stop-start:
+            songs.extend(self.blocks[block][offset:offset+stop-start-len(songs)])
+            block+=1
+            offset=0
+        return songs
+
+
+class _LevelCounts:
+    """
+    How many songs have each play count, for prefix sums over counts. The
+    counts in use are kept sorted in short blocks with their song numbers
+    alongside, plus a Fenwick tree over the block totals, so memory is
+    O(L) for L distinct counts however large the counts get. Changing the
+    songs at one count, a prefix sum and finding the count at a position
+    each touch one block (at most 2 * BLOCK counts) plus O(log L) tree
+    nodes.
+    """
+    BLOCK=64
+
+    def __init__(self, levels, sizes):
+        # levels must be sorted, sizes the number of songs at each
+        block=self.BLOCK
+        self.blocks=[levels[i:i+block] for i in range(0, len(levels), block)]
+        self.sizes=[sizes[i:i+block] for i in range(0, len(sizes), block)]
+        self.maxes=[levels[-1] for levels in self.blocks]
+        self.size=sum(sizes)
+        # Fenwick tree over sum(sizes[block]), rebuilt lazily after a block
+        #       is split or emptied
+        self._tree=None
+
+    def add(self, level, amount):
+        # amount more (or, if negative, fewer) songs with level plays
+        self.size+=amount
+        blocks=self.blocks
+        if not blocks:
+            blocks.append([level])
+            self.sizes.append([amount])
+            self.maxes.append(level)
+            self._tree=None
+            return
+        i=bisect_left(self.maxes, level)
+        if i==len(blocks):
+            i-=1
+        block=blocks[i]
+        sizes=self.sizes[i]
+        j=bisect_left(block, level)
+        if j<len(block) and block[j]==level:
+            sizes[j]+=amount
+            if not sizes[j]:
+                del block[j]
+                del sizes[j]
+                if not block:
+                    del blocks[i]
+                    del self.sizes[i]
+                    del self.maxes[i]
+                    self._tree=None
+                    return
+                self.maxes[i]=block[-1]
+        else:
+            block.insert(j, level)
+            sizes.insert(j, amount)
+            self.maxes[i]=block[-1]
+            if len(block)>2*self.BLOCK:
+                half=self.BLOCK
+                blocks[i:i+1]=[block[:half], block[half:]]
+                self.sizes[i:i+1]=[sizes[:half], sizes[half:]]
+                self.maxes[i:i+1]=[blocks[i][-1], blocks[i+1][-1]]
+                self._tree=None
+                return
+        tree=self._tree
+        if tree is not None:
+            i+=1
+            while i<len(tree):
+                tree[i]+=amount
+                i+=i & -i
+
+    def _fenwick(self):
+        if self._tree is None:
+            tree=[0]+[sum(sizes) for sizes in self.sizes]
+            for i in range(1, len(tree)):
+                parent=i+(i & -i)
+                if parent<len(tree):
+                    tree[parent]+=tree[i]
+            self._tree=tree
+        return self._tree
+
+    def prefix(self, level):
+        # Songs with at most level plays
+        i=bisect_left(self.maxes, level)
+        if i==len(self.blocks):
+            return self.size
+        tree=self._fenwick()
+        total=0
+        block=i
+        while block>0:
+            total+=tree[block]
+            block-=block & -block
+        return total+sum(self.sizes[i][:bisect_right(self.blocks[i], level)])
+
+    def lowest_level(self, position):
+        # Smallest count whose prefix reaches position (1-based)
+        tree=self._fenwick()
+        block=0
+        step=1 << (len(tree)-1).bit_length()
+        while step:
+            if block+step<len(tree) and tree[block+step]<position:
+                block+=step
+                position-=tree[block]
+            step>>=1
+        for level, size in zip(self.blocks[block], self.sizes[block]):
+            if position<=size:
+                return level
+            position-=size
+
+
+class _RankIndex:
+    """
+    Order statistics over a _SongChart, ranked by plays (most first) with
+    ties broken by song id.
+
+    A _LevelCounts holds how many songs have each play count, and each
+    count keeps its songs in a _SortedSongs. Moving a song between counts
+    and rank-of, select-by-rank and count-threshold queries are then
+    O(log L + log B) for L the number of distinct counts and B the size of
+    one count bucket.
+    """
+    def __init__(self, chart):
+        self.sorted_songs={level: _SortedSongs(sorted(bucket))
+                           for level, bucket in chart.buckets.items()}
+        levels=sorted(self.sorted_songs)
+        self.levels=_LevelCounts(levels, [len(self.sorted_songs[level])
+                                          for level in levels])
+
+    @property
+    def size(self):
+        return self.levels.size
+
+    def move(self, song, old, new):
+        if old:
+            songs=self.sorted_songs[old]
+            songs.remove(song)
+            if not songs:
+                del self.sorted_songs[old]
+            self.levels.add(old, -1)
+        if new:
+            songs=self.sorted_songs.get(new)
+            if songs is None:
+                songs=self.sorted_songs[new]=_SortedSongs()
+            songs.add(song)
+            self.levels.add(new, 1)
+
+    def count_at_least(self, plays):
+        if plays<=1:
+            return self.size
+        return self.size-self.levels.prefix(plays-1)
+
+    def rank(self, song, plays):
+        # 1-based rank of a song that has plays plays
+        higher=self.size-self.levels.prefix(plays)
+        return higher+self.sorted_songs[plays].index(song)+1
+
+    def select(self, rank):
+        # (plays, index into sorted_songs[plays]) of the song at rank
+        position=self.size-rank+1
+        level=self.levels.lowest_level(position)
+        offset=position-self.levels.prefix(level-1)
+        return level, len(self.sorted_songs[level])-offset
+
+
 class AlgoFy:
-    def __init__(self, k):
+    SECONDS_PER_DAY=86400
+
+    def __init__(self, k, window=None, bucket_seconds=60, rollover_offset=0,
+                 clock=time.time):
+        """
+        window=None counts plays forever. window='day' keeps a calendar day
+        that rolls over rollover_offset seconds after UTC midnight. An int
+        window keeps a rolling window of that many seconds, stored as a
+        ring of bucket_seconds wide buckets.
+        """
         self.k = k
-        # Create map/dict for recording sond frequencies
-        self.stream_map={}
+        # Chart holding the play counts and the incremental ranking
+        self._chart=_SongChart()
+        # Per dimension (region, genre, ...) charts fed by the same pass
+        self._dimension_charts={}
 
-    def stream_songs(self, songIds):
+        if window is not None and window!='day' and \
+                (not isinstance(window, int) or window<=0):
+            raise ValueError("window must be None, 'day' or a positive \
+number of seconds")
+        self.window=window
+        self.bucket_seconds=bucket_seconds
+        self.rollover_offset=rollover_offset
+        self._clock=clock
+        # Calendar day currently being counted in 'day' mode
+        self._day=None
+        # Rolling mode: (bucket index, Counter of (dimension, song) plays)
+        #       oldest first; the global chart uses dimension None
+        self._buckets=deque()
+        self._bucket_span=-(-window//bucket_seconds) \
+            if isinstance(window, int) else 0
+
+        # Append-only log of batches since the last checkpoint
+        self._log=None
+        self._log_path=None
+        self._log_sequence=0
+        # (thread, {dimension: settled chart}, cleanup, errors) for a
+        #       checkpoint or recovery still running in the background
+        self._background=None
+        # A failed background checkpoint, raised by the next settle()
+        self._checkpoint_error=None
+        # True while stream_songs can take the plain counting path
+        self._plain=window is None
+
+    def stream_songs(self, songIds, timestamp=None, dimensions=None):
+        """
+        dimensions, when given, runs parallel to songIds: each entry is a
+        dimension key (e.g. 'EU' or 'rock'), a tuple of keys, or None.
+        Every play counts toward the global chart and each of its keys.
+        """
+        if self._background is not None:
+            self._fold(wait=False)
+        if dimensions is not None or not self._plain:
+            if self._log is not None:
+                self._log_batch(songIds, dimensions)
+            if dimensions is not None or self.window is not None:
+                self._stream_tagged(songIds, timestamp, dimensions)
+                return
+
+        # Typed batches (NumPy arrays, array('q'), buffers) are aggregated
+        #       in one vectorized step and merged per distinct song
+        if type(songIds) is not list:
+            aggregated=_aggregate_plays(songIds)
+            if aggregated is not None:
+                self._chart.add_many(*aggregated)
+                return
+
+        stream_map=self._chart.counts
+        changed=self._chart.changed
         # Iterate over all new streams
         for id in songIds:
             # Skip any invalid inputs
             if isinstance(id,int):
-                # Index existing entries in map
-                if id in self.stream_map:
-                    self.stream_map[id]+=1
-                # Create new map entry if none exists
+                stream_map[id]=stream_map.get(id,0)+1
+                # Remember the song so the ranking can catch up on read
+                changed.add(id)
+
+    def get_top_k(self, dimension=None):
+        return self._live_chart(dimension, settled=False).top(self.k)
+
+    @property
+    def stream_map(self):
+        # song -> plays. While background work runs the chart only holds
+        #       the plays since, so this is a view over both.
+        chart=self._chart
+        if chart.base is None:
+            return chart.counts
+        return _CombinedCounts(chart)
+
+    def dimensions(self):
+        return list(self._dimension_charts)
+
+    def _live_chart(self, dimension=None, settled=True):
+        # The chart with anything outside the active window expired. Unless
+        #       settled is False, background work is folded in first.
+        if self._background is not None:
+            self._fold(wait=settled)
+        if self.window is not None:
+            self._advance(self._clock())
+        if dimension is None:
+            return self._chart
+        chart=self._dimension_charts.get(dimension)
+        return chart if chart is not None else _SongChart()
+
+    def _chart_for(self, dimension):
+        if dimension is None:
+            return self._chart
+        chart=self._dimension_charts.get(dimension)
+        if chart is None:
+            chart=self._dimension_charts[dimension]=_SongChart()
+        return chart
+
+    # Durable checkpoints plus a replayable log of later batches
+
+    CHECKPOINT_MAGIC=b'ALGOFYC2'
+    CHECKPOINT_HEADER=struct.Struct('=8s8sqq')
+    SECTION_HEADER=struct.Struct('=qqq')
+    LOG_RECORD=struct.Struct('=qqq')
+
+    def enable_log(self, path, fsync=False):
+        # Append every following batch to path so recover() can replay it
+        if self.window is not None:
+            raise ValueError("Logging isn't supported for windowed charts")
+        self._log_path=path
+        self._log_fsync=fsync
+        self._log=open(path, 'ab')
+        self._plain=False
+
+    def _log_batch(self, songIds, dimensions):
+        if np is not None and isinstance(songIds, np.ndarray) and \
+                dimensions is None and songIds.dtype.kind in 'iu':
+            songs=songIds.astype(np.int64).tobytes()
+            count=songIds.size
+        else:
+            view=_int_view(songIds) if dimensions is None else None
+            if view is not None:
+                songs=view.tobytes() if view.format=='q' else \
+                    array('q', view).tobytes()
+                count=len(view)
+            else:
+                if np is not None and isinstance(songIds, np.ndarray):
+                    songIds=songIds.tolist()
+                if dimensions is None:
+                    kept=array('q', (id for id in songIds
+                                     if isinstance(id,int)))
                 else:
-                    self.stream_map[id]=1
+                    pairs=[(id, tags) for id, tags in zip(songIds, dimensions)
+                           if isinstance(id,int)]
+                    kept=array('q', (id for id, tags in pairs))
+                    dimensions=[tags for id, tags in pairs]
+                songs=kept.tobytes()
+                count=len(kept)
+        extra=pickle.dumps(dimensions) if dimensions is not None else b''
+        self._log_sequence+=1
+        self._log.write(self.LOG_RECORD.pack(self._log_sequence, count,
+                                             len(extra)))
+        self._log.write(songs)
+        self._log.write(extra)
+        self._log.flush()
+        if self._log_fsync:
+            os.fsync(self._log.fileno())
 
-    def get_top_k(self):
+    def checkpoint(self, path, background=True):
+        """
+        Write every chart to path atomically (temp file, then rename).
+
+        Each chart's state is detached as a read-only base in O(1) and new
+        plays are counted on top of it, so the caller never waits on the
+        write. A background thread lays out the base's counts and writes
+        them; the next call that finds the thread finished folds the new
+        plays back in (see settle()). Returns the thread, or None when
+        background=False.
+        """
+        if self.window is not None:
+            raise ValueError("Checkpoints aren't supported for windowed \
+charts")
+
+        # Only one checkpoint (or recovery) in flight at a time
+        self.settle()
+
+        sections=[(None, self._chart)]
+        sections.extend(self._dimension_charts.items())
+        bases={key: chart.detach() for key, chart in sections}
+        sequence=self._log_sequence
+
+        # Batches logged so far are covered by this checkpoint; start a new
+        #       log and keep the old one until the checkpoint is on disk
+        previous_log=None
+        if self._log is not None:
+            previous_log=self._log_path+'.prev'
+            self._log.close()
+            if os.path.exists(previous_log):
+                with open(previous_log, 'ab') as combined, \
+                        open(self._log_path, 'rb') as current:
+                    combined.write(current.read())
+                os.remove(self._log_path)
+            else:
+                os.replace(self._log_path, previous_log)
+            self._log=open(self._log_path, 'ab')
+
+        # Whatever write() raised, for settle() to raise on the caller's
+        #       thread once the new plays are folded back in
+        errors=[]
+
+        def write():
+            temporary=path+'.tmp'
+            try:
+                with open(temporary, 'wb') as output:
+                    output.write(self.CHECKPOINT_HEADER.pack(
+                        self.CHECKPOINT_MAGIC, sys.byteorder.encode()[:8],
+                        sequence, len(sections)))
+                    for key, chart in sections:
+                        # Only the frozen counts are read here; readers
+                        #       keep the base's buckets to themselves
+                        songs, levels, runs, ids, plays= \
+                            _freeze_counts(bases[key].counts)
+                        key_bytes=pickle.dumps(key)
+                        output.write(self.SECTION_HEADER.pack(
+                            len(songs), len(levels), len(key_bytes)))
+                        output.write(key_bytes)
+                        output.write(bytes(-len(key_bytes)%8))
+                        for column in (songs, levels, runs, ids, plays):
+                            output.write(column)
+                    output.flush()
+                    os.fsync(output.fileno())
+                os.replace(temporary, path)
+                _fsync_directory(path)
+            except BaseException as error:
+                errors.append(error)
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                return
+            # The old log is only dropped once the checkpoint is durable
+            if previous_log is not None and os.path.exists(previous_log):
+                os.remove(previous_log)
+
+        if not background:
+            self._background=(None, bases, None, errors)
+            write()
+            self.settle()
+            return None
+        thread=threading.Thread(target=write, daemon=True)
+        self._background=(thread, bases, None, errors)
+        thread.start()
+        return thread
+
+    def settle(self, wait=True):
+        """
+        Fold a finished background checkpoint or recovery into the live
+        charts, so every chart holds full counts again. With wait=False
+        this returns at once if the work is still running; stream_songs and
+        get_top_k use that and never block on it. A checkpoint that failed
+        is raised here; its plays are folded back in all the same.
+        """
+        self._fold(wait)
+        error=self._checkpoint_error
+        if error is not None:
+            self._checkpoint_error=None
+            raise error
+
+    def _fold(self, wait):
+        if self._background is None:
+            return
+        thread, settled, cleanup, errors=self._background
+        if thread is not None and thread.is_alive():
+            if not wait:
+                return
+            thread.join()
+        self._background=None
+        for key, base in settled.items():
+            self._chart_for(key).attach(base)
+        # Anything the background thread didn't get to is built here
+        for chart in [self._chart]+list(self._dimension_charts.values()):
+            if chart.base is not None:
+                chart.attach(chart.base.materialize())
+        if cleanup is not None:
+            cleanup()
+        if errors:
+            self._checkpoint_error=errors[0]
+
+    @classmethod
+    def recover(cls, k, checkpoint_path=None, log_path=None, **options):
+        """
+        Rebuild an AlgoFy from a checkpoint and replay any logged batches
+        newer than it. Logging continues to log_path.
+
+        The checkpoint is mapped with mmap and served as is: get_top_k reads
+        the ranked songs straight from the mapping and looks the replayed
+        songs up in its sorted id index. The dicts are built on a background
+        thread and swapped in by settle(), so recovery costs O(k) plus the
+        replayed log, however many songs the checkpoint holds.
+        """
+        ranker=cls(k, **options)
+        sequence=0
+        mapped=None
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            sequence, mapped, close=ranker._load_checkpoint(checkpoint_path)
+
+        try:
+            # Replayed plays land in empty charts, which is exactly what a
+            #       chart counts on top of its base
+            if log_path is not None:
+                last=sequence
+                for name in (log_path+'.prev', log_path):
+                    if os.path.exists(name):
+                        last=max(last, ranker._replay_log(name, sequence))
+                ranker.enable_log(log_path)
+                ranker._log_sequence=last
+        except BaseException:
+            if mapped is not None:
+                close()
+            raise
+        if mapped is not None:
+            ranker._serve_checkpoint(mapped, close)
+        return ranker
+
+    def _load_checkpoint(self, path):
+        with open(path, 'rb') as source:
+            mapping=mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        mapped={}
+        try:
+            magic, byteorder, sequence, section_count= \
+                self.CHECKPOINT_HEADER.unpack_from(mapping, 0)
+            if magic!=self.CHECKPOINT_MAGIC:
+                raise ValueError(f"{path} is not an AlgoFy checkpoint")
+            if byteorder.rstrip(b'\0')!=sys.byteorder.encode()[:8]:
+                raise ValueError(f"{path} was written with a different \
+byte order")
+            view=memoryview(mapping)
+            offset=self.CHECKPOINT_HEADER.size
+            for i in range(section_count):
+                song_count, level_count, key_size= \
+                    self.SECTION_HEADER.unpack_from(mapping, offset)
+                offset+=self.SECTION_HEADER.size
+                key=pickle.loads(mapping[offset:offset+key_size])
+                offset+=key_size+(-key_size%8)
+                columns=[]
+                for size in (song_count, level_count, level_count,
+                             song_count, song_count):
+                    columns.append(view[offset:offset+8*size].cast('q'))
+                    offset+=8*size
+                mapped[key]=_MappedChart(*columns)
+            view.release()
+        except BaseException:
+            for base in mapped.values():
+                base.release()
+            mapping.close()
+            raise
+
+        def close():
+            for base in mapped.values():
+                base.release()
+            mapping.close()
+
+        return sequence, mapped, close
+
+    def _serve_checkpoint(self, mapped, close):
+        # Put the mapped charts under the live ones and build their dicts
+        #       in the background
+        settled={}
+
+        def materialize():
+            for key, base in mapped.items():
+                settled[key]=base.materialize()
+
+        for key, base in mapped.items():
+            self._chart_for(key).base=base
+        thread=threading.Thread(target=materialize, daemon=True)
+        self._background=(thread, settled, close, None)
+        thread.start()
 
-        # Helper function to perform downheap bubbling
-        def downheap(heap_list, i):
-            # Record indicies of potential left and right childen and a
-            #       max_i that will be changed as needed
-            max_i=i
-            left_i=(2*i)+1
-            right_i=(2*i)+2
-
-            # If the left child exists and is larger, it's the new max index
-            if left_i<len(heap_list) and \
-                                    heap_list[left_i][1]>heap_list[max_i][1]:
-                max_i=left_i
-            # If the right child exists and is larger, it's the new max index
-            if right_i<len(heap_list) and \
-                                    heap_list[right_i][1]>heap_list[max_i][1]:
-                max_i=right_i
-
-            # If we found a new max, swap the parent with that child
-            if i!=max_i:
-                temp=heap_list[i]
-                heap_list[i]=heap_list[max_i]
-                heap_list[max_i]=temp
-
-            # Return new max index for use in parent function
-            return max_i
-
-        # Helper function for removing max value and re-heapifying
-        def remove_max(heap_list):
-            # Single node heap edge case
-            if len(heap_list)==1:
-                return heap_list.pop()[0]
-            # Remove max and set last node as root
-            max=heap_list[0]
-            heap_list[0]=heap_list.pop()
-            i=0
-            # Perform downheap restructuring
+    def _replay_log(self, path, after):
+        # Re-apply logged batches with a sequence number above after
+        last=after
+        with open(path, 'rb') as log:
             while True:
-                new_i=downheap(heap_list,i)
-                # When downheap no longer results in a change, we're done
-                if i==new_i:
+                header=log.read(self.LOG_RECORD.size)
+                if len(header)<self.LOG_RECORD.size:
                     break
-                i=new_i
-            # Return the max value
-            return max[0]
-
-        #Beginning of main block
-
-        # Convert map to list that we will heapify
-        heap_list=list(self.stream_map.items())
-        # Start downheaping with last internal index
-        last_internal_index=(len(heap_list)-2)//2
-        # Work up the free to the root and downheap all
-        for i in range(last_internal_index,-1,-1):
+                sequence, count, extra_size=self.LOG_RECORD.unpack(header)
+                songs=log.read(8*count)
+                extra=log.read(extra_size)
+                # A torn final record from a crash is ignored
+                if len(songs)<8*count or len(extra)<extra_size:
+                    break
+                if sequence<=after:
+                    continue
+                batch=array('q')
+                batch.frombytes(songs)
+                dimensions=pickle.loads(extra) if extra_size else None
+                if dimensions is None:
+                    self.stream_songs(batch)
+                else:
+                    self.stream_songs(batch.tolist(), dimensions=dimensions)
+                last=max(last, sequence)
+        return last
+
+    # Rank and range queries, ordered by plays then song id
+
+    def get_rank(self, song, dimension=None):
+        # 1-based rank of a song, or None if it has no plays
+        chart=self._live_chart(dimension)
+        index=chart.ranks()
+        plays=chart.ranked.get(song)
+        if plays is None:
+            return None
+        return index.rank(song, plays)
+
+    def get_songs_by_rank(self, first, last, dimension=None):
+        # Songs ranked first..last (1-based, inclusive)
+        chart=self._live_chart(dimension)
+        index=chart.ranks()
+        first=max(first, 1)
+        last=min(last, index.size)
+        if first>last:
+            return []
+        plays, position=index.select(first)
+        songs=[]
+        level=bisect_left(chart.levels, plays)
+        while len(songs)<last-first+1:
+            bucket=index.sorted_songs[chart.levels[level]]
+            songs.extend(bucket.slice(position,
+                                      position+last-first+1-len(songs)))
+            level-=1
+            position=0
+        return songs
+
+    def count_at_least(self, plays, dimension=None):
+        # How many songs have at least plays plays
+        return self._live_chart(dimension).ranks().count_at_least(plays)
+
+    # Partial states, for merging shards that each saw part of the feed
+
+    PARTIAL_HEADER=struct.Struct('<8sq')
+    PARTIAL_MAGIC=b'ALGOFYP1'
+
+    def dump_partial(self):
+        # Serialize the counts as a header plus two little-endian int64
+        #       arrays (songs, then plays)
+        counts=self._live_chart().counts
+        songs=array('q', counts.keys())
+        plays=array('q', counts.values())
+        if sys.byteorder!='little':
+            songs.byteswap()
+            plays.byteswap()
+        return self.PARTIAL_HEADER.pack(self.PARTIAL_MAGIC, len(songs)) + \
+            songs.tobytes() + plays.tobytes()
+
+    def merge_partial(self, data):
+        # Add the plays from a dump_partial() blob into this ranker
+        magic, size=self.PARTIAL_HEADER.unpack_from(data, 0)
+        if magic!=self.PARTIAL_MAGIC:
+            raise ValueError("Not an AlgoFy partial state")
+        start=self.PARTIAL_HEADER.size
+        songs=array('q')
+        plays=array('q')
+        songs.frombytes(data[start:start+8*size])
+        plays.frombytes(data[start+8*size:start+16*size])
+        if sys.byteorder!='little':
+            songs.byteswap()
+            plays.byteswap()
+        self._live_chart().add_many(songs.tolist(), plays.tolist())
+
+    @classmethod
+    def from_partials(cls, k, partials):
+        ranker=cls(k)
+        for data in partials:
+            ranker.merge_partial(data)
+        return ranker
+
+    def top_counts(self, count):
+        # This shard's count most played songs as (song, plays)
+        chart=self._live_chart()
+        return [(song, chart.counts[song]) for song in chart.top(count)]
+
+    def songs_at_least(self, threshold):
+        # Every (song, plays) on this shard with plays >= threshold
+        chart=self._live_chart()
+        chart.sync()
+        found=[]
+        for level in reversed(chart.levels):
+            if level<threshold:
+                break
+            found.extend((song, level) for song in chart.buckets[level])
+        return found
+
+    def counts_for(self, songs):
+        counts=self._live_chart().counts
+        return [counts.get(song, 0) for song in songs]
+
+    def _stream_tagged(self, songIds, timestamp, dimensions):
+        # Windowed and/or dimension tagged batches: count (dimension, song)
+        #       pairs in one pass over the plays, then apply them per chart
+        if self.window is not None:
+            if timestamp is None:
+                timestamp=self._clock()
+            self._advance(timestamp)
+
+        played=Counter()
+        if dimensions is None:
+            aggregated=_aggregate_plays(songIds) \
+                if type(songIds) is not list else None
+            if aggregated is None:
+                aggregated=Counter(id for id in songIds
+                                   if isinstance(id,int)).items()
+            else:
+                aggregated=zip(*aggregated)
+            for song, plays in aggregated:
+                played[None, song]=plays
+        else:
+            if np is not None and isinstance(songIds, np.ndarray):
+                songIds=songIds.tolist()
+            for id, tags in zip(songIds, dimensions):
+                if not isinstance(id,int):
+                    continue
+                played[None, id]+=1
+                if tags is None:
+                    continue
+                if isinstance(tags, (tuple, list)):
+                    for dimension in tags:
+                        played[dimension, id]+=1
+                else:
+                    played[tags, id]+=1
+
+        if self.window=='day':
+            # Plays stamped before the current day have already expired
+            if self._day_of(timestamp)<self._day:
+                return
+        elif self.window is not None:
+            index=int(timestamp//self.bucket_seconds)
+            buckets=self._buckets
+            if buckets and (index<=buckets[-1][0]-self._bucket_span or
+                            index<buckets[0][0]):
+                return
+            # Buckets run one per index with no gaps, so a late play still
+            #       inside the window lands in the bucket for its own
+            #       timestamp, found by its offset from the oldest one
+            if not buckets or index>buckets[-1][0]:
+                first=index-self._bucket_span+1
+                if buckets:
+                    first=max(first, buckets[-1][0]+1)
+                buckets.extend((i, Counter()) for i in range(first, index+1))
+            buckets[index-buckets[0][0]][1].update(played)
+
+        for (dimension, song), plays in played.items():
+            self._chart_for(dimension).add(song, plays)
+
+    def _day_of(self, timestamp):
+        return int((timestamp-self.rollover_offset)//self.SECONDS_PER_DAY)
+
+    def _advance(self, now):
+        # Drop everything that has left the active window as of now
+        if self.window=='day':
+            day=self._day_of(now)
+            if self._day is None or day>self._day:
+                if self._day is not None:
+                    self._reset_chart()
+                self._day=day
+            return
+
+        # Expiring a bucket costs one update per distinct song it held
+        oldest_kept=int(now//self.bucket_seconds)-self._bucket_span+1
+        while self._buckets and self._buckets[0][0]<oldest_kept:
+            index, played=self._buckets.popleft()
+            for (dimension, song), plays in played.items():
+                self._chart_for(dimension).add(song, -plays)
+
+    def _reset_chart(self):
+        # Everything expires at once at a calendar rollover
+        self._chart=_SongChart()
+        self._dimension_charts={}
+
+
+def _threshold_top_k(k, shard_count, ask):
+    """
+    Exact top k over shards that each counted part of the plays, using the
+    three round Threshold Algorithm (TPUT). ask(method, args) calls method on
+    every shard and returns the list of results. Only local top lists and
+    songs above a threshold cross the wire, never whole count maps.
+    """
+    if k<=0:
+        return []
+
+    # Round 1: local top k lists give lower bounds on the totals
+    lower={}
+    for reported in ask('top_counts', (k,)):
+        for song, plays in reported:
+            lower[song]=lower.get(song, 0)+plays
+    if len(lower)>=k:
+        kth=heapq.nlargest(k, lower.values())[-1]
+    else:
+        kth=0
+
+    # Round 2: a song missing from every reply has fewer than kth / shards
+    #       plays on each shard, so its total is below kth
+    threshold=math.ceil(kth/shard_count)
+    lower={}
+    seen={}
+    for reported in ask('songs_at_least', (threshold,)):
+        for song, plays in reported:
+            lower[song]=lower.get(song, 0)+plays
+            seen[song]=seen.get(song, 0)+1
+    if not lower:
+        return []
+    # Both rounds give valid lower bounds on the true k-th total
+    if len(lower)>=k:
+        kth=max(kth, heapq.nlargest(k, lower.values())[-1])
+    # Shards that didn't report a song hold at most threshold - 1 of it
+    candidates=[song for song, plays in lower.items()
+                if plays+(shard_count-seen[song])*max(threshold-1, 0)>=kth]
+
+    # Round 3: exact totals for the surviving candidates
+    totals=[0]*len(candidates)
+    for counts in ask('counts_for', (candidates,)):
+        for i, plays in enumerate(counts):
+            totals[i]+=plays
+    ranked=sorted(zip(candidates, totals), key=lambda entry: (-entry[1], entry[0]))
+    return [song for song, plays in ranked[:k] if plays>0]
+
+
+def merge_top_k(shards, k):
+    # Exact top k across in-process AlgoFy shards
+    def ask(method, args):
+        return [getattr(shard, method)(*args) for shard in shards]
+    return _threshold_top_k(k, len(shards), ask)
+
+
+def _shard_worker(connection, k, options):
+    # Worker loop for ShardedAlgoFy: one AlgoFy per process
+    ranker=AlgoFy(k, **options)
+    while True:
+        message=connection.recv()
+        command=message[0]
+        if command=='stream':
+            ranker.stream_songs(message[1])
+        elif command=='stop':
+            break
+        else:
+            connection.send(getattr(ranker, command)(*message[1:]))
+    connection.close()
+
+
+class ShardedAlgoFy:
+    """
+    Runs one AlgoFy per worker process on this machine. Batches go to the
+    workers round robin, so ingestion scales past one core, and get_top_k
+    merges the shards exactly with the threshold algorithm.
+    """
+    def __init__(self, k, workers=None, **options):
+        self.k = k
+        context=multiprocessing.get_context()
+        self._connections=[]
+        self._processes=[]
+        for i in range(workers or os.cpu_count() or 1):
+            parent_end, child_end=context.Pipe()
+            process=context.Process(target=_shard_worker,
+                                    args=(child_end, k, options), daemon=True)
+            process.start()
+            child_end.close()
+            self._connections.append(parent_end)
+            self._processes.append(process)
+        self._next=0
+
+    def stream_songs(self, songIds):
+        # Hand the batch to the next worker without waiting for it
+        self._connections[self._next].send(('stream', songIds))
+        self._next=(self._next+1)%len(self._connections)
+
+    def _ask(self, method, args):
+        # Send to every worker first so they all work at the same time
+        for connection in self._connections:
+            connection.send((method,)+tuple(args))
+        return [connection.recv() for connection in self._connections]
+
+    def get_top_k(self):
+        return _threshold_top_k(self.k, len(self._connections), self._ask)
+
+    def dump_partials(self):
+        return self._ask('dump_partial', ())
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(('stop',))
+            connection.close()
+        for process in self._processes:
+            process.join()
+        self._connections=[]
+        self._processes=[]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AlgoFyServer:
+    """
+    asyncio front end for an AlgoFy fed by iStream.
+
+    Batches land in a bounded queue, so producers are slowed down (their
+    submit() waits) when ingestion falls behind. One ingest task drains the
+    queue, coalesces small batches into one larger stream_songs call and
+    applies it on a worker thread, then publishes a fresh chart snapshot.
+    get_top_k() only reads the last snapshot and never waits on a write.
+
+    Batches can also arrive over a local TCP socket as one JSON list of song
+    ids per line; a line reading TOP gets the current chart back as JSON.
+
+    A batch that isn't a list or an integer array is refused by submit()
+    (and skipped when it comes over the socket). If applying a batch fails
+    anyway, the error is logged and counted in failed_batches and ingestion
+    carries on with the next one.
+    """
+    def __init__(self, ranker, max_pending=64, coalesce_plays=50000):
+        self.ranker=ranker
+        self.max_pending=max_pending
+        self.coalesce_plays=coalesce_plays
+        # Socket lines that weren't a batch, and batches that failed to apply
+        self.rejected_batches=0
+        self.failed_batches=0
+        self._chart=tuple(ranker.get_top_k())
+        self._queue=None
+        self._ingest_task=None
+        self._server=None
+        # One thread owns the ranker, so writes never overlap
+        self._executor=ThreadPoolExecutor(max_workers=1)
+
+    async def start(self, host='127.0.0.1', port=None):
+        self._queue=asyncio.Queue(self.max_pending)
+        self._ingest_task=asyncio.create_task(self._ingest())
+        if port is not None:
+            self._server=await asyncio.start_server(self._handle_client,
+                                                    host, port)
+        return self
+
+    @property
+    def port(self):
+        if self._server is None:
+            return None
+        return self._server.sockets[0].getsockname()[1]
+
+    async def submit(self, songIds):
+        # Waits here (backpressure) while the queue is full
+        self._check_batch(songIds)
+        await self._queue.put(songIds)
+
+    @staticmethod
+    def _check_batch(songIds):
+        # Raise for anything stream_songs can't take as one batch
+        if isinstance(songIds, (list, tuple)):
+            return
+        if np is not None and isinstance(songIds, np.ndarray):
+            if songIds.dtype.kind not in 'iu':
+                raise TypeError(f"Can't read song ids from a \
+{songIds.dtype} array")
+            return
+        if _int_view(songIds) is None:
+            raise TypeError(f"A batch must be a list or an integer array, \
+not {type(songIds).__name__}")
+
+    @staticmethod
+    def _batch_plays(songIds):
+        # Plays in a batch _check_batch accepted: every id of a 2-D array,
+        #       and ids rather than bytes for raw buffers
+        if isinstance(songIds, (list, tuple)):
+            return len(songIds)
+        if np is not None and isinstance(songIds, np.ndarray):
+            return songIds.size
+        return len(_int_view(songIds))
+
+    def get_top_k(self):
+        return list(self._chart)
+
+    async def drain(self):
+        # Wait until everything submitted so far has been applied
+        await self._queue.join()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server=None
+        if self._queue is not None:
+            await self._queue.join()
+        if self._ingest_task is not None:
+            self._ingest_task.cancel()
+            try:
+                await self._ingest_task
+            except asyncio.CancelledError:
+                pass
+            self._ingest_task=None
+        self._executor.shutdown()
+
+    async def _ingest(self):
+        loop=asyncio.get_running_loop()
+        while True:
+            batches=[await self._queue.get()]
+            plays=self._batch_plays(batches[0])
+            # Coalesce whatever else is already waiting, up to the limit
+            while plays<self.coalesce_plays and not self._queue.empty():
+                batch=self._queue.get_nowait()
+                batches.append(batch)
+                plays+=self._batch_plays(batch)
+            try:
+                self._chart=await loop.run_in_executor(
+                    self._executor, self._apply, batches)
+            except Exception:
+                # One bad batch must not stop ingestion for everyone else
+                self.failed_batches+=len(batches)
+                logger.exception("Dropped %d batch(es) that failed to apply",
+                                 len(batches))
+            finally:
+                for batch in batches:
+                    self._queue.task_done()
+
+    def _apply(self, batches):
+        # Runs on the ingest thread
+        if len(batches)==1:
+            combined=batches[0]
+        elif np is not None and all(isinstance(batch, np.ndarray)
+                                    for batch in batches):
+            combined=np.concatenate([batch.ravel() for batch in batches])
+        else:
+            combined=[]
+            for batch in batches:
+                if np is not None and isinstance(batch, np.ndarray):
+                    batch=batch.ravel().tolist()
+                elif not isinstance(batch, (list, tuple)):
+                    batch=_int_view(batch).tolist()
+                combined.extend(batch)
+        self.ranker.stream_songs(combined)
+        return tuple(self.ranker.get_top_k())
+
+    async def _handle_client(self, reader, writer):
+        try:
             while True:
-                new_i=downheap(heap_list,i)
-                if i==new_i:
+                line=await reader.readline()
+                if not line:
                     break
-                i=new_i
+                line=line.strip()
+                if not line:
+                    continue
+                if line==b'TOP':
+                    writer.write(json.dumps(self.get_top_k()).encode()+b'\n')
+                    await writer.drain()
+                    continue
+                try:
+                    batch=json.loads(line)
+                    if not isinstance(batch, list):
+                        raise TypeError(f"Expected a JSON list, got \
+{type(batch).__name__}")
+                except (ValueError, TypeError) as error:
+                    self.rejected_batches+=1
+                    logger.warning("Skipped a malformed batch line: %s",
+                                   error)
+                    continue
+                await self.submit(batch)
+        finally:
+            writer.close()
+
+
+async def run_load_producer(target, batches=1000, batch_size=500,
+                            song_count=100000, seed=None):
+    """
+    Stand-in for iStream when load testing. target is an AlgoFyServer or a
+    (host, port) pair for its socket. Song ids are drawn with a skewed
+    (Zipf-like) popularity. Returns (plays sent, seconds taken).
+    """
+    rng=random.Random(seed)
+    writer=None
+    if isinstance(target, tuple):
+        reader, writer=await asyncio.open_connection(*target)
+
+    started=time.perf_counter()
+    for i in range(batches):
+        batch=[int(song_count**rng.random())-1 for j in range(batch_size)]
+        if writer is None:
+            await target.submit(batch)
+        else:
+            writer.write(json.dumps(batch).encode()+b'\n')
+            # The socket buffer filling up is the backpressure here
+            await writer.drain()
+    if writer is not None:
+        writer.close()
+        await writer.wait_closed()
+    return batches*batch_size, time.perf_counter()-started
 
-        top_k_list=[]
-        # Get and return the top k songs
-        for i in range(self.k):
-            if heap_list:
-                top_k_list.append(remove_max(heap_list))
 
-        return top_k_list
+class CountMinSketch:
+    """
+    Count-Min sketch: depth rows of width counters. An estimate never
+    undercounts, and overcounts by more than epsilon * total plays with
+    probability at most delta.
+    """
+    PRIME=(1 << 61)-1
+
+    def __init__(self, epsilon, delta, seed=None):
+        self.width=math.ceil(math.e/epsilon)
+        self.depth=math.ceil(math.log(1/delta))
+        rng=random.Random(seed)
+        self.hashes=[(rng.randrange(1, self.PRIME), rng.randrange(self.PRIME))
+                     for i in range(self.depth)]
+        self.rows=[array('q', bytes(8*self.width)) for i in range(self.depth)]
+
+    def add(self, song, plays):
+        for row, (a, b) in zip(self.rows, self.hashes):
+            row[(a*song+b)%self.PRIME%self.width]+=plays
+
+    def estimate(self, song):
+        return min(row[(a*song+b)%self.PRIME%self.width]
+                   for row, (a, b) in zip(self.rows, self.hashes))
+
+
+class ApproxAlgoFy:
+    """
+    Fixed-memory AlgoFy for very large catalogs.
+
+    Space-Saving monitors at most ceil(1/epsilon) candidate songs, evicting
+    the least played one (from the lowest count bucket) when a new song
+    arrives. A Count-Min sketch gives a second, independent upper bound on
+    each song's plays. Every estimate is within epsilon * total plays of
+    the true count (the sketch bound holds with probability 1 - delta).
+    """
+    def __init__(self, k, epsilon=0.001, delta=0.01, seed=None):
+        self.k = k
+        self.epsilon=epsilon
+        self.capacity=max(k, math.ceil(1/epsilon))
+        self.total_plays=0
+        # Monitored candidates and how much each one may be overcounted
+        self._chart=_SongChart()
+        self._overcount={}
+        self.sketch=CountMinSketch(epsilon, delta, seed)
+
+    def stream_songs(self, songIds):
+        aggregated=_aggregate_plays(songIds) \
+            if type(songIds) is not list else None
+        if aggregated is None:
+            played=Counter(id for id in songIds if isinstance(id,int))
+            aggregated=played.keys(), played.values()
+
+        chart=self._chart
+        counts=chart.counts
+        for song, plays in zip(*aggregated):
+            self.total_plays+=plays
+            self.sketch.add(song, plays)
+            if song in counts or len(counts)<self.capacity:
+                self._overcount.setdefault(song, 0)
+                chart.add(song, plays)
+                continue
+            # Replace the least played candidate; the newcomer inherits its
+            #       count as the worst case for plays it may have missed
+            chart.sync()
+            floor=chart.levels[0]
+            evicted=next(iter(chart.buckets[floor]))
+            chart.add(evicted, -floor)
+            del self._overcount[evicted]
+            self._overcount[song]=floor
+            chart.add(song, floor+plays)
+
+    def get_top_k(self):
+        return self._chart.top(self.k)
+
+    def get_top_k_with_errors(self):
+        # (song, estimated plays, maximum overcount) for each top song
+        top_list=[]
+        bound=self.epsilon*self.total_plays
+        for song in self.get_top_k():
+            monitored=self._chart.counts[song]
+            estimate=min(monitored, self.sketch.estimate(song))
+            error=min(self._overcount[song], bound, estimate)
+            top_list.append((song, estimate, error))
+        return top_list
 
 
 """
@@ -1,5 +1,17 @@
 import heapq
 import math
+import multiprocessing
+import os
+import random
+import time
+from array import array
+from collections import OrderedDict
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
  You are working for a promising new “flight hacking” startup “AlgoJet”.
@@ -38,6 +50,97 @@ import math
  node examination), plus M times (onece for each edge relaxation).
  Therefore, O((N+M)log(N)).
 
+ Frozen graph
+ --------------------
+ initialize_flight_graph(flights, freeze=True) (or freeze_graph() later)
+ packs the graph into a CompactFlightGraph: cities are interned to dense
+ integer ids and the edges are stored in compressed sparse row form, three
+ typed arrays (offsets, targets and prices) at about 16 bytes per flight.
+ The frozen graph then owns the topology: the dict graph is dropped, fare
+ updates go straight to the arrays, and the dict is only rebuilt when a
+ fare no longer fits the price storage, more flights are loaded or the
+ graph attribute is read (it is then kept in step with later updates). The
+ reverse adjacency costs as much again, so it is only built by the first
+ backward search (bidirectional queries and landmarks).
+ Dijkstra then runs over integer ids with an id-indexed distance list, so
+ there is no string hashing and no per-city dict work on the hot path.
+ Freezing is O(N+M) and queries stay O((N+M)log(N)).
+
+ Bucket queue
+ --------------------
+ When every fare is a non-negative int, frozen or not, searches use Dial's
+ bucket queue instead of a heap: a ring of lists indexed by price, since
+ every queued price is within the largest fare C of the one being settled.
+ Up to C<2**DIAL_BITS the ring has C+2 one-price buckets; a push is a list
+ append and a pop takes from the current bucket, so a search is O(N+M+D)
+ for a final price D, with no log factor. Larger fares (fares in cents, say)
+ share each bucket among 2**shift prices so the ring stays about
+ 2**DIAL_BITS long. Only the bucket being settled is then ordered, as a
+ small heap, so the log factor is over one bucket's entries rather than
+ the whole queue. Cached search trees keep their ring and resume from it.
+ The frozen graph sizes its ring per search from bucket_ring, which fare
+ updates keep current; the dict graph counts its fares when its first tree
+ is built and keeps the count up on every update. A fare beyond a cached
+ tree's ring, or one that isn't an int, drops that tree.
+
+ Faster query modes
+ --------------------
+ get_cheapest_flight(source, destination, method=...) also accepts
+ 'bidirectional', which grows one search forward from the source and one
+ backward from the destination over the reverse adjacency until their
+ frontiers together cost more than the best meeting point, and 'alt', which
+ is A* guided by landmark lower bounds: for a landmark L,
+ price(v, t) >= price(L, t) - price(L, v) and price(v, t) >= price(v, L) -
+ price(t, L). Landmarks cost 2 full searches each up front
+ (initialize_flight_graph(flights, landmarks=8)) and 2*N stored prices
+ each. Both modes have the same worst case as Dijkstra but settle far fewer
+ cities on long routes; last_settled reports the count for the last query.
+
+ Contraction hierarchy
+ --------------------
+ initialize_flight_graph(flights, contract=True) (or method='ch' on first
+ use, before any fare update) contracts every city in priority order,
+ adding shortcut flights that preserve prices, and keeps only the flights
+ that climb the ranking. Preprocessing does a bounded witness search per
+ (in, out) flight pair of each contracted city; compact.hierarchy.stats
+ reports its time, the number of shortcuts and the index size. A query is
+ a bidirectional search that only climbs, so it settles a few hundred
+ cities instead of most of the graph.
+
+ Cached search trees
+ --------------------
+ Plain Dijkstra queries keep their search per origin in an LRU cache of
+ ShortestPathTrees. A tree stops as soon as the destination is settled and
+ keeps its heap, so a later query for a farther city resumes the same
+ search, and a city that is already settled is a dict lookup. The cache
+ holds at most cache_limit cities across all trees (AlgoJet(cache_limit=0)
+ turns it off) and is dropped whenever the graph is reloaded or frozen. A
+ whole origin costs O((N+M)log(N)) once, however many queries it serves.
+
+ Fare matrix
+ --------------------
+ get_fare_matrix(sources, destinations) runs one full search per distinct
+ source over the frozen graph, S*O((N+M)log(N)) for S distinct sources
+ instead of one search per pair, and spreads the sources over a process
+ pool. Workers get the frozen graph once when they start (inherited, not
+ copied, where processes fork).
+
+ Fare updates
+ --------------------
+ add_flight, remove_flight and change_price keep every fare on routes that
+ have more than one, so the graph always holds the cheapest remaining fare.
+ When that cheapest fare changes, the frozen graph is repriced in place
+ (a new route goes into a small overlay) and each cached tree is repaired
+ or dropped on its own. Landmark prices are repaired rather than rebuilt: a
+ dearer fare leaves them as valid lower bounds, and a cheaper one is
+ relaxed through only the cities it makes cheaper. The contraction
+ hierarchy is kept when one hierarchy query shows the change leaves every
+ cheapest price as it was, and dropped otherwise. Queries never rebuild
+ an index once fares have changed: 'ch' (or 'alt' without landmarks) runs
+ on the cached trees until build_hierarchy() (or build_landmarks()) is
+ called. An update is O(degree) plus O(1) per cached tree, one hierarchy
+ query, and a search over the cities whose landmark prices drop.
+
  """
 
 
@@ -48,11 +151,1135 @@ class Flight:
         self.price = price
 
 
+class CompactFlightGraph:
+    """
+    Compressed sparse row copy of an AlgoJet graph.
+
+    City i's flights are targets[offsets[i]:offsets[i+1]] with the matching
+    prices. Prices are kept as int64 when every fare is an int (so answers
+    stay ints), as doubles when every fare is a float, and as a plain list
+    otherwise.
+    """
+    # Unreached marker for integer distance arrays
+    NO_PRICE=2**63-1
+    # Bucket queues keep about 2**DIAL_BITS buckets; larger fares share
+    #       each bucket among 2**shift prices
+    DIAL_BITS=12
+    # Query methods get_cheapest_price accepts
+    SEARCH_METHODS=('dijkstra', 'bidirectional', 'alt', 'ch')
+
+    def __init__(self, graph):
+        self.cities=list(graph)
+        self.city_ids={city: i for i, city in enumerate(self.cities)}
+
+        city_ids=self.city_ids
+        offsets=array('q', [0])
+        targets=array('q')
+        prices=[]
+        for city in self.cities:
+            for destination, price in graph[city].items():
+                targets.append(city_ids[destination])
+                prices.append(price)
+            offsets.append(len(targets))
+        self.offsets=offsets
+        self.targets=targets
+        # Reverse adjacency (who flies into each city), built by the first
+        #       backward search
+        self.reverse_offsets=None
+        self.reverse_targets=None
+        self.reverse_prices=None
+
+        # Integer distances need every path sum to fit below NO_PRICE
+        self.integral=all(type(price) is int for price in prices) and \
+            (not prices or 0<=min(prices) and
+             max(prices)*len(self.cities)<self.NO_PRICE)
+        if self.integral:
+            self.prices=array('q', prices)
+        elif all(type(price) is float for price in prices):
+            self.prices=array('d', prices)
+        else:
+            self.prices=prices
+        self.max_price=max(prices) if self.integral and prices else 0
+        # Fares that aren't non-negative ints
+        self.odd_prices=sum(self._is_odd(price) for price in prices)
+
+        # Routes added after freezing, {city: {city: price}} both ways
+        self.added_flights={}
+        self.added_into={}
+
+        # Filled in by build_landmarks()
+        self.landmarks=[]
+        self.landmark_from=[]
+        self.landmark_to=[]
+        # Filled in by build_hierarchy()
+        self.hierarchy=None
+        # Set by the first fare update; from then on a missing index is
+        #       never built inside a query (see search_method)
+        self.updated=False
+        self.last_settled=0
+
+    def __len__(self):
+        return len(self.cities)
+
+    def reverse_adjacency(self):
+        # (offsets, targets, prices) of the flights into each city, built
+        #       from the current arrays on first use and kept in step by
+        #       update_route from then on
+        if self.reverse_offsets is None:
+            count=len(self.cities)
+            offsets=self.offsets
+            targets=self.targets
+            incoming=[0]*(count+1)
+            for target in targets:
+                incoming[target+1]+=1
+            for i in range(count):
+                incoming[i+1]+=incoming[i]
+            reverse_offsets=array('q', incoming)
+            reverse_targets=array('q', bytes(8*len(targets)))
+            reverse_order=array('q', reverse_targets)
+            for city in range(count):
+                for i in range(offsets[city], offsets[city+1]):
+                    slot=incoming[targets[i]]
+                    incoming[targets[i]]+=1
+                    reverse_targets[slot]=city
+                    reverse_order[slot]=i
+            self.reverse_prices=self._price_array(self.prices[i]
+                                                  for i in reverse_order)
+            self.reverse_targets=reverse_targets
+            self.reverse_offsets=reverse_offsets
+        return self.reverse_offsets, self.reverse_targets, self.reverse_prices
+
+    def price(self, source, destination):
+        # Fare on one route, None if there is none
+        start=self.city_ids.get(source)
+        goal=self.city_ids.get(destination)
+        if start is None or goal is None:
+            return None
+        for i in range(self.offsets[start], self.offsets[start+1]):
+            if self.targets[i]==goal:
+                price=self.prices[i]
+                return None if price==self.unreached() else price
+        return self.added_flights.get(start, {}).get(goal)
+
+    def to_dict(self):
+        # The graph as {city: {destination: price}}, as AlgoJet keeps it
+        #       before freezing
+        unreached=self.unreached()
+        cities=self.cities
+        graph={}
+        for start, city in enumerate(cities):
+            graph[city]={cities[goal]: price
+                         for goal, price in self.flights_from(start)
+                         if price!=unreached}
+        return graph
+
+    def _price_array(self, values):
+        # Same storage type as self.prices
+        if type(self.prices) is array:
+            return array(self.prices.typecode, values)
+        return list(values)
+
+    def new_distances(self):
+        # One slot per city, all unreached
+        return [self.unreached()]*len(self.cities)
+
+    def unreached(self):
+        return self.NO_PRICE if self.integral else math.inf
+
+    @property
+    def bucket_ring(self):
+        # (buckets, shift) for the bucket queue, or None when the heap has
+        #       to be used
+        if not self.integral:
+            return None
+        return self.ring_for(self.max_price)
+
+    @classmethod
+    def ring_for(cls, max_price):
+        # Every queued price is within max_price of the one being settled,
+        #       so price>>shift spans at most (max_price>>shift)+2 buckets
+        shift=max(0, max_price.bit_length()-cls.DIAL_BITS)
+        return (max_price>>shift)+2, shift
+
+    @staticmethod
+    def _is_odd(price):
+        return price is not None and (type(price) is not int or price<0)
+
+    def flights_from(self, city):
+        # (destination, price) pairs for one city
+        low=self.offsets[city]
+        high=self.offsets[city+1]
+        flights=zip(self.targets[low:high], self.prices[low:high])
+        if city in self.added_flights:
+            return chain(flights, self.added_flights[city].items())
+        return flights
+
+    def update_route(self, source, destination, old_price, new_price):
+        """
+        Set the cheapest fare on one route in place (None for no route).
+        Existing routes are repriced in the arrays (a removed one keeps its
+        slot at the unreached price), new routes and cities go into
+        added_flights. Landmark prices are repaired and the hierarchy is
+        kept only if no cheapest price changes. Returns False when
+        new_price doesn't fit the price storage and the graph has to be
+        frozen again.
+        """
+        if new_price is not None and not self._fits(new_price):
+            return False
+        # Once the last odd fare is gone the fares can be packed as ints
+        odd_prices=self.odd_prices-self._is_odd(old_price)+\
+            self._is_odd(new_price)
+        if self.odd_prices and not odd_prices:
+            return False
+        self.odd_prices=odd_prices
+        self.updated=True
+        if self.integral and new_price is not None and \
+                new_price>self.max_price:
+            self.max_price=new_price
+        lowered=new_price is not None and (old_price is None or
+                                           new_price<old_price)
+        if self.hierarchy is not None and \
+                not self._keeps_prices(source, destination, old_price,
+                                       new_price, lowered):
+            self.hierarchy=None
+        for city in (source, destination):
+            if city not in self.city_ids:
+                self.city_ids[city]=len(self.cities)
+                self.cities.append(city)
+                self.offsets.append(self.offsets[-1])
+                if self.reverse_offsets is not None:
+                    self.reverse_offsets.append(self.reverse_offsets[-1])
+                for landmark_prices in chain(self.landmark_from,
+                                             self.landmark_to):
+                    landmark_prices.append(self.unreached())
+        start=self.city_ids[source]
+        goal=self.city_ids[destination]
+        price=self.unreached() if new_price is None else new_price
+
+        for i in range(self.offsets[start], self.offsets[start+1]):
+            if self.targets[i]==goal:
+                self.prices[i]=price
+                if self.reverse_offsets is None:
+                    break
+                for j in range(self.reverse_offsets[goal],
+                               self.reverse_offsets[goal+1]):
+                    if self.reverse_targets[j]==start:
+                        self.reverse_prices[j]=price
+                break
+        else:
+            if new_price is None:
+                del self.added_flights[start][goal]
+                del self.added_into[goal][start]
+                if not self.added_flights[start]:
+                    del self.added_flights[start]
+                if not self.added_into[goal]:
+                    del self.added_into[goal]
+            else:
+                self.added_flights.setdefault(start, {})[goal]=new_price
+                self.added_into.setdefault(goal, {})[start]=new_price
+
+        # Landmark prices are kept as exact prices over a graph no dearer
+        #       than this one, which keeps every bound a lower bound: a
+        #       dearer fare leaves them alone and a cheaper one is relaxed
+        #       through the cities it makes cheaper
+        if lowered:
+            for from_landmark, to_landmark in zip(self.landmark_from,
+                                                  self.landmark_to):
+                if from_landmark[start]+new_price<from_landmark[goal]:
+                    from_landmark[goal]=from_landmark[start]+new_price
+                    self._lower(from_landmark, goal)
+                if to_landmark[goal]+new_price<to_landmark[start]:
+                    to_landmark[start]=to_landmark[goal]+new_price
+                    self._lower(to_landmark, start, reverse=True)
+        return True
+
+    def _keeps_prices(self, source, destination, old_price, new_price,
+                      lowered):
+        # Whether a fare change leaves every cheapest price as it was, in
+        #       which case the hierarchy still answers exactly: a cheaper
+        #       fare that doesn't beat the cheapest price between its
+        #       cities, or a dearer or removed one that wasn't the cheapest
+        #       way between them. One hierarchy query, before the change.
+        start=self.city_ids.get(source)
+        goal=self.city_ids.get(destination)
+        if start is None or goal is None:
+            return False
+        current=self.hierarchy.get_cheapest_price(start, goal)
+        if lowered:
+            return current!=-1 and new_price>=current
+        return old_price is not None and current<old_price
+
+    def _lower(self, distances, city, reverse=False):
+        # distances[city] just went down: carry the drop on to every city
+        #       it makes cheaper, and no further
+        if reverse:
+            offsets, targets, prices=self.reverse_adjacency()
+            added=self.added_into
+        else:
+            offsets=self.offsets
+            targets=self.targets
+            prices=self.prices
+            added=self.added_flights
+        pq=[(distances[city], city)]
+        while pq:
+            price, city=heapq.heappop(pq)
+            if price>distances[city]:
+                continue
+            low=offsets[city]
+            high=offsets[city+1]
+            flights=zip(targets[low:high], prices[low:high])
+            if city in added:
+                flights=chain(flights, added[city].items())
+            for next_city, added_price in flights:
+                new_price=price+added_price
+                if new_price<distances[next_city]:
+                    distances[next_city]=new_price
+                    heapq.heappush(pq, (new_price, next_city))
+
+    def _fits(self, price):
+        # Whether price can be stored without changing the price storage
+        if self.integral:
+            return type(price) is int and \
+                0<=price and price*len(self.cities)<self.NO_PRICE
+        if type(self.prices) is array:
+            return type(price) is float
+        return True
+
+    def search_method(self, method):
+        # The method a query really runs. 'alt' and 'ch' build their index
+        #       on first use, but once fares have been updated a missing
+        #       index is only built by an explicit build_landmarks() or
+        #       build_hierarchy(), so those queries run plain Dijkstra
+        if method not in self.SEARCH_METHODS:
+            raise ValueError(f"Unknown search method {method!r}")
+        if self.updated and (method=='alt' and not self.landmarks or
+                             method=='ch' and self.hierarchy is None):
+            return 'dijkstra'
+        return method
+
+    def get_cheapest_price(self, source, destination, method='dijkstra'):
+        """
+        method is 'dijkstra', 'bidirectional', 'alt' (A* with landmark
+        lower bounds) or 'ch' (contraction hierarchy); all of them return
+        the same price. The number of cities each search settled is left in
+        last_settled.
+        """
+        method=self.search_method(method)
+        self.last_settled=0
+        if source==destination:
+            return 0
+        start=self.city_ids.get(source)
+        goal=self.city_ids.get(destination)
+        if start is None or goal is None:
+            return -1
+        if method=='bidirectional':
+            return self._bidirectional(start, goal)
+        if method=='alt':
+            if not self.landmarks:
+                self.build_landmarks()
+            return self._alt(start, goal)
+        if method=='ch':
+            if self.hierarchy is None:
+                self.build_hierarchy()
+            price=self.hierarchy.get_cheapest_price(start, goal)
+            self.last_settled=self.hierarchy.last_settled
+            return price
+        # Int fares always get a bucket ring; the heap is for the rest
+        if self.bucket_ring is not None:
+            return self._dial(start, goal)
+
+        offsets=self.offsets
+        targets=self.targets
+        prices=self.prices
+        added=self.added_flights
+        distances=self.new_distances()
+        distances[start]=0
+        pq=[(0, start)]
+        while pq:
+            price, city=heapq.heappop(pq)
+            # Skip stale entries left behind by a later relaxation
+            if price>distances[city]:
+                continue
+            self.last_settled+=1
+            if city==goal:
+                return price
+            low=offsets[city]
+            high=offsets[city+1]
+            flights=zip(targets[low:high], prices[low:high])
+            if city in added:
+                flights=chain(flights, added[city].items())
+            for next_city, added_price in flights:
+                new_price=price+added_price
+                if new_price<distances[next_city]:
+                    distances[next_city]=new_price
+                    heapq.heappush(pq, (new_price, next_city))
+        return -1
+
+    def _dial(self, start, goal=None, reverse=False):
+        # Dijkstra with Dial's bucket queue. Every queued price is within
+        #       the largest fare of the one being settled, so a ring of
+        #       buckets indexed by price replaces the heap: a push is a list
+        #       append and a pop takes the whole current bucket. Without a
+        #       goal, returns the distances from a full search.
+        size, shift=self.bucket_ring
+        if shift:
+            return self._wide_dial(start, goal, reverse, size, shift)
+        if reverse:
+            offsets, targets, prices=self.reverse_adjacency()
+            added=self.added_into
+        else:
+            offsets=self.offsets
+            targets=self.targets
+            prices=self.prices
+            added=self.added_flights
+        distances=self.new_distances()
+        distances[start]=0
+        buckets=[[] for _ in range(size)]
+        buckets[0].append(start)
+        price=0
+        index=0
+        # A full turn of empty buckets means nothing is left
+        idle=0
+        settled=0
+        while idle<size:
+            bucket=buckets[index]
+            if bucket:
+                idle=0
+            else:
+                idle+=1
+            while bucket:
+                city=bucket.pop()
+                if distances[city]!=price:
+                    continue
+                settled+=1
+                if city==goal:
+                    self.last_settled+=settled
+                    return price
+                low=offsets[city]
+                high=offsets[city+1]
+                flights=zip(targets[low:high], prices[low:high])
+                if city in added:
+                    flights=chain(flights, added[city].items())
+                for next_city, added_price in flights:
+                    new_price=price+added_price
+                    if new_price<distances[next_city]:
+                        distances[next_city]=new_price
+                        buckets[new_price%size].append(next_city)
+            price+=1
+            index+=1
+            if index==size:
+                index=0
+        if goal is None:
+            return distances
+        self.last_settled+=settled
+        return -1
+
+    def _wide_dial(self, start, goal, reverse, size, shift):
+        # The bucket queue for large fares: each bucket holds the prices
+        #       with one value of price>>shift as packed price*N+city ints,
+        #       and only the bucket being settled is ordered, as a heap.
+        #       Pushes into later buckets stay list appends.
+        count=len(self.cities)
+        if reverse:
+            offsets, targets, prices=self.reverse_adjacency()
+            added=self.added_into
+        else:
+            offsets=self.offsets
+            targets=self.targets
+            prices=self.prices
+            added=self.added_flights
+        heappush=heapq.heappush
+        heappop=heapq.heappop
+        distances=self.new_distances()
+        distances[start]=0
+        buckets=[[] for _ in range(size)]
+        buckets[0].append(start)
+        slot=0
+        queued=1
+        settled=0
+        while queued:
+            bucket=buckets[slot%size]
+            heapq.heapify(bucket)
+            while bucket:
+                price, city=divmod(heappop(bucket), count)
+                queued-=1
+                if distances[city]!=price:
+                    continue
+                settled+=1
+                if city==goal:
+                    self.last_settled+=settled
+                    return price
+                low=offsets[city]
+                high=offsets[city+1]
+                flights=zip(targets[low:high], prices[low:high])
+                if city in added:
+                    flights=chain(flights, added[city].items())
+                for next_city, added_price in flights:
+                    new_price=price+added_price
+                    if new_price<distances[next_city]:
+                        distances[next_city]=new_price
+                        queued+=1
+                        if new_price>>shift==slot:
+                            heappush(bucket, new_price*count+next_city)
+                        else:
+                            buckets[(new_price>>shift)%size].append(
+                                new_price*count+next_city)
+            slot+=1
+        if goal is None:
+            return distances
+        self.last_settled+=settled
+        return -1
+
+    def prices_from(self, start, reverse=False):
+        # Full single-source search: the price from start to every city
+        #       (or from every city to start over the reverse adjacency)
+        if self.bucket_ring is not None:
+            return self._dial(start, reverse=reverse)
+        if reverse:
+            offsets, targets, prices=self.reverse_adjacency()
+            added=self.added_into
+        else:
+            offsets=self.offsets
+            targets=self.targets
+            prices=self.prices
+            added=self.added_flights
+        distances=self.new_distances()
+        distances[start]=0
+        # Int fares take the bucket queue, so only the rest get here
+        pq=[(0, start)]
+        while pq:
+            price, city=heapq.heappop(pq)
+            if price>distances[city]:
+                continue
+            low=offsets[city]
+            high=offsets[city+1]
+            flights=zip(targets[low:high], prices[low:high])
+            if city in added:
+                flights=chain(flights, added[city].items())
+            for next_city, added_price in flights:
+                new_price=price+added_price
+                if new_price<distances[next_city]:
+                    distances[next_city]=new_price
+                    heapq.heappush(pq, (new_price, next_city))
+        return distances
+
+    def fare_rows(self, starts, goals):
+        # One full search per start, read off at the goals (-1 if unreached)
+        unreached=self.unreached()
+        rows=[]
+        for start in starts:
+            distances=self.prices_from(start)
+            rows.append([-1 if distances[goal]==unreached else distances[goal]
+                         for goal in goals])
+        return rows
+
+    def _bidirectional(self, start, goal):
+        # Search forward from the start and backward from the goal, always
+        #       growing the side with the cheaper frontier. best is the
+        #       cheapest complete route seen where the two searches touch;
+        #       once the two frontiers together cost at least that much,
+        #       nothing cheaper is left.
+        unreached=self.unreached()
+        forward=self.new_distances()
+        backward=self.new_distances()
+        forward[start]=0
+        backward[goal]=0
+        forward_queue=[(0, start)]
+        backward_queue=[(0, goal)]
+        forward_side=(forward_queue, forward, backward, self.offsets,
+                      self.targets, self.prices, self.added_flights)
+        backward_side=(backward_queue, backward, forward,
+                       *self.reverse_adjacency(), self.added_into)
+        best=unreached
+        while forward_queue and backward_queue:
+            if forward_queue[0][0]+backward_queue[0][0]>=best:
+                break
+            if forward_queue[0][0]<=backward_queue[0][0]:
+                pq, mine, other, offsets, targets, prices, added=forward_side
+            else:
+                pq, mine, other, offsets, targets, prices, added=backward_side
+            price, city=heapq.heappop(pq)
+            if price>mine[city]:
+                continue
+            self.last_settled+=1
+            low=offsets[city]
+            high=offsets[city+1]
+            flights=zip(targets[low:high], prices[low:high])
+            if city in added:
+                flights=chain(flights, added[city].items())
+            for next_city, added_price in flights:
+                new_price=price+added_price
+                if new_price<mine[next_city]:
+                    mine[next_city]=new_price
+                    heapq.heappush(pq, (new_price, next_city))
+                if other[next_city]!=unreached and \
+                        new_price+other[next_city]<best:
+                    best=new_price+other[next_city]
+        return -1 if best==unreached else best
+
+    def build_landmarks(self, count=8, seed=0):
+        """
+        Pick up to count landmark cities (each new one as far as possible
+        from those already picked) and store the price from and to each of
+        them for every city. Costs 2*count full searches and
+        2*count*N stored prices.
+        """
+        unreached=self.unreached()
+        self.landmarks=[]
+        self.landmark_from=[]
+        self.landmark_to=[]
+        if not self.cities:
+            return
+        candidate=random.Random(seed).randrange(len(self.cities))
+        # Distance from each city to the closest landmark picked so far
+        nearest=[unreached]*len(self.cities)
+        for _ in range(min(count, len(self.cities))):
+            from_landmark=self.prices_from(candidate)
+            to_landmark=self.prices_from(candidate, reverse=True)
+            self.landmarks.append(candidate)
+            self.landmark_from.append(self._price_array(from_landmark))
+            self.landmark_to.append(self._price_array(to_landmark))
+
+            candidate=None
+            farthest=-1
+            for city, price in enumerate(from_landmark):
+                if price<nearest[city]:
+                    nearest[city]=price
+                if nearest[city]!=unreached and nearest[city]>farthest and \
+                        city not in self.landmarks:
+                    farthest=nearest[city]
+                    candidate=city
+            if candidate is None:
+                break
+
+    def build_hierarchy(self, witness_limit=100):
+        self.hierarchy=ContractionHierarchy(self, witness_limit)
+        return self.hierarchy
+
+    def _alt(self, start, goal):
+        # A* where the estimate for a city is the best landmark lower bound
+        #       on its price to the goal (triangle inequality), so far fewer
+        #       cities are settled than with plain Dijkstra
+        unreached=self.unreached()
+        bounds=[(from_landmark, to_landmark, from_landmark[goal],
+                 to_landmark[goal])
+                for from_landmark, to_landmark in zip(self.landmark_from,
+                                                      self.landmark_to)]
+        estimates={}
+
+        def estimate(city):
+            if city in estimates:
+                return estimates[city]
+            bound=0
+            for from_landmark, to_landmark, from_goal, to_goal in bounds:
+                from_city=from_landmark[city]
+                to_city=to_landmark[city]
+                if from_city!=unreached:
+                    # The landmark reaches this city but not the goal,
+                    #       so this city can't reach the goal either
+                    if from_goal==unreached:
+                        bound=None
+                        break
+                    if from_goal-from_city>bound:
+                        bound=from_goal-from_city
+                if to_goal!=unreached:
+                    if to_city==unreached:
+                        bound=None
+                        break
+                    if to_city-to_goal>bound:
+                        bound=to_city-to_goal
+            estimates[city]=bound
+            return bound
+
+        offsets=self.offsets
+        targets=self.targets
+        prices=self.prices
+        added=self.added_flights
+        distances=self.new_distances()
+        distances[start]=0
+        start_estimate=estimate(start)
+        if start_estimate is None:
+            return -1
+        pq=[(start_estimate, 0, start)]
+        while pq:
+            _, price, city=heapq.heappop(pq)
+            if price>distances[city]:
+                continue
+            self.last_settled+=1
+            if city==goal:
+                return price
+            low=offsets[city]
+            high=offsets[city+1]
+            flights=zip(targets[low:high], prices[low:high])
+            if city in added:
+                flights=chain(flights, added[city].items())
+            for next_city, added_price in flights:
+                new_price=price+added_price
+                if new_price<distances[next_city]:
+                    next_estimate=estimate(next_city)
+                    if next_estimate is None:
+                        continue
+                    distances[next_city]=new_price
+                    heapq.heappush(pq, (new_price+next_estimate, new_price,
+                                        next_city))
+        return -1
+
+
+class ContractionHierarchy:
+    """
+    Contraction-hierarchy index over a CompactFlightGraph.
+
+    Cities are contracted one at a time, cheapest first by edge difference
+    (shortcuts added minus flights removed) plus the number of contracted
+    neighbours and the city's level, with lazy priority updates. Contracting
+    a city adds a shortcut u->w for each u->city->w route unless a witness
+    search finds a route from u to w at least as cheap that avoids the city.
+    The witness search settles at most witness_limit cities, so a missed
+    witness only costs an unneeded shortcut, never a wrong price.
+
+    A query is a bidirectional Dijkstra that only climbs: forward from the
+    source over flights to higher-ranked cities and backward from the
+    destination over flights from higher-ranked cities, skipping cities
+    that a higher one already reaches more cheaply (stall on demand). stats
+    holds the preprocessing time and the index size.
+    """
+    def __init__(self, graph, witness_limit=100):
+        started=time.perf_counter()
+        self.witness_limit=witness_limit
+        count=len(graph)
+        unreached=graph.unreached()
+
+        # Remaining graph as dicts, dropping self loops and removed routes
+        outgoing=[{} for _ in range(count)]
+        incoming=[{} for _ in range(count)]
+        for city in range(count):
+            for next_city, price in graph.flights_from(city):
+                if next_city!=city and price!=unreached:
+                    outgoing[city][next_city]=price
+                    incoming[next_city][city]=price
+
+        self.rank=array('q', bytes(8*count))
+        upward=[None]*count
+        downward=[None]*count
+        contracted_neighbours=[0]*count
+        level=[0]*count
+        shortcut_count=0
+
+        def priority(city, shortcuts):
+            # Edge difference, weighted, plus terms that spread the
+            #       contractions evenly over the graph
+            return 2*(len(shortcuts)-len(outgoing[city])-len(incoming[city]))+\
+                contracted_neighbours[city]+level[city]
+
+        pq=[(priority(city, self._shortcuts(city, outgoing, incoming)), city)
+            for city in range(count)]
+        heapq.heapify(pq)
+
+        order=0
+        while pq:
+            _, city=heapq.heappop(pq)
+            # Lazy update: recheck this city's priority against the rest
+            shortcuts=self._shortcuts(city, outgoing, incoming)
+            value=priority(city, shortcuts)
+            if pq and value>pq[0][0]:
+                heapq.heappush(pq, (value, city))
+                continue
+
+            self.rank[city]=order
+            order+=1
+            # Everything still attached to the city ranks above it
+            upward[city]=outgoing[city]
+            downward[city]=incoming[city]
+            neighbours=set(outgoing[city])
+            neighbours.update(incoming[city])
+            for next_city in outgoing[city]:
+                del incoming[next_city][city]
+            for previous_city in incoming[city]:
+                del outgoing[previous_city][city]
+            for previous_city, next_city, price in shortcuts:
+                if price<outgoing[previous_city].get(next_city, math.inf):
+                    outgoing[previous_city][next_city]=price
+                    incoming[next_city][previous_city]=price
+                    shortcut_count+=1
+            for neighbour in neighbours:
+                contracted_neighbours[neighbour]+=1
+                level[neighbour]=max(level[neighbour], level[city]+1)
+
+        self.up_offsets, self.up_targets, self.up_prices=\
+            self._pack(graph, upward)
+        self.down_offsets, self.down_targets, self.down_prices=\
+            self._pack(graph, downward)
+        self.last_settled=0
+        self.stats={
+            'preprocess_seconds': time.perf_counter()-started,
+            'shortcuts': shortcut_count,
+            'edges': len(self.up_targets)+len(self.down_targets),
+            # Price lists (mixed int/float fares) are counted at 8 bytes
+            'index_bytes': sum(len(part)*getattr(part, 'itemsize', 8)
+                               for part in (self.rank, self.up_offsets,
+                                            self.up_targets, self.up_prices,
+                                            self.down_offsets,
+                                            self.down_targets,
+                                            self.down_prices)),
+        }
+
+    def _shortcuts(self, city, outgoing, incoming):
+        # (from, to, price) shortcuts that contracting city would need
+        shortcuts=[]
+        out=outgoing[city]
+        if not out:
+            return shortcuts
+        highest_out=max(out.values())
+        for previous_city, in_price in incoming[city].items():
+            limit=in_price+highest_out
+            distances={previous_city: 0}
+            pq=[(0, previous_city)]
+            settled=0
+            # Stop early once every out-neighbour has been settled
+            waiting=len(out)-(previous_city in out)
+            while pq and settled<self.witness_limit and waiting:
+                price, witness=heapq.heappop(pq)
+                if price>limit:
+                    break
+                if price>distances[witness]:
+                    continue
+                settled+=1
+                if witness in out and witness!=previous_city:
+                    waiting-=1
+                for next_city, added_price in outgoing[witness].items():
+                    if next_city==city:
+                        continue
+                    new_price=price+added_price
+                    if new_price<distances.get(next_city, math.inf):
+                        distances[next_city]=new_price
+                        heapq.heappush(pq, (new_price, next_city))
+            for next_city, out_price in out.items():
+                if next_city!=previous_city and \
+                        distances.get(next_city, math.inf)>in_price+out_price:
+                    shortcuts.append((previous_city, next_city,
+                                      in_price+out_price))
+        return shortcuts
+
+    @staticmethod
+    def _pack(graph, adjacency):
+        offsets=array('q', [0])
+        targets=array('q')
+        prices=[]
+        for edges in adjacency:
+            targets.extend(edges)
+            prices.extend(edges.values())
+            offsets.append(len(targets))
+        return offsets, targets, graph._price_array(prices)
+
+    def get_cheapest_price(self, start, goal):
+        self.last_settled=0
+        forward={start: 0}
+        backward={goal: 0}
+        forward_queue=[(0, start)]
+        backward_queue=[(0, goal)]
+        up=(self.up_offsets, self.up_targets, self.up_prices)
+        down=(self.down_offsets, self.down_targets, self.down_prices)
+        forward_side=(forward_queue, forward, backward, up, down)
+        backward_side=(backward_queue, backward, forward, down, up)
+        best=math.inf
+        while True:
+            # A side is finished once its frontier costs at least best
+            if forward_queue and forward_queue[0][0]<best and \
+                    (not backward_queue or backward_queue[0][0]>=best or
+                     forward_queue[0][0]<=backward_queue[0][0]):
+                pq, mine, other, climb, stall=forward_side
+            elif backward_queue and backward_queue[0][0]<best:
+                pq, mine, other, climb, stall=backward_side
+            else:
+                break
+            price, city=heapq.heappop(pq)
+            if price>mine[city]:
+                continue
+            self.last_settled+=1
+            if city in other and price+other[city]<best:
+                best=price+other[city]
+
+            # Stall on demand: if a higher city reached by this search
+            #       already has a cheaper way down to this one, this city
+            #       isn't on a shortest climbing route, so don't expand it
+            offsets, targets, prices=stall
+            stalled=False
+            for higher_city, added_price in zip(
+                    targets[offsets[city]:offsets[city+1]],
+                    prices[offsets[city]:offsets[city+1]]):
+                if mine.get(higher_city, math.inf)+added_price<price:
+                    stalled=True
+                    break
+            if stalled:
+                continue
+
+            offsets, targets, prices=climb
+            low=offsets[city]
+            high=offsets[city+1]
+            for next_city, added_price in zip(targets[low:high],
+                                              prices[low:high]):
+                new_price=price+added_price
+                if new_price<mine.get(next_city, math.inf):
+                    mine[next_city]=new_price
+                    heapq.heappush(pq, (new_price, next_city))
+        return -1 if best==math.inf else best
+
+
+class ShortestPathTree:
+    """
+    Dijkstra search from one origin that can be paused and resumed.
+
+    price_to() settles cities until the destination is settled and then
+    stops with the queue intact, so asking for a farther city carries on
+    from there. flights_from(city) gives (destination, price) pairs. With
+    bucket_ring set to (buckets, shift), every fare is a non-negative int
+    and a ring of Dial buckets replaces the heap (see
+    CompactFlightGraph.ring_for).
+    """
+    def __init__(self, origin, flights_from, unreached=math.inf,
+                 bucket_ring=None):
+        self.flights_from=flights_from
+        self.unreached=unreached
+        self.prices={origin: 0}
+        self.settled=set()
+        # Price of the last city settled; nothing settled costs more
+        self.frontier=0
+        if bucket_ring is not None:
+            size, self.shift=bucket_ring
+            self.buckets=[[] for _ in range(size)]
+            # Wide buckets hold (price, city) pairs, one-price ones cities
+            self.buckets[0].append((0, origin) if self.shift else origin)
+            self.queued=1
+        else:
+            self.buckets=None
+            self.pq=[(0, origin)]
+        self.last_settled=0
+
+    def __len__(self):
+        # Cities held, counted against the cache limit
+        if self.buckets is not None:
+            return len(self.prices)+self.queued
+        return len(self.prices)+len(self.pq)
+
+    def price_to(self, destination):
+        self.last_settled=0
+        if destination in self.settled:
+            return self.prices[destination]
+        if self.buckets is not None:
+            if self.shift:
+                return self._resume_wide(destination)
+            return self._resume_buckets(destination)
+
+        prices=self.prices
+        settled=self.settled
+        pq=self.pq
+        unreached=self.unreached
+        while pq:
+            price, city=heapq.heappop(pq)
+            if city in settled:
+                continue
+            settled.add(city)
+            self.frontier=price
+            self.last_settled+=1
+            # Expand before stopping so the saved state can be resumed
+            for next_city, added_price in self.flights_from(city):
+                new_price=price+added_price
+                if new_price<prices.get(next_city, unreached) and \
+                        next_city not in settled:
+                    prices[next_city]=new_price
+                    heapq.heappush(pq, (new_price, next_city))
+            if city==destination:
+                return price
+        return -1
+
+    def _resume_buckets(self, destination):
+        # Fares are non-negative here, so a settled city is never improved
+        prices=self.prices
+        settled=self.settled
+        buckets=self.buckets
+        size=len(buckets)
+        unreached=self.unreached
+        flights_from=self.flights_from
+        price=self.frontier
+        queued=self.queued
+        while queued:
+            bucket=buckets[price%size]
+            while bucket:
+                city=bucket.pop()
+                queued-=1
+                if prices[city]!=price:
+                    continue
+                settled.add(city)
+                self.last_settled+=1
+                for next_city, added_price in flights_from(city):
+                    new_price=price+added_price
+                    if new_price<prices.get(next_city, unreached):
+                        prices[next_city]=new_price
+                        buckets[new_price%size].append(next_city)
+                        queued+=1
+                if city==destination:
+                    self.frontier=price
+                    self.queued=queued
+                    return price
+            price+=1
+        self.frontier=price
+        self.queued=queued
+        return -1
+
+    def _resume_wide(self, destination):
+        # Buckets of 2**shift prices; the one being settled is a heap, put
+        #       back in order here after a pause or a repair
+        prices=self.prices
+        settled=self.settled
+        buckets=self.buckets
+        size=len(buckets)
+        shift=self.shift
+        unreached=self.unreached
+        flights_from=self.flights_from
+        heappush=heapq.heappush
+        heappop=heapq.heappop
+        slot=self.frontier>>shift
+        queued=self.queued
+        while queued:
+            bucket=buckets[slot%size]
+            heapq.heapify(bucket)
+            while bucket:
+                price, city=heappop(bucket)
+                queued-=1
+                if prices[city]!=price:
+                    continue
+                settled.add(city)
+                self.frontier=price
+                self.last_settled+=1
+                for next_city, added_price in flights_from(city):
+                    new_price=price+added_price
+                    if new_price<prices.get(next_city, unreached):
+                        prices[next_city]=new_price
+                        queued+=1
+                        if new_price>>shift==slot:
+                            heappush(bucket, (new_price, next_city))
+                        else:
+                            buckets[(new_price>>shift)%size].append(
+                                (new_price, next_city))
+                if city==destination:
+                    self.queued=queued
+                    return price
+            slot+=1
+        self.queued=queued
+        return -1
+
+    def repair(self, source, destination, old_price, new_price):
+        """
+        Update the tree for a new cheapest fare on one route (None for no
+        route). Returns False if the tree has to be thrown away.
+        """
+        # The bucket ring only holds non-negative int fares up to the
+        #       largest one it was sized for
+        if self.buckets is not None and new_price is not None and \
+                (type(new_price) is not int or new_price<0 or
+                 new_price>>self.shift>len(self.buckets)-2):
+            return False
+        # A route out of an unexpanded city hasn't been used yet
+        if source not in self.settled:
+            return True
+        if new_price is None or old_price is not None and \
+                new_price>old_price:
+            # Fine unless this route may have set the destination's price
+            return old_price is None or \
+                self.prices.get(destination)!=self.prices[source]+old_price
+        new_price=self.prices[source]+new_price
+        if new_price>=self.prices.get(destination, self.unreached):
+            return True
+        # Cities settled beyond the new price might now be reached more
+        #       cheaply through it
+        if destination in self.settled or new_price<self.frontier:
+            return False
+        # Beyond everything settled, so it can simply be relaxed again
+        self.prices[destination]=new_price
+        if self.buckets is not None:
+            shift=self.shift
+            self.buckets[(new_price>>shift)%len(self.buckets)].append(
+                (new_price, destination) if shift else destination)
+            self.queued+=1
+            return True
+        heapq.heappush(self.pq, (new_price, destination))
+        return True
+
+
+# Frozen graph for fare matrix workers, set once per worker process
+_worker_graph=None
+
+
+def _set_worker_graph(graph):
+    global _worker_graph
+    _worker_graph=graph
+
+
+def _worker_fare_rows(starts, goals):
+    return _worker_graph.fare_rows(starts, goals)
+
+
 class AlgoJet:
-    def __init__(self):
-        self.graph = {}  # Recommended graph is {city: {destination : best_price}}
+    def __init__(self, cache_limit=1000000):
+        self._graph = {}  # Recommended graph is {city: {destination : best_price}}
+        # CompactFlightGraph once the graph is frozen. It then owns the
+        #       topology, and _graph is None until graph is read again.
+        self.compact = None
+        self.last_settled = 0  # Cities settled by the last query
+        self.cache_limit = cache_limit  # Cities kept across cached trees
+        self.trees = OrderedDict()  # {origin: ShortestPathTree}, LRU first
+        self.cache_size = 0
+        self.parallel_fares = {}  # {(source, destination): [every fare]}
+        # [fares that aren't non-negative ints, largest int fare] on the
+        #       dict graph, counted when its first tree is built
+        self._fare_stats = None
+
+    @property
+    def graph(self):
+        # {city: {destination: best_price}}. A frozen jet rebuilds it from
+        #       the packed graph on first read and keeps it in step with
+        #       fare updates until the next freeze.
+        return self._thaw_graph()
+
+    def freeze_graph(self):
+        # Queries and fare updates run on the packed graph from now on, and
+        #       the dict graph is dropped
+        self.compact=CompactFlightGraph(self._thaw_graph())
+        self._graph=None
+        self._fare_stats=None
+        self.clear_cache()
+        return self.compact
 
-    def initialize_flight_graph(self, flights: list[Flight]):
+    def _thaw_graph(self):
+        # The dict graph, rebuilt from the frozen one if it was dropped
+        if self._graph is None:
+            self._graph=self.compact.to_dict()
+            self._fare_stats=None
+        return self._graph
+
+    def _bucket_ring(self):
+        # Bucket ring for trees over the dict graph, None unless every fare
+        #       is a non-negative int
+        if self._fare_stats is None:
+            is_odd=CompactFlightGraph._is_odd
+            prices=[price for flights in self._graph.values()
+                    for price in flights.values()]
+            self._fare_stats=[sum(map(is_odd, prices)),
+                              max((price for price in prices
+                                   if not is_odd(price)), default=0)]
+        odd_prices, max_price=self._fare_stats
+        if odd_prices:
+            return None
+        return CompactFlightGraph.ring_for(max_price)
+
+    def clear_cache(self):
+        self.trees.clear()
+        self.cache_size=0
+
+    def initialize_flight_graph(self, flights: list[Flight], freeze=False,
+                                landmarks=0, contract=False):
+        self._thaw_graph()
+        self._fare_stats=None
         for flight in flights:
 
             source=flight.source
@@ -60,26 +1287,152 @@ class AlgoJet:
             price=flight.price
 
             # Add source to city list if needed
-            if source not in self.graph:
-                self.graph[source]=dict()
+            if source not in self._graph:
+                self._graph[source]=dict()
 
             # Add destination to city list if needed
-            if destination not in self.graph:
-                self.graph[destination]=dict()
+            if destination not in self._graph:
+                self._graph[destination]=dict()
 
             # Add price if it's the first time we've seen this flight
-            if destination not in self.graph[source]:
-                self.graph[source][destination]=price
+            if destination not in self._graph[source]:
+                self._graph[source][destination]=price
+                continue
+
+            # Keep every fare on routes with more than one, for updates
+            fares=self.parallel_fares.get((source, destination))
+            if fares is None:
+                self.parallel_fares[(source, destination)]=\
+                    [self._graph[source][destination], price]
+            else:
+                fares.append(price)
 
             # Update the price if the new one is lower than the existing one
-            elif price<self.graph[source][destination]:
-                self.graph[source][destination]=price
+            if price<self._graph[source][destination]:
+                self._graph[source][destination]=price
+
+        self.compact=None
+        self.clear_cache()
+        if freeze or landmarks or contract:
+            self.freeze_graph()
+        if landmarks:
+            self.compact.build_landmarks(landmarks)
+        if contract:
+            self.compact.build_hierarchy()
 
 
+    def add_flight(self, flight: Flight):
+        self._update_fares(flight.source, flight.destination,
+                           added=flight.price)
+
+    def remove_flight(self, flight: Flight):
+        # Removes one fare matching the flight's route and price
+        self._update_fares(flight.source, flight.destination,
+                           removed=flight.price)
+
+    def change_price(self, flight: Flight, new_price):
+        self._update_fares(flight.source, flight.destination,
+                           removed=flight.price, added=new_price)
+
+    def _update_fares(self, source, destination, removed=None, added=None):
+        if self.compact is not None:
+            old_price=self.compact.price(source, destination)
+        else:
+            old_price=self._graph.get(source, {}).get(destination)
+        fares=self.parallel_fares.get((source, destination))
+        if fares is None:
+            fares=[] if old_price is None else [old_price]
+        if removed is not None and removed not in fares:
+            raise KeyError((source, destination, removed))
+
+        if removed is not None:
+            fares.remove(removed)
+        if added is not None:
+            fares.append(added)
+        if len(fares)>1:
+            self.parallel_fares[(source, destination)]=fares
+        else:
+            self.parallel_fares.pop((source, destination), None)
+
+        # The graph only sees the cheapest fare on each route
+        new_price=min(fares) if fares else None
+        if added is not None and self.compact is None:
+            for city in (source, destination):
+                if city not in self._graph:
+                    self._graph[city]=dict()
+        if new_price==old_price:
+            return
+
+        if self.compact is None:
+            self._set_route(source, destination, new_price)
+        else:
+            new_city=source not in self.compact.city_ids or \
+                destination not in self.compact.city_ids
+            if not self.compact.update_route(source, destination, old_price,
+                                             new_price):
+                # The fare needs other price storage: freeze again from the
+                #       dict graph. The indexes are gone too, and aren't
+                #       rebuilt by queries.
+                self._thaw_graph()
+                self._set_route(source, destination, new_price)
+                self.freeze_graph().updated=True
+                return
+            # A dict graph read back from the frozen one follows it
+            if self._graph is not None:
+                self._set_route(source, destination, new_price)
+            # Packed heap entries depend on the number of cities
+            if new_city:
+                self.clear_cache()
+                return
+            source=self.compact.city_ids[source]
+            destination=self.compact.city_ids[destination]
+
+        # Only the cached trees that used or could use this route change
+        for origin, tree in list(self.trees.items()):
+            self.cache_size-=len(tree)
+            if tree.repair(source, destination, old_price, new_price):
+                self.cache_size+=len(tree)
+            else:
+                del self.trees[origin]
+
+    def _set_route(self, source, destination, price):
+        # Cheapest fare on one route of the dict graph, None for no route
+        for city in (source, destination):
+            if city not in self._graph:
+                self._graph[city]=dict()
+        stats=self._fare_stats
+        if stats is not None:
+            is_odd=CompactFlightGraph._is_odd
+            old_price=self._graph[source].get(destination)
+            stats[0]+=is_odd(price)-is_odd(old_price)
+            if price is not None and not is_odd(price):
+                stats[1]=max(stats[1], price)
+        if price is None:
+            del self._graph[source][destination]
+        else:
+            self._graph[source][destination]=price
+
+    def get_cheapest_flight(self, source, destination, method='dijkstra'):
+        if method not in CompactFlightGraph.SEARCH_METHODS:
+            raise ValueError(f"Unknown search method {method!r}")
+        # The other search methods need the frozen graph, so freeze it the
+        #       first time one of them is asked for
+        if method!='dijkstra' and self.compact is None:
+            self.freeze_graph()
+        # An index dropped by a fare update leaves its queries to the
+        #       cached trees until it is built again
+        if self.compact is not None:
+            method=self.compact.search_method(method)
+        if method=='dijkstra' and self.cache_limit:
+            return self._get_cached_price(source, destination)
+        if self.compact is not None:
+            price=self.compact.get_cheapest_price(source, destination, method)
+            self.last_settled=self.compact.last_settled
+            return price
+        self.last_settled=0
 
-    def get_cheapest_flight(self, source, destination):
         # Initialize distance to each city as infinity
-        distances = {city: math.inf for city in self.graph.keys()}
+        distances = {city: math.inf for city in self._graph.keys()}
         # The distance to the source city is 0 since you are already there
         distances[source] = 0
         # Initialize a priority queue with key 0 (distance to city) and source (city to process)
@@ -92,13 +1445,14 @@ class AlgoJet:
 
             # Process lowest price option available
             price, city = heapq.heappop(pq)
+            self.last_settled+=1
 
             # No need to keep going if we already know the relevant price
             if city==destination:
                 return distances[destination]
 
             # Examine every place you can get to from current city
-            for next_city, added_price in self.graph[city].items():
+            for next_city, added_price in self._graph[city].items():
                 new_price=price+added_price
                 # Compare and relax if needed
                 if new_price<distances[next_city]:
@@ -109,6 +1463,93 @@ class AlgoJet:
         # If we made it this far, then there is no path that works
         return -1
 
+    def _get_cached_price(self, source, destination):
+        self.last_settled=0
+        if source==destination:
+            return 0
+        if self.compact is not None:
+            source=self.compact.city_ids.get(source)
+            destination=self.compact.city_ids.get(destination)
+            if source is None or destination is None:
+                return -1
+        elif source not in self._graph or destination not in self._graph:
+            return -1
+
+        tree=self.trees.get(source)
+        if tree is None:
+            if self.compact is None:
+                tree=ShortestPathTree(source, self._flights_from,
+                                      bucket_ring=self._bucket_ring())
+            else:
+                tree=ShortestPathTree(source, self.compact.flights_from,
+                                      self.compact.unreached(),
+                                      self.compact.bucket_ring)
+            self.trees[source]=tree
+        else:
+            self.cache_size-=len(tree)
+            self.trees.move_to_end(source)
+
+        price=tree.price_to(destination)
+        self.last_settled=tree.last_settled
+        self.cache_size+=len(tree)
+        # Evict the least recently used trees (this one last, if it alone
+        #       is over the limit)
+        while self.cache_size>self.cache_limit:
+            _, evicted=self.trees.popitem(last=False)
+            self.cache_size-=len(evicted)
+        return price
+
+    def _flights_from(self, city):
+        return self._graph[city].items()
+
+    def get_fare_matrix(self, sources, destinations, processes=None):
+        """
+        Cheapest price from every source to every destination, -1 where
+        there is no route. Returns a NumPy array (int64 when every fare is
+        an int, else float64) or, without NumPy, a list of rows. processes
+        defaults to one per CPU; 1 runs everything in this process.
+        """
+        if self.compact is None:
+            self.freeze_graph()
+        graph=self.compact
+        goals=[graph.city_ids.get(destination, -1)
+               for destination in destinations]
+        known_goals=[goal for goal in goals if goal>=0]
+        starts=list(dict.fromkeys(graph.city_ids[source]
+                                  for source in sources
+                                  if source in graph.city_ids))
+
+        processes=min(processes or os.cpu_count() or 1, len(starts))
+        if processes<=1:
+            rows=graph.fare_rows(starts, known_goals)
+        else:
+            # A few chunks per worker keeps them busy if searches vary
+            chunk=-(-len(starts)//(processes*4))
+            chunks=[starts[i:i+chunk] for i in range(0, len(starts), chunk)]
+            with multiprocessing.get_context().Pool(
+                    processes, _set_worker_graph, (graph,)) as pool:
+                rows=[]
+                for part in pool.starmap(_worker_fare_rows,
+                                         [(part, known_goals)
+                                          for part in chunks]):
+                    rows.extend(part)
+        row_of=dict(zip(starts, rows))
+
+        # Unknown cities get -1 everywhere (0 to themselves)
+        column_of={goal: i for i, goal in enumerate(known_goals)}
+        matrix=[]
+        for source in sources:
+            start=graph.city_ids.get(source)
+            row=row_of.get(start)
+            matrix.append([0 if source==destination else
+                           -1 if row is None or goal<0 else
+                           row[column_of[goal]]
+                           for destination, goal in zip(destinations, goals)])
+        if np is None:
+            return matrix
+        return np.array(matrix, dtype=np.int64 if graph.integral else
+                        np.float64).reshape(len(sources), len(destinations))
+
 
 class TestAlgoFlights:
     def run_unit_tests(self):
@@ -0,0 +1,496 @@
+"""
+Tests for algo_book beyond the in-file suite, run with pytest.
+"""
+
+import json
+import random
+import tracemalloc
+
+import pytest
+
+import algo_book
+from algo_book import AlgoBookOrganization, CompactOrganization, Employee
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def sample_employees():
+    return [
+        Employee(1, None, 1000),
+        Employee(2, 1, 500),
+        Employee(3, 1, 600),
+        Employee(4, 2, 200),
+        Employee(5, 2, 300),
+        Employee(6, 3, 400),
+        Employee(7, 3, 200),
+        Employee(8, 4, 100),
+        Employee(9, 4, 100),
+        Employee(10, 4, 100),
+    ]
+
+
+@pytest.mark.skipif(np is None, reason="needs numpy")
+def test_compact_accepts_numpy_ids():
+    organization=CompactOrganization(sample_employees())
+    for employee_id in range(1, 11):
+        expected=organization.get_org_budget(employee_id)
+        assert organization.get_org_budget(np.int64(employee_id))==expected
+        assert organization.get_org_budget(np.uint16(employee_id))==expected
+    assert sorted(organization.get_reports(np.int32(2)))==[4, 5]
+    assert organization.get_org_budget(1.0)==0
+    assert organization.get_org_budget('1')==0
+
+
+def test_snapshot_round_trip(tmp_path):
+    organization=CompactOrganization(sample_employees())
+    path=str(tmp_path/'org.snapshot')
+    organization.save_snapshot(path)
+    loaded=CompactOrganization.load_snapshot(path)
+    try:
+        for employee_id in range(0, 12):
+            assert loaded.get_org_budget(employee_id)== \
+                organization.get_org_budget(employee_id)
+    finally:
+        loaded.close()
+
+
+def test_snapshot_replaces_mapped_file(tmp_path):
+    # Saving over a snapshot that is still mapped leaves the mapped copy
+    #       readable and the new file complete
+    path=str(tmp_path/'org.snapshot')
+    CompactOrganization(sample_employees()).save_snapshot(path)
+    old=CompactOrganization.load_snapshot(path)
+    employees=sample_employees()
+    employees[0]=Employee(1, None, 5000)
+    CompactOrganization(employees).save_snapshot(path)
+    new=CompactOrganization.load_snapshot(path)
+    try:
+        assert old.get_org_budget(1)==3500
+        assert new.get_org_budget(1)==7500
+    finally:
+        old.close()
+        new.close()
+    assert not (tmp_path/'org.snapshot.tmp').exists()
+
+
+def test_failed_snapshot_keeps_old_file(tmp_path, monkeypatch):
+    path=str(tmp_path/'org.snapshot')
+    CompactOrganization(sample_employees()).save_snapshot(path)
+
+    def fail(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(algo_book.os, 'fsync', fail)
+    employees=sample_employees()
+    employees[0]=Employee(1, None, 5000)
+    with pytest.raises(OSError):
+        CompactOrganization(employees).save_snapshot(path)
+    assert not (tmp_path/'org.snapshot.tmp').exists()
+    monkeypatch.undo()
+    loaded=CompactOrganization.load_snapshot(path)
+    try:
+        assert loaded.get_org_budget(1)==3500
+    finally:
+        loaded.close()
+
+
+def random_employees(count, seed):
+    rng=random.Random(seed)
+    employees=[Employee(0, None, rng.randint(0, 100))]
+    for employee_id in range(1, count):
+        employees.append(Employee(employee_id, rng.randrange(employee_id),
+                                  rng.randint(0, 100)))
+    rng.shuffle(employees)
+    return employees
+
+
+def brute_force_budget(employees, employee_id, depth=None):
+    # Walk the org from the manager the employee resolves to
+    reports={}
+    budget={}
+    manager_of={}
+    for employee in employees:
+        budget[employee.employee_id]=employee.budget
+        manager_of[employee.employee_id]=employee.manager_id
+        reports.setdefault(employee.manager_id, []).append(employee.employee_id)
+    if employee_id not in budget:
+        return 0
+    if employee_id not in reports and manager_of[employee_id] is not None:
+        employee_id=manager_of[employee_id]
+    total=0
+    stack=[(employee_id, 0)]
+    while stack:
+        current, level=stack.pop()
+        if depth is not None and level>depth:
+            continue
+        total+=budget[current]
+        stack.extend((report, level+1) for report in reports.get(current, ()))
+    return total
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_budget_to_depth_matches_brute_force(seed):
+    employees=random_employees(300, seed)
+    index=AlgoBookOrganization(employees).analytics()
+    rng=random.Random(seed)
+    for _ in range(200):
+        employee_id=rng.randrange(-1, 301)
+        depth=rng.randrange(-1, 12)
+        expected=brute_force_budget(employees, employee_id, depth) \
+            if depth>=0 else 0
+        assert index.get_org_budget_to_depth(employee_id, depth)==expected
+
+
+def live_budgets(organization, employee_ids):
+    return [organization.get_org_budget(employee_id)
+            for employee_id in employee_ids]
+
+
+def random_reorg(organization, rng, next_id):
+    # One random hire, termination, move or budget change; returns the
+    #       next unused employee id
+    employee_ids=list(organization.node_map)
+    action=rng.randrange(4)
+    if action==0:
+        organization.add_employee(Employee(next_id, rng.choice(employee_ids),
+                                           rng.randint(0, 100)))
+        return next_id+1
+    employee_id=rng.choice(employee_ids)
+    if action==1 and employee_id!=organization.org_head.id:
+        organization.remove_employee(employee_id)
+    elif action==2 and employee_id!=organization.org_head.id:
+        new_manager_id=rng.choice(employee_ids)
+        try:
+            organization.move_subtree(employee_id, new_manager_id)
+        except ValueError:
+            pass
+    else:
+        organization.set_budget(employee_id, rng.randint(0, 100))
+    return next_id
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_versions_match_history(seed):
+    rng=random.Random(seed)
+    organization=AlgoBookOrganization(random_employees(60, seed),
+                                      versioned=True)
+    probe=list(range(-1, 120))
+    history={organization.version: live_budgets(organization, probe)}
+    next_id=60
+    for _ in range(150):
+        next_id=random_reorg(organization, rng, next_id)
+        history[organization.version]=live_budgets(organization, probe)
+        # The live tree must agree with a walk over the current employees
+        employees=[Employee(node.id, node.manager_id, node.budget)
+                   for node in organization.node_map.values()]
+        employee_id=rng.choice(probe)
+        assert organization.get_org_budget(employee_id)== \
+            brute_force_budget(employees, employee_id)
+    for version, budgets in history.items():
+        assert [organization.get_org_budget(employee_id, as_of=version)
+                for employee_id in probe]==budgets
+
+
+def test_reorg_versions_share_structure():
+    # Moves used to copy the whole organization into a new version
+    employees=random_employees(100000, 7)
+    organization=AlgoBookOrganization(employees, versioned=True)
+    managers=[employee_id for employee_id, node
+              in organization.node_map.items()
+              if node.is_manager and node.manager_node is not None]
+    rng=random.Random(7)
+    # The first reorg builds the live Euler tour index; only measure what
+    #       the versions add after that
+    organization.set_budget(managers[0], 1)
+    organization._get_tour()
+    tracemalloc.start()
+    before=tracemalloc.get_traced_memory()[0]
+    for _ in range(20):
+        employee_id=rng.choice(managers)
+        new_manager_id=rng.choice(managers)
+        try:
+            organization.move_subtree(employee_id, new_manager_id)
+        except ValueError:
+            pass
+        organization.set_budget(rng.choice(managers), 5)
+    grown=tracemalloc.get_traced_memory()[0]-before
+    tracemalloc.stop()
+    assert grown<8*1024*1024
+    ceo_id=organization.org_head.id
+    assert organization.get_org_budget(ceo_id, as_of=0)== \
+        sum(employee.budget for employee in employees)
+    for employee_id in rng.sample(managers, 50):
+        assert organization.get_org_budget(employee_id)== \
+            organization.get_org_budget(employee_id,
+                                        as_of=organization.version)
+
+
+def test_build_reports_unplaced_employees():
+    employees=sample_employees()+[
+        Employee(11, 42, 5),   # orphan
+        Employee(12, 11, 5),   # below the orphan
+        Employee(13, None, 5),  # second root
+        Employee(14, 15, 5), Employee(15, 14, 5),  # cycle
+        Employee(3, 1, 999),   # duplicate
+    ]
+    for organization in (AlgoBookOrganization(employees),
+                         CompactOrganization(employees)):
+        result=organization.build_result
+        assert result.placed==10 and not result.is_complete()
+        assert result.orphans==[11] and result.extra_roots==[13]
+        assert sorted(map(sorted, result.cycles))==[[14, 15]]
+        assert result.detached==[12] and result.duplicates==[3]
+        assert organization.get_org_budget(3)==1200
+        assert organization.get_org_budget(12)==0
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_input_order_and_stores_agree(seed):
+    employees=random_employees(500, seed)
+    expected=[brute_force_budget(employees, employee_id)
+              for employee_id in range(-1, 502)]
+    rng=random.Random(seed)
+    for _ in range(2):
+        rng.shuffle(employees)
+        assert live_budgets(AlgoBookOrganization(employees),
+                            range(-1, 502))==expected
+        compact=CompactOrganization(employees)
+        assert live_budgets(compact, range(-1, 502))==expected
+        for employee_id in rng.sample(range(500), 30):
+            assert sorted(compact.get_reports(employee_id))== \
+                sorted(employee.employee_id for employee in employees
+                       if employee.manager_id==employee_id)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_cached_totals_follow_budget_changes(seed):
+    employees=random_employees(200, seed)
+    organization=AlgoBookOrganization(employees)
+    rng=random.Random(seed)
+    budgets={employee.employee_id: employee for employee in employees}
+    for _ in range(50):
+        employee_id=rng.randrange(200)
+        budget=rng.randint(0, 100)
+        organization.set_budget(employee_id, budget)
+        budgets[employee_id]=Employee(employee_id,
+                                      budgets[employee_id].manager_id, budget)
+        current=list(budgets.values())
+        for probe in rng.sample(range(-1, 201), 20):
+            assert organization.get_org_budget(probe)== \
+                brute_force_budget(current, probe)
+    # Every node's cached total is the sum over its own subtree
+    current=list(budgets.values())
+    for node in organization.node_map.values():
+        if node.is_manager:
+            assert node.org_budget==brute_force_budget(current, node.id)
+        else:
+            assert node.org_budget==node.budget
+    assert organization._tour is None
+
+
+class ShadowOrg:
+    """
+    Plain dict model of an organization, changed the slow obvious way and
+    walked from scratch for every answer.
+    """
+    def __init__(self, employees):
+        self.manager_of={employee.employee_id: employee.manager_id
+                         for employee in employees}
+        self.budget={employee.employee_id: employee.budget
+                     for employee in employees}
+
+    def employees(self):
+        return [Employee(employee_id, manager_id, self.budget[employee_id])
+                for employee_id, manager_id in self.manager_of.items()]
+
+    def reports(self, employee_id):
+        return sorted(report for report, manager_id in self.manager_of.items()
+                      if manager_id==employee_id)
+
+    def inside(self, ancestor_id, employee_id):
+        while employee_id is not None:
+            if employee_id==ancestor_id:
+                return True
+            employee_id=self.manager_of[employee_id]
+        return False
+
+    def remove(self, employee_id):
+        manager_id=self.manager_of.pop(employee_id)
+        del self.budget[employee_id]
+        for report in self.reports(employee_id):
+            self.manager_of[report]=manager_id
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_reorgs_match_brute_force(seed):
+    rng=random.Random(seed)
+    employees=random_employees(80, seed)
+    organization=AlgoBookOrganization(employees)
+    shadow=ShadowOrg(employees)
+    next_id=80
+    for step in range(250):
+        employee_ids=sorted(shadow.manager_of)
+        employee_id=rng.choice(employee_ids)
+        head=organization.org_head.id
+        action=rng.randrange(5)
+        if action==0:
+            manager_id=rng.choice(employee_ids)
+            budget=rng.randint(0, 100)
+            organization.add_employee(Employee(next_id, manager_id, budget))
+            shadow.manager_of[next_id]=manager_id
+            shadow.budget[next_id]=budget
+            next_id+=1
+        elif action==1 and employee_id!=head:
+            organization.remove_employee(employee_id)
+            shadow.remove(employee_id)
+        elif action==2 and employee_id!=head:
+            new_manager_id=rng.choice(employee_ids)
+            if shadow.inside(employee_id, new_manager_id):
+                with pytest.raises(ValueError):
+                    organization.move_subtree(employee_id, new_manager_id)
+            else:
+                organization.move_subtree(employee_id, new_manager_id)
+                shadow.manager_of[employee_id]=new_manager_id
+        else:
+            budget=rng.randint(0, 100)
+            organization.set_budget(employee_id, budget)
+            shadow.budget[employee_id]=budget
+
+        if step%5==0 or rng.random()<0.1:
+            current=shadow.employees()
+            probe=list(shadow.manager_of)+[-1, next_id]
+            expected=[brute_force_budget(current, employee_id)
+                      for employee_id in probe]
+            assert live_budgets(organization, probe)==expected
+            assert organization.get_org_budgets(probe)==expected
+            for employee_id in rng.sample(list(shadow.manager_of), 5):
+                assert sorted(report.id for report in
+                              organization.node_map[employee_id].reports)== \
+                    shadow.reports(employee_id)
+            compact=organization.to_compact()
+            assert compact.get_org_budgets(probe)==expected
+
+
+def test_reorg_errors_leave_the_org_unchanged():
+    organization=AlgoBookOrganization(sample_employees())
+    before=live_budgets(organization, range(12))
+    with pytest.raises(ValueError):
+        organization.add_employee(Employee(4, 1, 10))
+    with pytest.raises(ValueError):
+        organization.add_employee(Employee(11, None, 10))
+    with pytest.raises(KeyError):
+        organization.add_employee(Employee(11, 99, 10))
+    with pytest.raises(ValueError):
+        organization.remove_employee(1)
+    with pytest.raises(KeyError):
+        organization.remove_employee(99)
+    with pytest.raises(ValueError):
+        organization.move_subtree(2, 8)
+    with pytest.raises(ValueError):
+        organization.move_subtree(1, 2)
+    with pytest.raises(KeyError):
+        organization.set_budget(99, 1)
+    assert live_budgets(organization, range(12))==before
+
+
+@pytest.mark.skipif(np is None, reason="needs numpy")
+@pytest.mark.parametrize('spread', [1, 10**9])
+def test_numpy_batch_budgets(spread):
+    # Dense ids use a lookup table, spread out ones a sorted search
+    employees=[Employee(employee.employee_id*spread,
+                        employee.manager_id*spread
+                        if employee.manager_id is not None else None,
+                        employee.budget)
+               for employee in random_employees(300, 4)]
+    queries=[employee_id*spread for employee_id in range(-2, 305)]+[7]
+    expected=[brute_force_budget(employees, employee_id)
+              for employee_id in queries]
+    for organization in (AlgoBookOrganization(employees),
+                         CompactOrganization(employees)):
+        assert organization.get_org_budgets(
+            np.array(queries, dtype=np.int64)).tolist()==expected
+
+
+@pytest.mark.skipif(np is None, reason="needs numpy")
+def test_numpy_batch_budgets_without_int64_ids():
+    # Ids int64 can't hold fall back to the dict; empty orgs stay integer
+    employees=[Employee('ceo', None, 5), Employee(2, 'ceo', 3),
+               Employee(2**70, 2, 4), Employee(1.5, 2, 1)]
+    organization=AlgoBookOrganization(employees)
+    budgets=organization.get_org_budgets(np.array([[2, 1], [3, 2]]))
+    assert budgets.tolist()==[[8, 0], [0, 8]]
+    for organization in (AlgoBookOrganization([]), CompactOrganization([])):
+        budgets=organization.get_org_budgets(np.array([1, 2]))
+        assert budgets.dtype.kind=='i' and budgets.tolist()==[0, 0]
+
+
+def test_top_budgets_and_common_manager_match_brute_force():
+    employees=random_employees(400, 9)
+    organization=AlgoBookOrganization(employees)
+    index=organization.analytics()
+    shadow=ShadowOrg(employees)
+    managers={manager_id for manager_id in shadow.manager_of.values()
+              if manager_id is not None}|{organization.org_head.id}
+    ranked=sorted(((brute_force_budget(employees, manager_id), manager_id)
+                   for manager_id in managers),
+                  key=lambda entry: (-entry[0], entry[1]))
+    assert index.top_budgets(25)==[(manager_id, budget)
+                                   for budget, manager_id in ranked[:25]]
+
+    def chain(employee_id):
+        path=[]
+        while employee_id is not None:
+            path.append(employee_id)
+            employee_id=shadow.manager_of[employee_id]
+        return path
+
+    rng=random.Random(9)
+    for _ in range(300):
+        first, second=rng.randrange(400), rng.randrange(400)
+        if first==second:
+            expected=first if first in managers else shadow.manager_of[first]
+            expected=first if expected is None else expected
+        else:
+            above=set(chain(second))
+            expected=next(employee_id for employee_id in chain(first)
+                          if employee_id in above)
+        assert index.lowest_common_manager(first, second)==expected
+    assert index.lowest_common_manager(1, 999) is None
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.jsonl'])
+def test_files_load_like_employee_lists(tmp_path, suffix):
+    employees=random_employees(300, 5)
+    path=tmp_path/('org'+suffix)
+    with open(path, 'w') as output:
+        if suffix=='.csv':
+            output.write('employee_id,manager_id,budget\n')
+            for employee in employees:
+                manager_id=employee.manager_id
+                output.write(f'{employee.employee_id},'
+                             f'{"" if manager_id is None else manager_id},'
+                             f'{employee.budget}\n')
+        else:
+            for employee in employees:
+                output.write(json.dumps({
+                    'employee_id': employee.employee_id,
+                    'manager_id': employee.manager_id,
+                    'budget': employee.budget})+'\n\n')
+    expected=live_budgets(AlgoBookOrganization(employees), range(-1, 302))
+    # A tiny chunk size makes the reader cross many chunk boundaries
+    for organization in (
+            AlgoBookOrganization.from_file(str(path), chunk_size=64),
+            CompactOrganization.from_file(str(path), chunk_size=64)):
+        assert organization.build_result.is_complete()
+        assert live_budgets(organization, range(-1, 302))==expected
+
+
+@pytest.mark.parametrize('chunk_size', [16, 1 << 20])
+def test_short_csv_rows_name_their_line(tmp_path, chunk_size):
+    path=tmp_path/'org.csv'
+    path.write_text('employee_id,manager_id,budget\n1,,5\n\n3,1,"2\n"\n2,1\n')
+    with pytest.raises(ValueError, match=r"line 6: .*\['2', '1'\]"):
+        list(algo_book.read_employees(str(path), chunk_size))
@@ -0,0 +1,628 @@
+"""
+Tests for algo_fy beyond the in-file suite, run with pytest.
+"""
+
+from array import array
+import asyncio
+import json
+import random
+import threading
+
+import pytest
+
+import algo_fy
+from algo_fy import AlgoFy, AlgoFyServer, ApproxAlgoFy, _SortedSongs
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def reference_top(plays, k):
+    counts={}
+    for song in plays:
+        counts[song]=counts.get(song, 0)+1
+    return sorted(counts, key=lambda song: (-counts[song], song))[:k]
+
+
+def top_after(batch, k=5):
+    ranker=AlgoFy(k)
+    ranker.stream_songs(batch)
+    return ranker.get_top_k()
+
+
+PLAYS=[1, 2, 3, 4, 5, 6, 7, 8, 3, 3, 5, 8, 8, 8]
+
+
+@pytest.mark.parametrize('typecode', ['b', 'B', 'h', 'H', 'i', 'I', 'l', 'L',
+                                      'q', 'Q'])
+def test_typed_arrays_count_by_value(typecode):
+    expected=reference_top(PLAYS, 5)
+    assert top_after(array(typecode, PLAYS))==expected
+    assert top_after(memoryview(array(typecode, PLAYS)))==expected
+
+
+def test_byte_arrays_are_not_reinterpreted():
+    # array('B') and a memoryview over it are eight one-byte ids
+    batch=array('B', [1, 2, 3, 4, 5, 6, 7, 8])
+    assert top_after(batch, 8)==[1, 2, 3, 4, 5, 6, 7, 8]
+    assert top_after(memoryview(batch), 8)==[1, 2, 3, 4, 5, 6, 7, 8]
+
+
+def test_raw_buffers_hold_int64_ids():
+    raw=array('q', PLAYS).tobytes()
+    expected=reference_top(PLAYS, 5)
+    assert top_after(raw)==expected
+    assert top_after(bytearray(raw))==expected
+    # A view over raw bytes reads them the same way
+    assert top_after(memoryview(raw))==expected
+    assert top_after(memoryview(bytearray(raw))[8:])== \
+        reference_top(PLAYS[1:], 5)
+    with pytest.raises(ValueError):
+        top_after(raw[:-1])
+    with pytest.raises(ValueError):
+        top_after(memoryview(bytes([9, 9, 4])))
+
+
+@pytest.mark.parametrize('typecode', ['B', 'l', 'Q'])
+def test_buffers_count_the_same_without_numpy(monkeypatch, typecode):
+    rng=random.Random(typecode)
+    # Sparse wide ids take the unique path, narrow ones bincount
+    high=200 if typecode=='B' else 10**15
+    plays=[rng.randrange(high) for _ in range(3000)]+[7]*40
+    batch=array(typecode, plays)
+    batches=[batch, memoryview(batch), batch.tobytes()]
+    expected=[top_after(one, 20) for one in batches]
+    assert expected[0]==expected[1]==reference_top(plays, 20)
+    monkeypatch.setattr(algo_fy, 'np', None)
+    assert [top_after(one, 20) for one in batches]==expected
+
+
+def test_multidimensional_memoryview():
+    view=memoryview(array('q', PLAYS[:12])).cast('B').cast('q', (3, 4))
+    assert top_after(view)==reference_top(PLAYS[:12], 5)
+
+
+def test_rejects_non_integer_buffers():
+    with pytest.raises(TypeError):
+        top_after(array('d', [1.0, 2.0]))
+
+
+@pytest.mark.skipif(np is None, reason="needs numpy")
+@pytest.mark.parametrize('dtype', ['int8', 'uint16', 'int32', 'int64',
+                                   'uint64'])
+def test_numpy_batches(dtype):
+    rng=random.Random(dtype)
+    plays=[rng.randrange(100) for _ in range(2000)]
+    assert top_after(np.array(plays, dtype=dtype), 10)== \
+        reference_top(plays, 10)
+    # Sparse ids take the unique() path
+    sparse=[song*100000 for song in plays]
+    if np.iinfo(dtype).max>=max(sparse):
+        assert top_after(np.array(sparse, dtype=dtype), 10)== \
+            reference_top(sparse, 10)
+
+
+def test_typed_batches_in_windowed_and_logged_rankers(tmp_path):
+    batch=array('B', [1, 2, 3, 4, 5, 6, 7, 8, 8])
+    ranker=AlgoFy(3, window=3600, clock=lambda: 0)
+    ranker.stream_songs(batch, timestamp=0)
+    assert ranker.get_top_k()==[8, 1, 2]
+
+    log=str(tmp_path/'plays.log')
+    ranker=AlgoFy(3)
+    ranker.enable_log(log)
+    ranker.stream_songs(memoryview(batch))
+    ranker._log.close()
+    assert AlgoFy.recover(3, log_path=log).get_top_k()==[8, 1, 2]
+
+
+def test_late_plays_expire_with_their_own_bucket():
+    now=[0]
+    ranker=AlgoFy(3, window=3600, bucket_seconds=60, clock=lambda: now[0])
+    ranker.stream_songs([2], timestamp=3000)
+    # Late, but still inside the window as of t=3000
+    ranker.stream_songs([1, 1], timestamp=100)
+    now[0]=3000
+    assert ranker.get_top_k()==[1, 2]
+    now[0]=3750
+    assert ranker.get_top_k()==[2]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rolling_window_matches_brute_force(seed):
+    rng=random.Random(seed)
+    bucket_seconds=10
+    window=100
+    span=window//bucket_seconds
+    now=[0]
+    ranker=AlgoFy(5, window=window, bucket_seconds=bucket_seconds,
+                  clock=lambda: now[0])
+    kept=[]
+    newest=None
+    for step in range(300):
+        now[0]+=rng.randrange(0, 8)
+        timestamp=now[0]-rng.randrange(0, 140)
+        batch=[rng.randrange(12) for _ in range(rng.randrange(1, 6))]
+        ranker.stream_songs(batch, timestamp=timestamp)
+        index=timestamp//bucket_seconds
+        # Plays older than the newest bucket seen so far allows are dropped
+        if newest is None or index>newest-span:
+            kept.extend((index, song) for song in batch)
+        newest=max(newest if newest is not None else index, index,
+                   now[0]//bucket_seconds)
+        if rng.random()<0.3:
+            oldest=now[0]//bucket_seconds-span+1
+            live=[song for index, song in kept if index>=oldest]
+            assert ranker.get_top_k()==reference_top(live, 5)
+
+
+def test_dimension_charts_match_brute_force():
+    rng=random.Random(16)
+    ranker=AlgoFy(4)
+    plays=[]
+    for _ in range(50):
+        batch=[rng.randrange(30) for _ in range(20)]
+        tags=[rng.choice([None, 'EU', ('EU', 'rock'), 'US']) for _ in batch]
+        ranker.stream_songs(batch, dimensions=tags)
+        plays.extend(zip(batch, tags))
+    assert ranker.get_top_k()==reference_top([song for song, tags in plays], 4)
+    for dimension in ('EU', 'rock', 'US'):
+        tagged=[song for song, tags in plays
+                if tags==dimension or
+                (isinstance(tags, tuple) and dimension in tags)]
+        assert ranker.get_top_k(dimension)==reference_top(tagged, 4)
+
+
+def test_rolling_dimensions_release_expired_songs():
+    # Nothing outlives the window once every play in it has expired
+    now=[0]
+    ranker=AlgoFy(3, window=60, bucket_seconds=10, clock=lambda: now[0])
+    for step in range(100):
+        now[0]=step*10
+        songs=list(range(step*100, step*100+100))
+        ranker.stream_songs(songs, timestamp=now[0], dimensions=['EU']*100)
+    now[0]+=1000
+    assert ranker.get_top_k()==[] and ranker.get_top_k('EU')==[]
+    assert ranker._chart.counts=={} and ranker._chart.ranked=={}
+    assert all(not chart.counts and not chart.ranked
+               for chart in ranker._dimension_charts.values())
+    assert sum(len(played) for index, played in ranker._buckets)==0
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+def test_server_skips_malformed_socket_lines():
+    async def scenario():
+        server=await AlgoFyServer(AlgoFy(3)).start(port=0)
+        reader, writer=await asyncio.open_connection('127.0.0.1', server.port)
+        for line in (b'5', b'not json', b'{"song": 1}', b'"7"', b'[1, 1, 2]',
+                     b'[2, 1, 3]'):
+            writer.write(line+b'\n')
+        await writer.drain()
+        # The connection stays usable after the bad lines
+        while True:
+            writer.write(b'TOP\n')
+            await writer.drain()
+            chart=json.loads(await reader.readline())
+            if chart==[1, 2, 3]:
+                break
+            await asyncio.sleep(0.01)
+        writer.close()
+        await writer.wait_closed()
+        await server.submit([3, 3, 3])
+        await server.drain()
+        assert server.get_top_k()==[3, 1, 2]
+        assert server.rejected_batches==4
+        await server.close()
+
+    run(scenario())
+
+
+def test_server_refuses_bad_batches_on_submit():
+    async def scenario():
+        server=await AlgoFyServer(AlgoFy(3)).start()
+        for batch in (5, None, 'abc', array('d', [1.0])):
+            with pytest.raises(TypeError):
+                await server.submit(batch)
+        await server.submit(array('q', [4, 4]).tobytes())
+        await server.submit([5])
+        await server.drain()
+        assert server.get_top_k()==[4, 5]
+        await server.close()
+
+    run(scenario())
+
+
+class FailingAlgoFy(AlgoFy):
+    def stream_songs(self, songIds, *args, **kwargs):
+        if -1 in songIds:
+            raise RuntimeError("bad batch")
+        super().stream_songs(songIds, *args, **kwargs)
+
+
+def test_server_keeps_ingesting_after_a_failed_batch():
+    async def scenario():
+        server=await AlgoFyServer(FailingAlgoFy(3)).start()
+        await server.submit([-1])
+        await server.drain()
+        await server.submit([7, 7, 8])
+        await server.drain()
+        assert server.get_top_k()==[7, 8]
+        assert server.failed_batches==1
+        await server.close()
+
+    run(scenario())
+
+
+class RecordingAlgoFy(AlgoFy):
+    def stream_songs(self, songIds, *args, **kwargs):
+        self.calls.append(AlgoFyServer._batch_plays(songIds))
+        super().stream_songs(songIds, *args, **kwargs)
+
+
+def test_server_coalesces_by_plays_not_bytes():
+    # Raw buffers count ids rather than bytes, 2-D arrays every id
+    async def scenario(batches):
+        ranker=RecordingAlgoFy(3)
+        ranker.calls=[]
+        server=await AlgoFyServer(ranker, coalesce_plays=4).start()
+        for batch in batches:
+            await server.submit(batch)
+        await server.drain()
+        await server.close()
+        return ranker.calls
+
+    raw=array('q', [4, 4]).tobytes()
+    assert run(scenario([raw, memoryview(raw), [9]]))==[4, 1]
+    if np is not None:
+        assert run(scenario([np.array([[1, 2], [3, 4]]), [9]]))==[4, 1]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_top_k_with_large_ties_matches_brute_force(seed):
+    # Mostly one-play songs, so the cut keeps landing inside a big tie
+    #       bucket whose cached prefix has to follow every change
+    rng=random.Random(seed)
+    now=[0]
+    ranker=AlgoFy(7, window=50, bucket_seconds=5, clock=lambda: now[0])
+    plays=[]
+    for step in range(400):
+        now[0]+=rng.randrange(3)
+        batch=[rng.randrange(400) for _ in range(rng.randrange(1, 5))]
+        ranker.stream_songs(batch, timestamp=now[0])
+        plays.extend((now[0]//5, song) for song in batch)
+        live=[song for index, song in plays if index>now[0]//5-10]
+        assert ranker.get_top_k()==reference_top(live, 7)
+
+
+def reference_ranking(plays):
+    counts={}
+    for song in plays:
+        counts[song]=counts.get(song, 0)+1
+    return sorted(counts, key=lambda song: (-counts[song], song)), counts
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_rank_queries_match_brute_force(seed):
+    rng=random.Random(seed)
+    now=[0]
+    ranker=AlgoFy(5, window=200, bucket_seconds=10, clock=lambda: now[0])
+    plays=[]
+    # Small blocks so buckets split and empty blocks go away
+    _SortedSongs.BLOCK=4
+    try:
+        for step in range(300):
+            now[0]+=rng.randrange(4)
+            batch=[rng.randrange(rng.choice([20, 3000]))
+                   for _ in range(rng.randrange(1, 30))]
+            ranker.stream_songs(batch, timestamp=now[0])
+            plays.extend((now[0]//10, song) for song in batch)
+            if rng.random()<0.5:
+                continue
+            live=[song for index, song in plays if index>now[0]//10-20]
+            ranking, counts=reference_ranking(live)
+            for song in rng.sample(range(3000), 20):
+                expected=ranking.index(song)+1 if song in counts else None
+                assert ranker.get_rank(song)==expected
+            first=rng.randrange(1, len(ranking)+2)
+            last=first+rng.randrange(40)
+            assert ranker.get_songs_by_rank(first, last)== \
+                ranking[first-1:last]
+            threshold=rng.randrange(1, 6)
+            assert ranker.count_at_least(threshold)== \
+                sum(1 for plays in counts.values() if plays>=threshold)
+    finally:
+        _SortedSongs.BLOCK=256
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_rank_index_over_huge_sparse_counts(monkeypatch, seed):
+    # Small blocks so the distinct counts split and empty blocks go away
+    monkeypatch.setattr(algo_fy._LevelCounts, 'BLOCK', 2)
+    rng=random.Random(seed)
+    ranker=AlgoFy(5)
+    counts={}
+    ranker.get_rank(0)
+    for step in range(400):
+        song=rng.randrange(60)
+        plays=rng.choice([1, rng.randrange(1, 10**9)])
+        if counts.get(song, 0)>plays and rng.random()<0.5:
+            plays=-plays
+        ranker._chart.add(song, plays)
+        counts[song]=counts.get(song, 0)+plays
+        if not counts[song]:
+            del counts[song]
+        if rng.random()<0.7:
+            continue
+        ranking=sorted(counts, key=lambda song: (-counts[song], song))
+        assert [ranker.get_rank(song) for song in range(62)]== \
+            [ranking.index(song)+1 if song in counts else None
+             for song in range(62)]
+        assert ranker.get_songs_by_rank(1, len(ranking)+1)==ranking
+        threshold=rng.choice([1, 10**8, 10**9, rng.randrange(1, 2*10**9)])
+        assert ranker.count_at_least(threshold)== \
+            sum(1 for plays in counts.values() if plays>=threshold)
+    # Index size follows the distinct counts, not the largest one
+    levels=ranker._chart.rank_index.levels
+    assert sum(map(len, levels.blocks))==len(set(counts.values()))
+
+
+def random_tagged_batch(rng, songs=60):
+    batch=[rng.randrange(songs) for _ in range(rng.randrange(1, 30))]
+    tags=[rng.choice([None, 'EU', ('EU', 'rock'), 'US']) for _ in batch]
+    return batch, tags
+
+
+def check_charts(ranker, plays, k):
+    assert ranker.get_top_k()==reference_top([song for song, tags in plays], k)
+    for dimension in ('EU', 'rock', 'US'):
+        tagged=[song for song, tags in plays
+                if tags==dimension or
+                (isinstance(tags, tuple) and dimension in tags)]
+        assert ranker.get_top_k(dimension)==reference_top(tagged, k)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_reads_and_writes_during_a_checkpoint(tmp_path, monkeypatch, seed):
+    # Hold the writer thread so every read below runs over detached bases
+    release=threading.Event()
+    freeze=algo_fy._freeze_counts
+
+    def held(counts):
+        release.wait(10)
+        return freeze(counts)
+
+    monkeypatch.setattr(algo_fy, '_freeze_counts', held)
+    rng=random.Random(seed)
+    ranker=AlgoFy(6)
+    ranker.enable_log(str(tmp_path/'plays.log'))
+    plays=[]
+    for _ in range(40):
+        batch, tags=random_tagged_batch(rng)
+        ranker.stream_songs(batch, dimensions=tags)
+        plays.extend(zip(batch, tags))
+    ranker.get_top_k()
+    thread=ranker.checkpoint(str(tmp_path/'chart.ckpt'))
+    for _ in range(40):
+        batch, tags=random_tagged_batch(rng, 80)
+        ranker.stream_songs(batch, dimensions=tags)
+        plays.extend(zip(batch, tags))
+        if rng.random()<0.5:
+            check_charts(ranker, plays, 6)
+    assert thread.is_alive()
+    # stream_map still holds full counts, not just the plays since
+    assert ranker.stream_map==reference_ranking(
+        [song for song, tags in plays])[1]
+    release.set()
+    thread.join()
+    check_charts(ranker, plays, 6)
+    songs=[song for song, tags in plays]
+    ranking, counts=reference_ranking(songs)
+    assert ranker.get_songs_by_rank(1, len(ranking))==ranking
+    assert ranker.stream_map==counts
+
+    ranker._log.close()
+    recovered=AlgoFy.recover(6, str(tmp_path/'chart.ckpt'),
+                             str(tmp_path/'plays.log'))
+    recovered.settle()
+    check_charts(recovered, plays, 6)
+    recovered._log.close()
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_reads_and_writes_during_recovery(tmp_path, monkeypatch, seed):
+    rng=random.Random(seed)
+    ranker=AlgoFy(5)
+    log=str(tmp_path/'plays.log')
+    ranker.enable_log(log)
+    plays=[]
+    for step in range(60):
+        batch, tags=random_tagged_batch(rng)
+        ranker.stream_songs(batch, dimensions=tags)
+        plays.extend(zip(batch, tags))
+        if step==30:
+            ranker.checkpoint(str(tmp_path/'chart.ckpt'), background=False)
+    ranker._log.close()
+
+    # Hold the dict building so reads are served from the mapping
+    release=threading.Event()
+    materialize=algo_fy._MappedChart.materialize
+
+    def held(self):
+        release.wait(10)
+        return materialize(self)
+
+    monkeypatch.setattr(algo_fy._MappedChart, 'materialize', held)
+    recovered=AlgoFy.recover(5, str(tmp_path/'chart.ckpt'), log)
+    assert isinstance(recovered._chart.base, algo_fy._MappedChart)
+    check_charts(recovered, plays, 5)
+    counts=reference_ranking([song for song, tags in plays])[1]
+    stream_map=recovered.stream_map
+    assert stream_map==counts and len(stream_map)==len(counts)
+    assert stream_map.get(10**9) is None
+    for _ in range(30):
+        batch, tags=random_tagged_batch(rng, 90)
+        recovered.stream_songs(batch, dimensions=tags)
+        plays.extend(zip(batch, tags))
+        check_charts(recovered, plays, 5)
+    # A bigger k rebuilds the overlay candidates
+    assert recovered._chart.top(20)== \
+        reference_top([song for song, tags in plays], 20)
+    release.set()
+    ranking, counts=reference_ranking([song for song, tags in plays])
+    assert [recovered.get_rank(song) for song in range(100)]== \
+        [ranking.index(song)+1 if song in counts else None
+         for song in range(100)]
+    check_charts(recovered, plays, 5)
+    recovered._log.close()
+
+
+@pytest.mark.parametrize('background', [True, False])
+def test_failed_checkpoint_is_raised_and_cleaned_up(tmp_path, monkeypatch,
+                                                    background):
+    path=str(tmp_path/'chart.ckpt')
+    ranker=AlgoFy(3)
+    ranker.stream_songs([1, 1, 1, 2])
+    ranker.checkpoint(path, background=False)
+
+    def fail(descriptor):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(algo_fy.os, 'fsync', fail)
+    ranker.stream_songs([2, 3])
+    if background:
+        ranker.checkpoint(path).join()
+        ranker.stream_songs([1])
+        with pytest.raises(OSError, match='disk full'):
+            ranker.settle()
+        ranker.settle()
+    else:
+        with pytest.raises(OSError, match='disk full'):
+            ranker.checkpoint(path, background=False)
+        ranker.stream_songs([1])
+    assert not (tmp_path/'chart.ckpt.tmp').exists()
+    assert ranker.stream_map=={1: 4, 2: 2, 3: 1}
+    assert ranker.get_top_k()==[1, 2, 3]
+    monkeypatch.undo()
+    # The old checkpoint is untouched
+    recovered=AlgoFy.recover(3, path)
+    recovered.settle()
+    assert recovered.stream_map=={1: 3, 2: 1}
+
+
+def test_stream_map_during_a_checkpoint(tmp_path, monkeypatch):
+    release=threading.Event()
+    freeze=algo_fy._freeze_counts
+
+    def held(counts):
+        release.wait(10)
+        return freeze(counts)
+
+    monkeypatch.setattr(algo_fy, '_freeze_counts', held)
+    ranker=AlgoFy(3)
+    ranker.stream_songs([1, 1, 1, 2])
+    thread=ranker.checkpoint(str(tmp_path/'chart.ckpt'))
+    ranker.stream_songs([1, 5])
+    stream_map=ranker.stream_map
+    assert stream_map=={1: 4, 2: 1, 5: 1} and len(stream_map)==3
+    assert stream_map[2]==1 and 7 not in stream_map
+    release.set()
+    thread.join()
+    ranker.settle()
+    # A view handed out earlier follows the chart once it is attached
+    assert stream_map=={1: 4, 2: 1, 5: 1}
+    assert ranker.stream_map is ranker._chart.counts
+
+
+@pytest.mark.skipif(np is None, reason="needs numpy")
+def test_checkpoint_layout_without_numpy(monkeypatch):
+    rng=random.Random(3)
+    counts={rng.randrange(-50, 10**6): rng.randrange(1, 6)
+            for _ in range(5000)}
+    with_numpy=[list(column) for column in algo_fy._freeze_counts(counts)]
+    monkeypatch.setattr(algo_fy, 'np', None)
+    monkeypatch.setattr(algo_fy._MappedChart, 'CHUNK', 64)
+    assert [list(column) for column in algo_fy._freeze_counts(counts)]== \
+        with_numpy
+    songs, levels, runs, ids, plays=with_numpy
+    assert songs==sorted(counts, key=lambda song: (-counts[song], song))
+    assert ids==sorted(counts) and plays==[counts[song] for song in ids]
+    assert levels==[5, 4, 3, 2, 1] and sum(runs)==len(counts)
+
+
+def test_daily_chart_rolls_over():
+    now=[0]
+    day=24*60*60
+    ranker=AlgoFy(3, window='day', rollover_offset=3600, clock=lambda: now[0])
+    ranker.stream_songs([1, 1, 2], timestamp=3600+10)
+    now[0]=3600+day-1
+    ranker.stream_songs([2, 2], timestamp=now[0])
+    assert ranker.get_top_k()==[2, 1]
+    now[0]=3600+day
+    ranker.stream_songs([3], timestamp=now[0])
+    # Yesterday's plays are gone, and late ones for it are dropped
+    ranker.stream_songs([1, 1, 1], timestamp=3600+day-5)
+    assert ranker.get_top_k()==[3]
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_approximate_counts_stay_within_bounds(seed):
+    rng=random.Random(seed)
+    epsilon=0.01
+    ranker=ApproxAlgoFy(5, epsilon=epsilon, seed=seed)
+    plays=[]
+    for _ in range(40):
+        # A few heavy songs over a long tail
+        batch=[int(rng.paretovariate(0.8)) for _ in range(500)]
+        ranker.stream_songs(batch)
+        plays.extend(batch)
+    counts={}
+    for song in plays:
+        counts[song]=counts.get(song, 0)+1
+    bound=epsilon*len(plays)
+    assert ranker.total_plays==len(plays)
+    for song, estimate, error in ranker.get_top_k_with_errors():
+        assert counts[song]<=estimate<=counts[song]+bound
+        assert estimate-error<=counts[song]
+    # Anything played more than epsilon of the time is monitored
+    heavy=[song for song, count in counts.items() if count>bound]
+    assert all(song in ranker._chart.counts for song in heavy)
+    assert set(ranker.get_top_k())>= \
+        set(reference_top(plays, 5)[:2])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merged_shards_match_one_ranker(seed):
+    rng=random.Random(seed)
+    shards=[AlgoFy(6) for _ in range(rng.randrange(1, 5))]
+    plays=[]
+    for _ in range(60):
+        # Skewed per shard, so local and global top lists disagree
+        shard=rng.randrange(len(shards))
+        batch=[rng.randrange(shard*10, shard*10+40)
+               for _ in range(rng.randrange(1, 40))]
+        shards[shard].stream_songs(batch)
+        plays.extend(batch)
+    expected=reference_top(plays, 6)
+    assert algo_fy.merge_top_k(shards, 6)==expected
+    merged=AlgoFy.from_partials(6, [shard.dump_partial()
+                                    for shard in shards])
+    assert merged.get_top_k()==expected
+    assert algo_fy.merge_top_k(shards, 0)==[]
+
+
+def test_sharded_ranker_matches_one_ranker():
+    rng=random.Random(8)
+    plays=[]
+    with algo_fy.ShardedAlgoFy(4, workers=2) as sharded:
+        for _ in range(30):
+            batch=[rng.randrange(50) for _ in range(rng.randrange(1, 30))]
+            sharded.stream_songs(batch)
+            plays.extend(batch)
+        assert sharded.get_top_k()==reference_top(plays, 4)
+        merged=AlgoFy.from_partials(4, sharded.dump_partials())
+        assert merged.get_top_k()==reference_top(plays, 4)
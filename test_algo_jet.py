@@ -0,0 +1,435 @@
+"""
+Tests for algo_jet beyond the in-file suite, run with pytest.
+"""
+
+import math
+import random
+import tracemalloc
+
+import pytest
+
+import algo_jet
+from algo_jet import AlgoJet, Flight
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def reference_price(flights, source, destination):
+    # Plain dict Dijkstra over a graph built from scratch
+    jet=AlgoJet(cache_limit=0)
+    jet.initialize_flight_graph([Flight(*flight) for flight in flights])
+    if source==destination:
+        return 0
+    if source not in jet.graph or destination not in jet.graph:
+        return -1
+    return jet.get_cheapest_flight(source, destination)
+
+
+def random_fare(rng, floats):
+    price=rng.randint(1, 60)
+    return price+0.5 if floats else price
+
+
+def grid_flights(size, seed):
+    rng=random.Random(seed)
+    flights=[]
+    for row in range(size):
+        for column in range(size):
+            for next_row, next_column in ((row+1, column), (row, column+1)):
+                if next_row<size and next_column<size:
+                    flights.append((f'{row},{column}',
+                                    f'{next_row},{next_column}',
+                                    rng.randint(1, 100)))
+                    flights.append((f'{next_row},{next_column}',
+                                    f'{row},{column}', rng.randint(1, 100)))
+    return flights
+
+
+@pytest.mark.parametrize('seed', range(12))
+def test_fare_updates_match_rebuild(seed):
+    rng=random.Random(seed)
+    floats=seed%4==0
+    names=[f'C{i}' for i in range(25)]
+    flights=[(rng.choice(names[:20]), rng.choice(names[:20]),
+              random_fare(rng, floats)) for _ in range(60)]
+    # Parallel fares on some routes
+    flights+=[(source, destination, random_fare(rng, floats))
+              for source, destination, price in flights[:15]]
+    # Dict graph, small tree cache, frozen, and frozen with both indexes
+    jets=[]
+    for cache_limit, freeze, indexes in ((10**6, False, False),
+                                         (40, False, False),
+                                         (10**6, True, False),
+                                         (10**6, True, True)):
+        jet=AlgoJet(cache_limit=cache_limit)
+        jet.initialize_flight_graph([Flight(*flight) for flight in flights],
+                                    freeze=freeze,
+                                    landmarks=3 if indexes else 0,
+                                    contract=indexes)
+        jets.append(jet)
+    methods=[['dijkstra'], ['dijkstra'], ['dijkstra', 'bidirectional'],
+             ['dijkstra', 'bidirectional', 'alt', 'ch']]
+
+    def check():
+        for _ in range(30):
+            source=rng.choice(names[:8])
+            destination=rng.choice(names)
+            expected=reference_price(flights, source, destination)
+            for jet, jet_methods in zip(jets, methods):
+                for method in jet_methods:
+                    assert jet.get_cheapest_flight(source, destination,
+                                                   method)==expected
+
+    check()
+    for step in range(60):
+        action=rng.random()
+        if action<0.35 or not flights:
+            flight=(rng.choice(names), rng.choice(names),
+                    random_fare(rng, floats))
+            # An occasional float fare on an int graph forces a refreeze
+            if rng.random()<0.1 and not floats:
+                flight=flight[:2]+(float(flight[2]),)
+            flights.append(flight)
+            for jet in jets:
+                jet.add_flight(Flight(*flight))
+        elif action<0.65:
+            flight=flights.pop(rng.randrange(len(flights)))
+            for jet in jets:
+                jet.remove_flight(Flight(*flight))
+        else:
+            i=rng.randrange(len(flights))
+            flight=flights[i]
+            new_price=random_fare(rng, floats)
+            flights[i]=flight[:2]+(new_price,)
+            for jet in jets:
+                jet.change_price(Flight(*flight), new_price)
+        if step%3==0:
+            check()
+    with pytest.raises(KeyError):
+        jets[0].remove_flight(Flight('C0', 'C1', 10**9))
+
+
+def test_queries_never_rebuild_indexes_after_updates(monkeypatch):
+    flights=grid_flights(8, 1)
+    jet=AlgoJet()
+    jet.initialize_flight_graph([Flight(*flight) for flight in flights],
+                                landmarks=4, contract=True)
+    built=[]
+    hierarchy=algo_jet.ContractionHierarchy
+    monkeypatch.setattr(algo_jet, 'ContractionHierarchy',
+                        lambda *args: built.append(args) or
+                        hierarchy(*args))
+    monkeypatch.setattr(algo_jet.CompactFlightGraph, 'build_landmarks',
+                        lambda *args: built.append(args))
+    rng=random.Random(1)
+    for _ in range(40):
+        i=rng.randrange(len(flights))
+        flight=flights[i]
+        new_price=max(1, flight[2]+rng.randint(-30, 30))
+        flights[i]=flight[:2]+(new_price,)
+        jet.change_price(Flight(*flight), new_price)
+        source, destination=rng.sample(sorted(jet.compact.cities), 2)
+        expected=reference_price(flights, source, destination)
+        for method in ('ch', 'alt', 'bidirectional', 'dijkstra'):
+            assert jet.get_cheapest_flight(source, destination,
+                                           method)==expected
+    assert built==[]
+    # Landmarks are repaired, never dropped
+    assert jet.compact.landmarks
+
+    monkeypatch.undo()
+    jet.compact.build_hierarchy()
+    source, destination='0,0', '7,7'
+    assert jet.get_cheapest_flight(source, destination, 'ch')== \
+        reference_price(flights, source, destination)
+    assert jet.compact.hierarchy is not None
+
+
+def test_hierarchy_survives_updates_that_keep_prices():
+    jet=AlgoJet()
+    jet.initialize_flight_graph([Flight('A', 'B', 1), Flight('B', 'C', 1),
+                                 Flight('C', 'D', 1)], contract=True)
+    hierarchy=jet.compact.hierarchy
+    # Never cheaper than going through B
+    jet.add_flight(Flight('A', 'C', 5))
+    jet.change_price(Flight('A', 'C', 5), 3)
+    jet.remove_flight(Flight('A', 'C', 3))
+    assert jet.compact.hierarchy is hierarchy
+    assert jet.get_cheapest_flight('A', 'D', 'ch')==3
+    # A cheaper route changes prices, so the hierarchy goes
+    jet.add_flight(Flight('A', 'D', 2))
+    assert jet.compact.hierarchy is None
+    assert jet.get_cheapest_flight('A', 'D', 'ch')==2
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_repaired_landmarks_stay_lower_bounds(seed):
+    rng=random.Random(seed)
+    flights=grid_flights(6, seed)
+    jet=AlgoJet()
+    jet.initialize_flight_graph([Flight(*flight) for flight in flights],
+                                landmarks=3)
+    names=sorted(jet.compact.cities)+['X', 'Y']
+    for _ in range(40):
+        if rng.random()<0.5:
+            flight=(rng.choice(names), rng.choice(names), rng.randint(1, 40))
+            flights.append(flight)
+            jet.add_flight(Flight(*flight))
+        else:
+            i=rng.randrange(len(flights))
+            flight=flights[i]
+            new_price=rng.randint(1, 150)
+            flights[i]=flight[:2]+(new_price,)
+            jet.change_price(Flight(*flight), new_price)
+        graph=jet.compact
+        for landmark, from_landmark, to_landmark in zip(
+                graph.landmarks, graph.landmark_from, graph.landmark_to):
+            exact_from=graph.prices_from(landmark)
+            exact_to=graph.prices_from(landmark, reverse=True)
+            assert all(bound<=price for bound, price
+                       in zip(from_landmark, exact_from))
+            assert all(bound<=price for bound, price
+                       in zip(to_landmark, exact_to))
+        source, destination=rng.sample(names[:-2], 2)
+        assert jet.get_cheapest_flight(source, destination, 'alt')== \
+            reference_price(flights, source, destination)
+
+
+def random_flights(cities, count, seed):
+    rng=random.Random(seed)
+    return [(f'C{rng.randrange(cities)}', f'C{rng.randrange(cities)}',
+             rng.randint(1, 500)) for _ in range(count)]
+
+
+def test_frozen_graph_owns_the_topology():
+    flights=[Flight(*flight) for flight in random_flights(2000, 30000, 1)]
+    tracemalloc.start()
+    before=tracemalloc.get_traced_memory()[0]
+    jet=AlgoJet()
+    jet.initialize_flight_graph(flights)
+    as_dict=tracemalloc.get_traced_memory()[0]-before
+    jet.freeze_graph()
+    frozen=tracemalloc.get_traced_memory()[0]-before
+    tracemalloc.stop()
+    assert jet._graph is None
+    assert frozen<as_dict
+
+    reference=AlgoJet()
+    reference.initialize_flight_graph(flights)
+    assert jet.compact.to_dict()==reference.graph
+    # Loading more flights starts from the frozen routes
+    more=[Flight(*flight) for flight in random_flights(2100, 3000, 2)]
+    jet.initialize_flight_graph(more, freeze=True)
+    reference.initialize_flight_graph(more)
+    assert jet.compact.to_dict()==reference.graph
+    rng=random.Random(3)
+    for _ in range(50):
+        source, destination=rng.sample(sorted(reference.graph), 2)
+        assert jet.get_cheapest_flight(source, destination,
+                                       'bidirectional')== \
+            reference.get_cheapest_flight(source, destination)
+
+
+def reference_prices(flights, source):
+    # Bellman-Ford from source over the cheapest fare per route
+    prices={source: 0}
+    for _ in range(len(flights)+1):
+        changed=False
+        for start, goal, price in flights:
+            if start in prices and prices[start]+price<prices.get(goal,
+                                                                   math.inf):
+                prices[goal]=prices[start]+price
+                changed=True
+        if not changed:
+            break
+    return prices
+
+
+def fare_network(fares, cities=40, count=160):
+    # Random routes with int, float, mixed or large fares
+    rng=random.Random(fares)
+    names=[f'C{i}' for i in range(cities)]
+
+    def fare():
+        price=rng.randint(0, 30)
+        if fares=='float' or fares=='mixed' and rng.random()<0.3:
+            return price+0.25
+        return price*1000 if fares=='large' else price
+
+    return names, [(rng.choice(names), rng.choice(names), fare())
+                   for _ in range(count)]
+
+
+def check_methods(jet, names, flights, methods):
+    for source in names[:12]:
+        prices=reference_prices(flights, source)
+        for destination in names+['nowhere']:
+            expected=prices.get(destination, -1)
+            for method in methods:
+                assert jet.get_cheapest_flight(source, destination,
+                                               method)==expected
+
+
+@pytest.mark.parametrize('fares', ['int', 'float', 'mixed'])
+def test_search_methods_match_brute_force(fares):
+    names, flights=fare_network(fares)
+    jet=AlgoJet(cache_limit=0)
+    jet.initialize_flight_graph([Flight(*flight) for flight in flights],
+                                landmarks=4)
+    check_methods(jet, names, flights, ('dijkstra', 'bidirectional', 'alt'))
+    with pytest.raises(ValueError):
+        jet.get_cheapest_flight('C0', 'C1', 'astar')
+
+
+@pytest.mark.parametrize('fares', ['int', 'float', 'mixed'])
+def test_contraction_hierarchy_matches_brute_force(fares):
+    names, flights=fare_network(fares)
+    jet=AlgoJet(cache_limit=0)
+    jet.initialize_flight_graph([Flight(*flight) for flight in flights],
+                                contract=True)
+    check_methods(jet, names, flights, ('ch',))
+
+
+def test_tree_cache_stays_within_its_limit():
+    flights=grid_flights(10, 3)
+    limit=150
+    jet=AlgoJet(cache_limit=limit)
+    jet.initialize_flight_graph([Flight(*flight) for flight in flights],
+                                freeze=True)
+    reference=AlgoJet(cache_limit=0)
+    reference.initialize_flight_graph([Flight(*flight) for flight in flights])
+    rng=random.Random(3)
+    cities=sorted(reference.graph)
+    for _ in range(300):
+        # A few busy origins, so trees get reused as well as evicted
+        source=rng.choice(cities[:6]) if rng.random()<0.7 else \
+            rng.choice(cities)
+        destination=rng.choice(cities)
+        assert jet.get_cheapest_flight(source, destination)== \
+            reference.get_cheapest_flight(source, destination)
+        assert jet.cache_size==sum(len(tree) for tree in jet.trees.values())
+        assert jet.cache_size<=limit or len(jet.trees)==1
+    # A settled city is answered without settling anything new
+    source, destination=cities[0], cities[-1]
+    jet.get_cheapest_flight(source, destination)
+    jet.get_cheapest_flight(source, destination)
+    assert jet.last_settled==0
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_fare_matrix_matches_brute_force(processes):
+    rng=random.Random(processes)
+    names=[f'C{i}' for i in range(30)]
+    flights=[(rng.choice(names), rng.choice(names), rng.randint(1, 50))
+             for _ in range(100)]
+    jet=AlgoJet()
+    jet.initialize_flight_graph([Flight(*flight) for flight in flights])
+    sources=names[:10]+['C3', 'nowhere']
+    destinations=names[5:25]+['nowhere']
+    matrix=jet.get_fare_matrix(sources, destinations, processes=processes)
+    expected=[]
+    for source in sources:
+        prices=reference_prices(flights, source)
+        expected.append([0 if source==destination else
+                         prices.get(destination, -1)
+                         for destination in destinations])
+    if np is not None:
+        matrix=matrix.tolist()
+    assert matrix==expected
+
+
+@pytest.mark.parametrize('fares', ['int', 'float', 'mixed', 'large'])
+@pytest.mark.parametrize('bits', [12, 2])
+def test_bucket_queue_matches_brute_force(monkeypatch, fares, bits):
+    # Two bits makes every bucket span many prices, even for small fares
+    monkeypatch.setattr(algo_jet.CompactFlightGraph, 'DIAL_BITS', bits)
+    names, flights=fare_network(fares)
+    cached=AlgoJet()
+    cached.initialize_flight_graph([Flight(*flight) for flight in flights],
+                                   freeze=True)
+    unfrozen=AlgoJet()
+    unfrozen.initialize_flight_graph([Flight(*flight) for flight in flights])
+    uncached=AlgoJet(cache_limit=0)
+    uncached.initialize_flight_graph([Flight(*flight) for flight in flights],
+                                     freeze=True, landmarks=3)
+    check_methods(cached, names, flights, ('dijkstra',))
+    check_methods(unfrozen, names, flights, ('dijkstra',))
+    check_methods(uncached, names, flights, ('dijkstra', 'alt'))
+    integral=fares in ('int', 'large')
+    assert (cached.compact.bucket_ring is not None)==integral
+    assert all((tree.buckets is not None)==integral
+               for tree in unfrozen.trees.values())
+    assert jet_rings(cached)==jet_rings(unfrozen)
+
+
+def jet_rings(jet):
+    return {tree.buckets is not None and (len(tree.buckets), tree.shift)
+            for tree in jet.trees.values()}
+
+
+def test_cached_dict_trees_follow_fare_updates():
+    rng=random.Random(7)
+    names=[f'C{i}' for i in range(30)]
+    flights=[Flight(rng.choice(names), rng.choice(names), rng.randint(1, 40))
+             for _ in range(120)]
+    jet=AlgoJet()
+    jet.initialize_flight_graph(flights)
+    rings=set()
+    for step in range(80):
+        flight=rng.choice(flights)
+        # Mostly small int fares, sometimes a much larger fare or a float
+        roll=rng.random()
+        new_price=rng.randint(10**5, 10**6) if roll<0.2 else \
+            2.5 if roll<0.25 else rng.randint(0, 40)
+        jet.change_price(flight, new_price)
+        flights[flights.index(flight)]=Flight(flight.source,
+                                              flight.destination, new_price)
+        if rng.random()<0.3:
+            jet.remove_flight(flights.pop(rng.randrange(len(flights))))
+        for source in rng.sample(names, 4):
+            prices=reference_prices([(flight.source, flight.destination,
+                                      flight.price) for flight in flights],
+                                    source)
+            for destination in rng.sample(names, 8):
+                assert jet.get_cheapest_flight(source, destination)== \
+                    prices.get(destination, -1)
+        rings|=jet_rings(jet)
+    assert jet.compact is None
+    # Heap trees, one-price buckets and wide buckets all took part
+    assert False in rings
+    assert {ring[1]>0 for ring in rings if ring}=={False, True}
+
+
+def test_graph_stays_readable_after_freezing():
+    flights=[Flight(*flight) for flight in random_flights(60, 300, 4)]
+    reference=AlgoJet()
+    reference.initialize_flight_graph(flights)
+    jet=AlgoJet()
+    jet.initialize_flight_graph(flights)
+    # A bad method is refused before anything is frozen
+    with pytest.raises(ValueError):
+        jet.get_cheapest_flight('C0', 'C1', 'bogus')
+    assert jet.compact is None and jet.graph==reference.graph
+    jet.get_cheapest_flight('C0', 'C1', 'bidirectional')
+    assert jet._graph is None
+    assert jet.graph==reference.graph
+    # The thawed copy follows later fare updates
+    rng=random.Random(4)
+    for _ in range(40):
+        flight=rng.choice(flights)
+        new_price=rng.randint(1, 500)
+        for target in (jet, reference):
+            target.change_price(flight, new_price)
+        flights[flights.index(flight)]=Flight(flight.source,
+                                              flight.destination, new_price)
+        extra=Flight(f'C{rng.randrange(70)}', f'C{rng.randrange(70)}',
+                     rng.randint(1, 500))
+        flights.append(extra)
+        for target in (jet, reference):
+            target.add_flight(extra)
+        assert jet.graph==reference.graph
+        assert jet.get_cheapest_flight('C0', 'C5', 'bidirectional')== \
+            reference.get_cheapest_flight('C0', 'C5')